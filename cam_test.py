@@ -3,6 +3,7 @@
 import datetime
 import subprocess
 import tempfile
+from v4l2 import exif
 from v4l2 import v4l2
 
 
@@ -31,18 +32,7 @@ def take_photo(device="/dev/video0", resolution="1920x1080", filename=None):
         print(rval)
         return None
 
-    isodate = datetime.datetime.now().isoformat()
-
-    result = subprocess.run(
-        [
-            "exiftool",
-            "-overwrite_original",
-            "-DateTimeOriginal='{}'".format(isodate),
-            filename,
-        ],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
+    exif.stamp_file(filename, datetime.datetime.now())
 
     return filename
 
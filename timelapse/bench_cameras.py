@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""
+Drive 1, 2, 4 and 8 fake cameras from one Timelapse process and report
+CPU time and how late captures start (after each camera's first). The
+"separate daemons" column is the single camera run multiplied by the
+number of cameras, which is what one daemon per camera costs.
+
+    ./bench_cameras.py --interval 0.5 --duration 10
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import yaml
+
+import timelapse
+from v4l2 import v4l2
+from v4l2.fake import FakeDevice
+
+
+def write_config(tmp_dir, count, interval):
+    config = {
+        "device": "/dev/video0",
+        "duration": None,
+        "interval": interval,
+        "out_dir": os.path.join(tmp_dir, "photos"),
+        "prefix": "bench_",
+        "resolution": "640x480",
+        "start_time": None,
+        "stats_interval": 1e9,
+        "cameras": [
+            {"device": "/dev/video{}".format(index * 2)} for index in range(1, count)
+        ],
+    }
+    config_path = os.path.join(tmp_dir, "config.yml")
+    with open(config_path, "w") as config_file:
+        yaml.dump(config, config_file)
+    return config_path
+
+
+def run(count, interval, duration):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        daemon = timelapse.Timelapse(
+            write_config(tmp_dir, count, interval),
+            capture_options={"transport": FakeDevice, "warmup": 0},
+            control_backend=lambda path: v4l2.IoctlBackend(path, transport=FakeDevice),
+        )
+
+        # Timelapse.run() without the endless loop
+        cpu_start = time.process_time()
+        end_time = time.monotonic() + duration
+        while time.monotonic() < end_time:
+            daemon.config_check()
+            timeout = 1
+            for camera in daemon.cameras.values():
+                timeout = min(timeout, camera.tick())
+            time.sleep(max(0, timeout))
+        cpu_time = time.process_time() - cpu_start
+
+        for camera in daemon.cameras.values():
+            camera.stop()
+        daemon.pipeline.join()
+        daemon.config_watcher.close()
+
+        # A camera's first photo waits for the cameras opened before it
+        lateness = sorted(
+            late
+            for camera in daemon.cameras.values()
+            for late in list(camera.scheduler.lateness)[1:]
+        )
+        taken = sum(camera.scheduler.taken for camera in daemon.cameras.values())
+        missed = sum(camera.scheduler.missed for camera in daemon.cameras.values())
+        return cpu_time, taken, missed, lateness
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--interval", type=float, default=0.5)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--cameras", default="1,2,4,8")
+    args = parser.parse_args()
+
+    single_cpu = None
+    print(
+        "cameras  photos  missed  cpu (s)  separate daemons (s)  "
+        "lateness p50 / p99 (ms)"
+    )
+    for count in [int(count) for count in args.cameras.split(",")]:
+        cpu_time, taken, missed, lateness = run(count, args.interval, args.duration)
+        if single_cpu is None:
+            single_cpu = cpu_time / count
+        print(
+            "{:7d} {:7d} {:7d} {:8.2f} {:21.2f}  {:7.1f} / {:.1f}".format(
+                count,
+                taken,
+                missed,
+                cpu_time,
+                single_cpu * count,
+                lateness[len(lateness) // 2] * 1000,
+                lateness[len(lateness) * 99 // 100] * 1000,
+            )
+        )
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+How long the capture thread is held up per photo when writes to out_dir
+are slow, with the old inline stamp and write against the pipeline.
+
+    ./bench_pipeline.py --photos 50 --write-delay 0.2 --policy spill
+"""
+
+import argparse
+import io
+import os
+import tempfile
+import time
+from datetime import datetime
+
+from PIL import Image
+
+import pipeline
+from v4l2 import exif
+
+
+def sample_jpeg():
+    data = io.BytesIO()
+    Image.new("RGB", (1920, 1080)).save(data, "JPEG")
+    return data.getvalue()
+
+
+def slow_writes(out_dir, delay):
+    write_atomic = pipeline.write_atomic
+
+    def slow_write_atomic(filename, data):
+        # Stand in for a busy SD card, spill_dir stays fast
+        if os.path.dirname(filename) == out_dir:
+            time.sleep(delay)
+        return write_atomic(filename, data)
+
+    return slow_write_atomic
+
+
+def inline(out_dir, jpeg, photos):
+    held = []
+    for index in range(photos):
+        start = time.monotonic()
+        data = exif.add_datetime(jpeg, datetime.now())
+        pipeline.write_atomic(
+            os.path.join(out_dir, "inline_{:06d}.jpg".format(index)), data
+        )
+        held.append(time.monotonic() - start)
+    return held
+
+
+def pipelined(out_dir, jpeg, photos, depth, policy, spill_dir):
+    stages = pipeline.Pipeline(depth, policy, spill_dir)
+    held = []
+    for index in range(photos):
+        start = time.monotonic()
+        stages.submit(
+            os.path.join(out_dir, "pipeline_{:06d}.jpg".format(index)),
+            jpeg,
+            datetime.now(),
+        )
+        held.append(time.monotonic() - start)
+    stages.join()
+    stages.close()
+    return held, stages.stats()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--photos", type=int, default=50)
+    parser.add_argument(
+        "--write-delay", type=float, default=0.2, help="Seconds per write"
+    )
+    parser.add_argument("--depth", type=int, default=pipeline.FRAME_QUEUE)
+    parser.add_argument("--policy", default="spill", choices=pipeline.SPILL_POLICIES)
+    args = parser.parse_args()
+
+    jpeg = sample_jpeg()
+    with tempfile.TemporaryDirectory() as out_dir:
+        with tempfile.TemporaryDirectory() as spill_dir:
+            pipeline.write_atomic = slow_writes(out_dir, args.write_delay)
+            results = [("inline", inline(out_dir, jpeg, args.photos))]
+            held, stats = pipelined(
+                out_dir, jpeg, args.photos, args.depth, args.policy, spill_dir
+            )
+            results.append(("pipeline", held))
+            written = len(os.listdir(out_dir)) - args.photos
+
+    for name, held in results:
+        held.sort()
+        print(
+            "{:8s} capture thread held p50 {:7.1f}ms max {:7.1f}ms".format(
+                name, held[len(held) // 2] * 1000, held[-1] * 1000
+            )
+        )
+    print(
+        "{} of {} pipeline photos written ({})".format(
+            written, args.photos, args.policy
+        )
+    )
+    for name, stage in stats.items():
+        print("{:8s} {}".format(name, stage))
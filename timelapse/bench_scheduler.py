@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""
+Run the capture schedule on a simulated clock for a million frames, with
+random capture times and wake up jitter, and compare it with the old loop
+(photo interval measured from the last check, polled once a second).
+
+    ./bench_scheduler.py --frames 1000000 --interval 10 --capture 0.5
+    ./bench_scheduler.py --interval 0.5 --capture 0.3 --policy burst
+"""
+
+import argparse
+import collections
+import random
+
+import scheduler
+
+
+class SimulatedClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, duration):
+        self.now += max(0, duration)
+
+
+def capture_time(mean, stall_every):
+    # Mostly steady, with the odd very slow capture (e.g. USB reset)
+    if stall_every and random.randrange(stall_every) == 0:
+        return mean * 20
+    return random.uniform(0.5 * mean, 1.5 * mean)
+
+
+def run_scheduler(frames, interval, mean_capture, stall_every, policy):
+    clock = SimulatedClock()
+    schedule = scheduler.Scheduler(0.0, interval, policy, clock=clock, wall_clock=clock)
+    # Finish times of the captures queued on the worker
+    worker = collections.deque()
+    worker_free = 0.0
+    first_start = None
+    last_frame = None
+    last_start = None
+
+    while schedule.next_frame < frames:
+        while worker and worker[0] <= clock.now:
+            worker.popleft()
+
+        for frame in schedule.due(clock.now, len(worker)):
+            start = max(clock.now, worker_free)
+            schedule.record(frame, start)
+            worker_free = start + capture_time(mean_capture, stall_every)
+            worker.append(worker_free)
+            if first_start is None:
+                first_start = start
+            last_frame, last_start = frame, start
+
+        timeout = min(1, schedule.next_deadline() - clock.now)
+        # The OS wakes the loop up a little late
+        clock.sleep(timeout + random.uniform(0, 0.002))
+
+    # Start of the last frame against where the grid says it should be
+    drift = (last_start - first_start) - last_frame * interval
+    return schedule.stats(), drift
+
+
+def run_old_loop(frames, interval, mean_capture, stall_every):
+    now = 0.0
+    last_photo_time = 0.0
+    taken = 0
+    while taken < frames:
+        if now >= last_photo_time + interval:
+            last_photo_time = now
+            now += capture_time(mean_capture, stall_every)
+            taken += 1
+        now += 1 + random.uniform(0, 0.002)
+    return now - frames * interval
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=1000000)
+    parser.add_argument("--interval", type=float, default=10.0)
+    parser.add_argument(
+        "--capture", type=float, default=0.5, help="Mean capture time in seconds"
+    )
+    parser.add_argument(
+        "--stall-every", type=int, default=1000, help="One slow capture every N"
+    )
+    parser.add_argument("--policy", default="skip", choices=scheduler.POLICIES)
+    args = parser.parse_args()
+
+    random.seed(0)
+    stats, drift = run_scheduler(
+        args.frames, args.interval, args.capture, args.stall_every, args.policy
+    )
+    print(
+        "scheduler ({}): {} taken, {} missed, drift {:.6f}s after {} frames".format(
+            args.policy, stats["taken"], stats["missed"], drift, args.frames
+        )
+    )
+    print(
+        "  start lateness p50 {:.4f}s p99 {:.4f}s max {:.4f}s".format(
+            stats["lateness"]["p50"], stats["lateness"]["p99"], stats["max_lateness"]
+        )
+    )
+
+    if args.interval >= 1:
+        random.seed(0)
+        old_drift = run_old_loop(
+            args.frames, args.interval, args.capture, args.stall_every
+        )
+        print(
+            "old loop: drift {:.0f}s ({:.1f} days) after {} frames".format(
+                old_drift, old_drift / 86400, args.frames
+            )
+        )
+    else:
+        print("old loop: can't take more than one photo a second")
@@ -0,0 +1,199 @@
+"""
+Reload the timelapse config only when the file changes.
+
+With watchdog installed, inotify events on the config's directory say when
+to look at the file. Otherwise (and every STAT_INTERVAL seconds anyway, in
+case an event was missed) the file's inode, size and mtime are compared
+with the last ones seen. The YAML is only parsed when they differ.
+
+A new config replaces the old one as a whole, and only if it parses and has
+every required key. A half written or broken file is reported and ignored
+until it changes again.
+"""
+
+import os
+import threading
+import time
+import yaml
+from v4l2 import v4l2
+from v4l2.device import device_path
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    FileSystemEventHandler = object
+    Observer = None
+
+# Settings that are applied to the running timelapse. Changing anything
+# else starts a new one
+CAMERA_KEYS = ("z_camera_settings",)
+
+REQUIRED_KEYS = (
+    "device",
+    "duration",
+    "interval",
+    "out_dir",
+    "prefix",
+    "resolution",
+    "start_time",
+)
+
+STAT_INTERVAL = 60
+
+
+class ConfigError(Exception):
+    pass
+
+
+def load_config(config_path):
+    with open(config_path, "r") as config_file:
+        config = yaml.safe_load(config_file)
+
+    if not isinstance(config, dict):
+        raise ConfigError("Unable to load config file")
+
+    missing = [key for key in REQUIRED_KEYS if key not in config]
+    if missing:
+        raise ConfigError("Config is missing {}".format(", ".join(missing)))
+
+    cameras = config.get("cameras")
+    if cameras is not None and cameras != "auto":
+        if not isinstance(cameras, list) or not all(
+            isinstance(camera, dict) and "device" in camera for camera in cameras
+        ):
+            raise ConfigError("cameras must be auto or a list with a device each")
+
+    return config
+
+
+def camera_configs(config, discover=v4l2.list_devices):
+    """
+    One config per camera, keyed by device path. The top level settings are
+    the first camera. Each entry in cameras is another one, with the top
+    level settings as defaults, the device name added to the prefix and,
+    unless it sets its own out_dir, a subdirectory of out_dir named after
+    the device, so each camera's photos can make their own timelapse.
+    cameras: auto adds every device v4l2-ctl lists.
+    """
+    base = {key: value for key, value in config.items() if key != "cameras"}
+    base_path = device_path(base["device"])
+    configs = {base_path: base}
+
+    cameras = config.get("cameras") or []
+    if cameras == "auto":
+        try:
+            cameras = [{"device": path} for _, path, _ in discover()]
+        except OSError as e:
+            print("Unable to list devices: {}".format(e))
+            cameras = []
+
+    for camera in cameras:
+        path = device_path(camera["device"])
+        if path == base_path:
+            configs[path] = dict(base, **camera)
+            continue
+        if path in configs:
+            continue
+
+        name = os.path.basename(path)
+        camera_config = dict(base)
+        camera_config["prefix"] = "{}{}_".format(base["prefix"], name)
+        camera_config["out_dir"] = os.path.join(base["out_dir"], name)
+        # Each camera gets only its own camera settings
+        camera_config.pop("z_camera_settings", None)
+        camera_config.update(camera)
+        configs[path] = camera_config
+
+    return configs
+
+
+def changed_keys(old_config, new_config):
+    keys = set(old_config) | set(new_config)
+    return sorted(key for key in keys if old_config.get(key) != new_config.get(key))
+
+
+def camera_only(old_config, new_config):
+    """
+    True if only camera settings differ between the two configs.
+    """
+    return all(key in CAMERA_KEYS for key in changed_keys(old_config, new_config))
+
+
+def file_key(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class ConfigChangeHandler(FileSystemEventHandler):
+    def __init__(self, path, changed):
+        self.path = path
+        self.changed = changed
+
+    def on_any_event(self, event):
+        # Editors and the UI replace the file, so renames count too
+        paths = (event.src_path, getattr(event, "dest_path", ""))
+        if self.path in (os.path.abspath(path) for path in paths if path):
+            self.changed.set()
+
+
+class ConfigWatcher:
+    def __init__(self, config_path):
+        self.path = os.path.abspath(config_path)
+        self.changed = threading.Event()
+        self.last_stat = time.monotonic()
+        self.parses = 0
+
+        # Take the key first, so a change while loading is seen by poll()
+        self.key = file_key(self.path)
+        self.config = self._load()
+
+        self.observer = None
+        if Observer is not None:
+            self.observer = Observer()
+            self.observer.schedule(
+                ConfigChangeHandler(self.path, self.changed),
+                os.path.dirname(self.path),
+            )
+            self.observer.start()
+
+    def _load(self):
+        self.parses += 1
+        return load_config(self.path)
+
+    def poll(self):
+        """
+        Return the new config if the file changed since the last call,
+        otherwise None.
+        """
+        if self.observer is not None:
+            now = time.monotonic()
+            if not self.changed.is_set() and now - self.last_stat < STAT_INTERVAL:
+                return None
+            self.changed.clear()
+            self.last_stat = now
+
+        key = file_key(self.path)
+        if key is None or key == self.key:
+            return None
+        self.key = key
+
+        try:
+            config = self._load()
+        except (OSError, yaml.YAMLError, ConfigError) as e:
+            print("Ignoring config change: {}".format(e))
+            return None
+
+        if config == self.config:
+            return None
+        self.config = config
+        return config
+
+    def close(self):
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+            self.observer = None
@@ -0,0 +1,253 @@
+"""
+Stages a photo goes through after the capture: EXIF stamping, then the
+write to out_dir. Each stage has its own thread and a bounded queue, so a
+slow write (e.g. a busy SD card) doesn't delay the next capture.
+
+Photos are written to a hidden file and renamed into place, which is what
+timelapse_gen waits for. When the persist queue is full, spill_policy
+decides what happens to the next photo:
+
+- block: the capture waits for room (and the schedule's missed_policy
+  applies to the photos it couldn't take).
+- drop_newest: the new photo is dropped.
+- drop_oldest: the oldest queued photo is dropped.
+- spill: the photo is written to spill_dir (ideally a tmpfs) and queued
+  without its data. It is copied to out_dir once the queue catches up.
+"""
+
+import collections
+import os
+import tempfile
+import threading
+import time
+
+from timelapse_metrics import metrics
+from v4l2 import exif
+from v4l2.files import write_atomic
+
+SPILL_POLICIES = ("block", "drop_newest", "drop_oldest", "spill")
+FRAME_QUEUE = 8
+
+
+class Frame:
+    def __init__(self, filename, data, timestamp):
+        self.filename = filename
+        self.data = data
+        self.timestamp = timestamp
+        self.spill_path = None
+        self.queued = None
+
+
+def discard(frame):
+    """
+    Forget a dropped frame, and its spill file if it has one.
+    """
+    if frame.spill_path is not None:
+        try:
+            os.remove(frame.spill_path)
+        except OSError as e:
+            print("Unable to remove {}: {}".format(frame.spill_path, e))
+        frame.spill_path = None
+    frame.data = None
+
+
+class Stage:
+    def __init__(
+        self, name, function, max_depth, policy="block", output=None, spill_dir=None
+    ):
+        if policy not in SPILL_POLICIES:
+            raise ValueError(
+                "Unknown spill policy {} (use {})".format(
+                    policy, ", ".join(SPILL_POLICIES)
+                )
+            )
+        self.name = name
+        self.function = function
+        self.max_depth = max_depth
+        self.policy = policy
+        self.output = output
+        self.spill_dir = spill_dir or tempfile.gettempdir()
+
+        self.condition = threading.Condition()
+        self.frames = collections.deque()
+        self.running = False
+        self.closed = False
+
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.max_seen_depth = 0
+        self.blocked_time = 0
+        self.latencies = collections.deque(maxlen=1000)
+
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def put(self, frame):
+        """
+        Queue frame, applying the spill policy if the queue is full.
+        """
+        dropped = None
+        with self.condition:
+            if self.policy == "block":
+                start_time = time.monotonic()
+                while len(self.frames) >= self.max_depth and not self.closed:
+                    self.condition.wait()
+                self.blocked_time += time.monotonic() - start_time
+            full = len(self.frames) >= self.max_depth
+
+            if full and self.policy == "drop_newest":
+                dropped = frame
+            elif full and self.policy == "drop_oldest":
+                dropped = self.frames.popleft()
+            if dropped is not None:
+                self.dropped += 1
+
+        if dropped is not None:
+            print("{} queue full, dropped {}".format(self.name, dropped.filename))
+            discard(dropped)
+            if dropped is frame:
+                return
+        elif full and self.policy == "spill":
+            self._spill(frame)
+
+        frame.queued = time.monotonic()
+        with self.condition:
+            self.frames.append(frame)
+            self.max_seen_depth = max(self.max_seen_depth, len(self.frames))
+            depth = len(self.frames)
+            self.condition.notify_all()
+        metrics.queue_depth(self.name, depth)
+
+    def _spill(self, frame):
+        spill_path = os.path.join(self.spill_dir, os.path.basename(frame.filename))
+        try:
+            write_atomic(spill_path, frame.data)
+        except OSError as e:
+            # Keep it in memory rather than lose it
+            print("Unable to spill {}: {}".format(frame.filename, e))
+            return
+        metrics.bytes_written("spill", len(frame.data))
+        frame.spill_path = spill_path
+        frame.data = None
+        with self.condition:
+            self.spilled += 1
+
+    def _next_frame(self):
+        with self.condition:
+            while not self.frames:
+                if self.closed:
+                    return None
+                self.condition.wait()
+            self.running = True
+            frame = self.frames.popleft()
+            depth = len(self.frames)
+            self.condition.notify_all()
+        metrics.queue_depth(self.name, depth)
+        return frame
+
+    def _run(self):
+        while True:
+            frame = self._next_frame()
+            if frame is None:
+                return
+
+            # The next stage sets its own queued time
+            queued = frame.queued
+            start_time = time.monotonic()
+            try:
+                result = self.function(frame)
+            except Exception as e:
+                print("{} failed for {}: {!r}".format(self.name, frame.filename, e))
+                result = None
+                with self.condition:
+                    self.failed += 1
+            end_time = time.monotonic()
+            metrics.observe_stage(self.name, end_time - start_time)
+
+            # Hand it on before looking idle, so join() can't miss it
+            if result is not None and self.output is not None:
+                self.output.put(result)
+
+            with self.condition:
+                self.running = False
+                self.completed += 1
+                self.latencies.append(end_time - queued)
+                self.condition.notify_all()
+
+    def join(self):
+        """
+        Wait until every queued frame has been handled.
+        """
+        with self.condition:
+            while self.frames or self.running:
+                self.condition.wait()
+
+    def close(self):
+        """
+        Handle the queued frames and stop the thread.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+
+    def stats(self):
+        """
+        Queue depth, and latency percentiles (seconds, from being queued to
+        done) over the last 1000 frames.
+        """
+        with self.condition:
+            return {
+                "depth": len(self.frames),
+                "max_depth": self.max_seen_depth,
+                "completed": self.completed,
+                "failed": self.failed,
+                "dropped": self.dropped,
+                "spilled": self.spilled,
+                "blocked_time": self.blocked_time,
+                "latency": metrics.percentiles(self.latencies),
+            }
+
+
+def stamp(frame):
+    if frame.timestamp is not None and frame.data is not None:
+        try:
+            frame.data = exif.add_datetime(frame.data, frame.timestamp)
+        except exif.ExifError as e:
+            # An unstamped photo is still better than none
+            print("Unable to stamp {}: {}".format(frame.filename, e))
+    return frame
+
+
+def persist(frame):
+    if frame.spill_path is not None:
+        with open(frame.spill_path, "rb") as spilled:
+            frame.data = spilled.read()
+    write_atomic(frame.filename, frame.data)
+    metrics.bytes_written("photo", len(frame.data))
+    if frame.spill_path is not None:
+        os.remove(frame.spill_path)
+    return None
+
+
+class Pipeline:
+    def __init__(self, max_depth=FRAME_QUEUE, policy="block", spill_dir=None):
+        self.persist = Stage("persist", persist, max_depth, policy, spill_dir=spill_dir)
+        # Stamping is quick, it only backs up when persisting blocks
+        self.stamp = Stage("stamp", stamp, max_depth, output=self.persist)
+
+    def submit(self, filename, data, timestamp=None):
+        self.stamp.put(Frame(filename, data, timestamp))
+
+    def join(self):
+        self.stamp.join()
+        self.persist.join()
+
+    def close(self):
+        self.stamp.close()
+        self.persist.close()
+
+    def stats(self):
+        return {"stamp": self.stamp.stats(), "persist": self.persist.stats()}
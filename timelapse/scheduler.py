@@ -0,0 +1,227 @@
+"""
+Photo schedule on absolute deadlines.
+
+Frame n is due at start_time + n * interval, measured on the monotonic
+clock. Deadlines are computed from the frame number rather than from the
+previous photo, so a slow or late capture never shifts the ones after it
+and no drift builds up.
+
+A deadline is missed when the scheduler wakes up after a later deadline is
+also due (e.g. the system was busy or suspended), or when captures are
+still queued. What happens then depends on the policy:
+
+- skip: only the newest due frame is taken, and only if no capture is
+  queued. Missed frames are dropped.
+- catch_up: every missed frame is queued and taken back to back until the
+  schedule is caught up.
+- burst: like catch_up, but at most max_burst captures are queued. The
+  oldest missed frames are dropped.
+"""
+
+import collections
+import math
+import threading
+import time
+
+from timelapse_metrics import metrics
+
+POLICIES = ("skip", "catch_up", "burst")
+MAX_BURST = 3
+
+
+class Scheduler:
+    def __init__(
+        self,
+        start_time,
+        interval,
+        policy="skip",
+        max_burst=MAX_BURST,
+        clock=time.monotonic,
+        wall_clock=time.time,
+    ):
+        if policy not in POLICIES:
+            raise ValueError(
+                "Unknown missed deadline policy {} (use {})".format(
+                    policy, ", ".join(POLICIES)
+                )
+            )
+        if interval <= 0:
+            raise ValueError("Interval must be positive")
+
+        self.interval = interval
+        self.policy = policy
+        self.max_burst = max_burst
+
+        # start_time is wall clock, deadlines are monotonic
+        now = clock()
+        self.anchor = now + (start_time - wall_clock())
+        # Frames that were due before the scheduler existed aren't missed
+        self.next_frame = max(0, math.ceil((now - self.anchor) / interval))
+
+        self.taken = 0
+        self.missed = 0
+        self.last_lateness = 0
+        self.max_lateness = 0
+        self.lateness = collections.deque(maxlen=1000)
+
+    def deadline(self, frame):
+        return self.anchor + frame * self.interval
+
+    def next_deadline(self):
+        return self.deadline(self.next_frame)
+
+    def due(self, now, backlog=0):
+        """
+        Frames to capture now, after applying the missed deadline policy.
+        backlog is the number of captures still queued or running.
+        """
+        if now < self.next_deadline():
+            return range(0)
+
+        # Rounding can put now a hair before the deadline it just passed
+        last = max(self.next_frame, math.floor((now - self.anchor) / self.interval))
+        frames = range(self.next_frame, last + 1)
+        self.next_frame = last + 1
+
+        if self.policy == "skip":
+            room = 0 if backlog else 1
+        elif self.policy == "burst":
+            room = max(0, self.max_burst - backlog)
+        else:
+            room = len(frames)
+
+        keep = frames[max(0, len(frames) - room) :]
+        self.missed += len(frames) - len(keep)
+        return keep
+
+    def record(self, frame, start_time):
+        """
+        Note that the capture of frame started at start_time (monotonic).
+        """
+        lateness = start_time - self.deadline(frame)
+        self.taken += 1
+        self.last_lateness = lateness
+        self.max_lateness = max(self.max_lateness, lateness)
+        self.lateness.append(lateness)
+
+    def stats(self):
+        """
+        Frames taken and missed, and how late captures started (seconds)
+        over the last 1000 frames.
+        """
+        return {
+            "taken": self.taken,
+            "missed": self.missed,
+            "last_lateness": self.last_lateness,
+            "max_lateness": self.max_lateness,
+            "lateness": metrics.percentiles(self.lateness),
+        }
+
+
+class CaptureWorker:
+    """
+    Pool of threads that runs captures, and anything else that touches a
+    camera. Jobs for one device run one at a time, in order. Different
+    devices run in parallel, so a slow camera doesn't hold up the others.
+    """
+
+    def __init__(self, workers=1):
+        self.condition = threading.Condition()
+        # device -> jobs waiting for that device, in order
+        self.queues = {}
+        # devices that have jobs waiting and none running
+        self.ready = collections.deque()
+        self.running = set()
+
+        self.depth = 0
+        self.max_depth = 0
+        self.latencies = collections.deque(maxlen=1000)
+
+        self.threads = []
+        self.add_workers(workers)
+
+    def add_workers(self, workers):
+        """
+        Start threads until there are at least workers of them.
+        """
+        while len(self.threads) < workers:
+            thread = threading.Thread(
+                target=self._run,
+                name="capture-{}".format(len(self.threads)),
+                daemon=True,
+            )
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, key, function, *args):
+        with self.condition:
+            queue = self.queues.setdefault(key, collections.deque())
+            queue.append((function, args, time.monotonic()))
+            self.depth += 1
+            self.max_depth = max(self.max_depth, self.depth)
+            if len(queue) == 1 and key not in self.running:
+                self.ready.append(key)
+                self.condition.notify_all()
+
+    def backlog(self, key):
+        """
+        Jobs queued or running for key.
+        """
+        with self.condition:
+            return len(self.queues.get(key, ())) + (key in self.running)
+
+    def cancel(self, key):
+        """
+        Drop the jobs queued for key and wait for the running one.
+        """
+        with self.condition:
+            if key in self.ready:
+                self.ready.remove(key)
+            queue = self.queues.get(key)
+            if queue is not None:
+                self.depth -= len(queue)
+                queue.clear()
+                if key not in self.running:
+                    del self.queues[key]
+            while key in self.running:
+                self.condition.wait()
+
+    def _next_job(self):
+        with self.condition:
+            while not self.ready:
+                self.condition.wait()
+            key = self.ready.popleft()
+            self.running.add(key)
+            return key, self.queues[key].popleft()
+
+    def _run(self):
+        while True:
+            key, (function, args, submitted) = self._next_job()
+            try:
+                function(*args)
+            except Exception as e:
+                print("Capture job failed: {!r}".format(e))
+            end_time = time.monotonic()
+
+            with self.condition:
+                self.running.discard(key)
+                if self.queues[key]:
+                    self.ready.append(key)
+                else:
+                    del self.queues[key]
+                self.depth -= 1
+                self.latencies.append(end_time - submitted)
+                self.condition.notify_all()
+
+    def stats(self):
+        """
+        Queue depth, and latency percentiles (seconds, from being submitted
+        to done) over the last 1000 jobs.
+        """
+        with self.condition:
+            return {
+                "depth": self.depth,
+                "max_depth": self.max_depth,
+                "running": len(self.running),
+                "latency": metrics.percentiles(self.latencies),
+            }
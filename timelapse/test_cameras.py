@@ -0,0 +1,142 @@
+"""
+Several fake cameras driven by one Timelapse process.
+
+    python -m pytest test_cameras.py
+"""
+
+import os
+import tempfile
+import time
+import unittest
+
+import yaml
+
+import bench_cameras
+import config_watcher
+import timelapse
+from v4l2 import v4l2
+from v4l2.fake import FakeDevice
+
+
+def run_daemon(config_path, duration):
+    daemon = timelapse.Timelapse(
+        config_path,
+        capture_options={"transport": FakeDevice, "warmup": 0},
+        control_backend=lambda path: v4l2.IoctlBackend(path, transport=FakeDevice),
+    )
+    # Timelapse.run() without the endless loop
+    end_time = time.monotonic() + duration
+    while time.monotonic() < end_time:
+        daemon.config_check()
+        timeout = 1
+        for camera in daemon.cameras.values():
+            timeout = min(timeout, camera.tick())
+        time.sleep(max(0, min(timeout, end_time - time.monotonic())))
+
+    for camera in daemon.cameras.values():
+        camera.stop()
+    daemon.pipeline.close()
+    daemon.config_watcher.close()
+    return daemon
+
+
+class CameraConfigsTest(unittest.TestCase):
+    def setUp(self):
+        self.config = {
+            "device": "/dev/video0",
+            "out_dir": "/photos",
+            "prefix": "test_",
+            "z_camera_settings": {"focus_auto": 0},
+        }
+
+    def test_cameras_get_their_own_out_dir(self):
+        self.config["cameras"] = [{"device": "/dev/video2"}, {"device": 4}]
+        configs = config_watcher.camera_configs(self.config)
+
+        self.assertEqual(configs["/dev/video0"]["out_dir"], "/photos")
+        self.assertEqual(configs["/dev/video2"]["out_dir"], "/photos/video2")
+        self.assertEqual(configs["/dev/video4"]["out_dir"], "/photos/video4")
+        self.assertEqual(configs["/dev/video2"]["prefix"], "test_video2_")
+        self.assertNotIn("z_camera_settings", configs["/dev/video2"])
+
+    def test_entry_out_dir_wins(self):
+        self.config["cameras"] = [{"device": "/dev/video2", "out_dir": "/other"}]
+        configs = config_watcher.camera_configs(self.config)
+        self.assertEqual(configs["/dev/video2"]["out_dir"], "/other")
+
+    def test_auto_discovered_cameras_are_separate(self):
+        self.config["cameras"] = "auto"
+        configs = config_watcher.camera_configs(
+            self.config,
+            discover=lambda: [
+                (0, "/dev/video0", "main"),
+                (2, "/dev/video2", "usb"),
+                (4, "/dev/video4", "usb"),
+            ],
+        )
+        out_dirs = [config["out_dir"] for config in configs.values()]
+        self.assertEqual(len(out_dirs), 3)
+        self.assertEqual(len(set(out_dirs)), 3)
+
+
+class FakeCamerasTest(unittest.TestCase):
+    def test_photos_stay_in_each_cameras_dir(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            out_dir = os.path.join(tmp_dir, "photos")
+            config = {
+                "device": "/dev/video0",
+                "duration": None,
+                "interval": 0.1,
+                "out_dir": out_dir,
+                "prefix": "test_",
+                "resolution": "640x480",
+                "start_time": None,
+                "stats_interval": 1e9,
+                "cameras": [{"device": "/dev/video2"}, {"device": "/dev/video4"}],
+            }
+            config_path = os.path.join(tmp_dir, "config.yml")
+            with open(config_path, "w") as config_file:
+                yaml.dump(config, config_file)
+
+            daemon = run_daemon(config_path, 1.0)
+
+            self.assertEqual(len(daemon.cameras), 3)
+            for device, prefix, directory in [
+                ("/dev/video0", "test_2", out_dir),
+                ("/dev/video2", "test_video2_", os.path.join(out_dir, "video2")),
+                ("/dev/video4", "test_video4_", os.path.join(out_dir, "video4")),
+            ]:
+                photos = [
+                    name for name in os.listdir(directory) if name.endswith(".jpg")
+                ]
+                self.assertGreater(len(photos), 0, device)
+                for photo in photos:
+                    self.assertTrue(photo.startswith(prefix), photo)
+
+
+class BenchCamerasTest(unittest.TestCase):
+    def run_cameras(self, count, interval=0.1, duration=2.0):
+        cpu_time, taken, missed, lateness = bench_cameras.run(count, interval, duration)
+
+        # Each camera takes one photo per interval, none are missed
+        expected = count * duration / interval
+        self.assertGreaterEqual(taken, expected - count)
+        self.assertLessEqual(taken, expected + count)
+        self.assertEqual(missed, 0)
+        return cpu_time, lateness[len(lateness) * 99 // 100]
+
+    def test_cameras_scale_sub_linearly(self):
+        count = 8
+        single_cpu, single_p99 = self.run_cameras(1)
+        cpu_time, p99 = self.run_cameras(count)
+
+        # Cheaper than one daemon per camera (about half of it here)
+        self.assertLess(cpu_time, 0.8 * count * single_cpu)
+        # Sharing the process doesn't push the captures back. Both are well
+        # under a millisecond, so one hiccup is allowed for
+        self.assertLess(p99, 4 * single_p99 + 0.002)
+        self.assertLess(p99, 0.1 / 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
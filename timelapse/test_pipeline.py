@@ -0,0 +1,84 @@
+"""
+Spill policies of a pipeline stage with a stalled writer.
+
+    python -m pytest test_pipeline.py
+"""
+
+import os
+import tempfile
+import threading
+import unittest
+
+import pipeline
+
+
+class StageTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+        self.done = []
+
+    def stage(self, policy, max_depth=2):
+        def write(frame):
+            self.release.wait()
+            self.done.append(frame.filename)
+
+        stage = pipeline.Stage(
+            "persist", write, max_depth, policy, spill_dir=self.tmp_dir.name
+        )
+        self.addCleanup(stage.close)
+        return stage
+
+    def put(self, stage, name):
+        stage.put(pipeline.Frame(name, b"photo", None))
+
+    def spill_files(self):
+        return sorted(os.listdir(self.tmp_dir.name))
+
+    def test_drop_oldest_removes_its_spill_file(self):
+        stage = self.stage("drop_oldest")
+        self.put(stage, "a.jpg")
+        # a.jpg is being written, the next two fill the queue
+        with stage.condition:
+            while not stage.running:
+                stage.condition.wait()
+        spilled = pipeline.Frame("b.jpg", b"photo", None)
+        stage._spill(spilled)
+        stage.put(spilled)
+        self.put(stage, "c.jpg")
+        self.assertEqual(self.spill_files(), ["b.jpg"])
+
+        self.put(stage, "d.jpg")
+        self.assertEqual(stage.dropped, 1)
+        self.assertEqual(self.spill_files(), [])
+
+        self.release.set()
+        stage.join()
+        self.assertEqual(self.done, ["a.jpg", "c.jpg", "d.jpg"])
+
+    def test_spilled_photos_are_written_and_removed(self):
+        stage = pipeline.Stage(
+            "persist",
+            pipeline.persist,
+            1,
+            "spill",
+            spill_dir=self.tmp_dir.name,
+        )
+        self.addCleanup(stage.close)
+        out_dir = os.path.join(self.tmp_dir.name, "photos")
+        os.mkdir(out_dir)
+        names = [os.path.join(out_dir, "{}.jpg".format(index)) for index in range(20)]
+        for name in names:
+            stage.put(pipeline.Frame(name, name.encode("utf-8"), None))
+        stage.join()
+
+        self.assertEqual(self.spill_files(), ["photos"])
+        for name in names:
+            with open(name, "rb") as photo:
+                self.assertEqual(photo.read(), name.encode("utf-8"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+"""
+Capture schedule on a fake clock.
+
+    python -m pytest test_scheduler.py
+"""
+
+import random
+import unittest
+
+import scheduler
+from bench_scheduler import SimulatedClock, run_scheduler
+
+
+class SchedulerTest(unittest.TestCase):
+    def schedule(self, policy, start_time=0.0, interval=1.0, **kwargs):
+        self.clock = SimulatedClock()
+        return scheduler.Scheduler(
+            start_time,
+            interval,
+            policy,
+            clock=self.clock,
+            wall_clock=self.clock,
+            **kwargs
+        )
+
+    def test_nothing_due_before_the_deadline(self):
+        schedule = self.schedule("skip", start_time=5.0)
+        self.assertEqual(list(schedule.due(4.999)), [])
+        self.assertEqual(list(schedule.due(5.0)), [0])
+        self.assertEqual(list(schedule.due(5.5)), [])
+        self.assertEqual(list(schedule.due(6.0)), [1])
+
+    def test_frames_before_the_start_are_not_missed(self):
+        self.clock = SimulatedClock()
+        self.clock.now = 100.25
+        schedule = scheduler.Scheduler(
+            0.0, 1.0, "skip", clock=self.clock, wall_clock=self.clock
+        )
+        self.assertEqual(schedule.next_frame, 101)
+        self.assertEqual(list(schedule.due(101.0)), [101])
+        self.assertEqual(schedule.missed, 0)
+
+    def test_skip_takes_the_newest_frame(self):
+        schedule = self.schedule("skip")
+        self.assertEqual(list(schedule.due(0.0)), [0])
+        # Woken up 4.5 intervals late
+        self.assertEqual(list(schedule.due(5.5)), [5])
+        self.assertEqual(schedule.missed, 4)
+
+    def test_skip_waits_for_the_backlog(self):
+        schedule = self.schedule("skip")
+        self.assertEqual(list(schedule.due(0.0, backlog=1)), [])
+        self.assertEqual(list(schedule.due(1.0, backlog=0)), [1])
+        self.assertEqual(schedule.missed, 1)
+
+    def test_catch_up_takes_every_frame(self):
+        schedule = self.schedule("catch_up")
+        schedule.due(0.0)
+        self.assertEqual(list(schedule.due(5.5, backlog=3)), [1, 2, 3, 4, 5])
+        self.assertEqual(schedule.missed, 0)
+
+    def test_burst_keeps_the_newest_frames(self):
+        schedule = self.schedule("burst", max_burst=3)
+        schedule.due(0.0)
+        self.assertEqual(list(schedule.due(5.5, backlog=1)), [4, 5])
+        self.assertEqual(schedule.missed, 3)
+        self.assertEqual(list(schedule.due(6.0, backlog=3)), [])
+        self.assertEqual(schedule.missed, 4)
+
+    def test_record_measures_lateness(self):
+        schedule = self.schedule("skip")
+        for frame in schedule.due(0.0):
+            schedule.record(frame, 0.25)
+        for frame in schedule.due(1.1):
+            schedule.record(frame, 1.1)
+        stats = schedule.stats()
+        self.assertEqual(stats["taken"], 2)
+        self.assertAlmostEqual(stats["max_lateness"], 0.25)
+        self.assertAlmostEqual(stats["last_lateness"], 0.1)
+
+
+class SimulatedRunTest(unittest.TestCase):
+    def setUp(self):
+        random.seed(0)
+
+    def test_no_drift_over_a_long_run(self):
+        # A week of 10s frames with jittery captures and wake ups
+        frames = 60480
+        stats, drift = run_scheduler(frames, 10.0, 0.5, 0, "skip")
+        self.assertEqual(stats["taken"], frames)
+        self.assertEqual(stats["missed"], 0)
+        self.assertLess(abs(drift), 0.01)
+        self.assertLess(stats["max_lateness"], 0.01)
+
+    def test_stalls_only_cost_the_frames_they_cover(self):
+        frames = 20000
+        missed = {}
+        for policy in scheduler.POLICIES:
+            random.seed(0)
+            stats, drift = run_scheduler(frames, 1.0, 0.3, 500, policy)
+            self.assertEqual(stats["taken"] + stats["missed"], frames, policy)
+            # Stalls delay the captures after them, never the schedule
+            self.assertLess(abs(drift), 0.01, policy)
+            missed[policy] = stats["missed"]
+
+        # About 40 stalls of 6s each
+        self.assertEqual(missed["catch_up"], 0)
+        self.assertGreater(missed["burst"], 0)
+        self.assertLess(missed["burst"], missed["skip"])
+        self.assertLess(missed["skip"], 40 * 6)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,27 +3,53 @@
 import argparse
 import math
 import os
-import subprocess
+import tempfile
 import time
-import yaml
 from datetime import datetime
+from timelapse_metrics import metrics
+from v4l2 import capture
 from v4l2 import v4l2
 
-
-class Timelapse:
-    def __init__(self, config_path):
-        self.config_path = config_path
-        self.config = self.load_config(config_path)
+import config_watcher
+import pipeline
+import scheduler
+
+
+class Camera:
+    """
+    Schedule, capture session and controls of one device. Everything that
+    touches the device runs on the shared capture worker, keyed by device,
+    so settings never leak from one camera to another.
+    """
+
+    def __init__(
+        self, config, worker, pipeline, capture_options=None, control_backend=None
+    ):
+        self.config = config
+        self.device = config["device"]
+        self.worker = worker
+        self.pipeline = pipeline
+        self.capture_options = capture_options or {}
+        self.control_backend = control_backend
         self.running = False
         self.start_time = None
-        self.end_time = None
+        self.stop_time = None
+        self.camera = None
+        self.camera_controls = None
+        self.device_lock = None
+        self.scheduler = None
 
         self.start_timelapse()
 
     def start_timelapse(self):
-        self.last_photo_time = 0
         self.index = 0
         self.running = False
+        # Photos queued for the old schedule are dropped
+        self.worker.cancel(self.device)
+        self.print_schedule_stats()
+        self.close_camera()
+        self.camera_controls = v4l2.ControlCache(self.device, self.control_backend)
+        self.device_lock = capture.DeviceLock(self.device)
 
         if self.config["start_time"] is not None:
             self.start_time = self.config["start_time"]
@@ -35,6 +61,13 @@ class Timelapse:
         else:
             self.stop_time = 1e99
 
+        self.scheduler = scheduler.Scheduler(
+            self.start_time,
+            self.config["interval"],
+            self.config.get("missed_policy", "skip"),
+            self.config.get("max_burst", scheduler.MAX_BURST),
+        )
+
         # Use start time of timelapse as a tag
         self.photo_prefix = "{}{}_".format(
             self.config["prefix"], datetime.now().replace(microsecond=0).isoformat()
@@ -44,28 +77,42 @@ class Timelapse:
             print("{} not found. Creating".format(self.config["out_dir"]))
             os.makedirs(self.config["out_dir"], exist_ok=True)
 
-        self.set_camera_settings(verbose=True)
+        self.worker.submit(self.device, self.set_camera_settings, True)
         self.print_summary()
 
+    def open_camera(self, device, resolution):
+        if self.camera is None:
+            self.camera = capture.open_capture(
+                device,
+                resolution,
+                self.config.get("capture_backend", "v4l2"),
+                **self.capture_options
+            )
+            print("Using {} capture backend for {}".format(self.camera.name, device))
+            # Opening sets the manual focus, exposure and white balance
+            self.camera_controls.invalidate()
+        return self.camera
+
+    def close_camera(self):
+        if self.camera is not None:
+            self.camera.close()
+            self.camera = None
+
+        # Let the UI preview have the device until the next photo
+        if self.device_lock is not None:
+            self.device_lock.release()
+
+        # Controls may be reset when the device is opened again
+        if self.camera_controls is not None:
+            self.camera_controls.invalidate()
+
     def set_camera_settings(self, verbose=False):
         if "z_camera_settings" not in self.config:
             return
-        cam_ctrl = v4l2.V4L2(self.config["device"])
-        for setting, value in self.config["z_camera_settings"].items():
-            if setting in cam_ctrl.controls:
-                if verbose:
-                    print("Setting {} to {}".format(setting, value))
-                try:
-                    cam_ctrl.controls[setting].set(int(value))
-                except ValueError:
-                    if verbose:
-                        print("Unable to set {}".format(setting))
-            else:
-                if verbose:
-                    print("Setting {} not available.".format("setting"))
+        self.camera_controls.apply(self.config["z_camera_settings"], verbose)
 
     def print_summary(self):
-        print("---Timelapse Config---")
+        print("---Timelapse Config ({})---".format(self.device))
         print("Interval: {}".format(self.config["interval"]))
         print(
             "Start time: {}".format(
@@ -90,114 +137,212 @@ class Timelapse:
         else:
             print("Timelapse will run indefinitely.")
 
-    def load_config(self, config_path):
-        with open(config_path, "r") as config_file:
-            config = yaml.safe_load(config_file)
-
-        if config is None:
-            raise Exception("Unable to load config file")
-
-        return config
-
-    def time_for_photo(self):
-        if not self.running:
-            return False
-
-        if time.time() >= (self.last_photo_time + self.config["interval"]):
-            self.last_photo_time = time.time()
-            return True
-        else:
-            return False
+    def print_schedule_stats(self):
+        if self.scheduler is not None and self.scheduler.taken:
+            print("{} schedule".format(self.device), self.scheduler.stats())
 
     def take_photo(self, device="/dev/video0", resolution="1920x1080", filename=None):
 
         if filename is None:
             filename = tempfile.mktemp(".jpg")
 
-        # Make sure camera settings are set from config before every photo
-        self.set_camera_settings()
-
-        result = subprocess.run(
-            [
-                "fswebcam",
-                "--no-banner",
-                "-sFocus, Auto=False",
-                "-sExposure, Auto=Manual Mode",
-                "-sWhite Balance Temperature, Auto=False",
-                "-S5",
-                "-d",
-                "v4l2:{}".format(device),
-                "-r",
-                resolution,
-                filename,
-            ],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
-
-        # fswebcam seems to use stderr instead of stdout
-        rval = result.stderr.decode("utf-8")
-        if "Error" in rval and "Error querying menu" not in rval:
-            print(rval)
+        # The UI preview hands the device over within a frame or two
+        if not self.device_lock.acquire(timeout=5):
+            print("{} is busy".format(device))
             return None
 
-        isodate = datetime.now().isoformat()
-
-        result = subprocess.run(
-            [
-                "exiftool",
-                "-overwrite_original",
-                "-DateTimeOriginal='{}'".format(isodate),
-                filename,
-            ],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
+        camera = self.open_camera(device, resolution)
 
+        # Make sure camera settings are set from config before every photo
+        with metrics.timer("controls"):
+            self.set_camera_settings()
+
+        try:
+            timestamp = datetime.now()
+            with metrics.timer("capture"):
+                data = camera.capture()
+        except (OSError, capture.CaptureError) as e:
+            metrics.counter("capture_failures_total", "Failed captures").inc(
+                device=device
+            )
+            print("Capture failed: {}".format(e))
+            # Reopen the device on the next photo
+            self.close_camera()
+            return None
+
+        # Stamped and written to out_dir by the pipeline's threads
+        self.pipeline.submit(filename, data, timestamp)
         return filename
 
-    def config_check(self):
-        # TODO - setup watchdog to watch config file for changes
-        new_config = self.load_config(args.config)
-        if new_config != self.config:
-            print("Config changed. Starting new timelapse with new settings.")
-            self.config = new_config
+    def update_config(self, new_config):
+        if new_config == self.config:
+            return
+
+        old_config = self.config
+        self.config = new_config
+        if config_watcher.camera_only(old_config, new_config):
+            print(
+                "Camera settings for {} changed. Applying them to the running "
+                "timelapse.".format(self.device)
+            )
+            self.worker.submit(self.device, self.set_camera_settings, True)
+        else:
+            print(
+                "Config for {} changed ({}). Starting new timelapse with new "
+                "settings.".format(
+                    self.device,
+                    ", ".join(config_watcher.changed_keys(old_config, new_config)),
+                )
+            )
             self.start_timelapse()
 
+    def stop(self):
+        self.running = False
+        self.worker.cancel(self.device)
+        self.close_camera()
+        self.print_schedule_stats()
+
     def run_check(self):
 
         if self.running:
             if time.time() > self.stop_time:
-                print("Stopping timelapse.")
+                print("Stopping timelapse on {}.".format(self.device))
                 self.running = False
+                self.worker.submit(self.device, self.close_camera)
+                self.worker.submit(self.device, self.print_schedule_stats)
         else:
             if self.start_time < time.time() < self.stop_time:
-                print("Starting timelapse.")
+                print("Starting timelapse on {}.".format(self.device))
                 self.running = True
 
-    def run(self):
-        while True:
+    def capture(self, frame, filename):
+        """
+        Take the photo for frame. Runs on the capture worker.
+        """
+        self.scheduler.record(frame, time.monotonic())
+        res = self.take_photo(self.device, self.config["resolution"], filename)
+        if res == filename:
+            print(
+                "Captured {} ({} settings written, {} unchanged)".format(
+                    filename,
+                    self.camera_controls.last_writes,
+                    self.camera_controls.last_skipped,
+                )
+            )
+        else:
+            print("Error taking photo on {}".format(self.device))
 
-            self.config_check()
-            self.run_check()
+    def tick(self):
+        """
+        Queue the photos that are due. Returns the seconds until the next
+        one.
+        """
+        self.run_check()
 
-            if self.time_for_photo():
+        if self.running:
+            backlog = self.worker.backlog(self.device)
+            for frame in self.scheduler.due(time.monotonic(), backlog):
                 filename = os.path.join(
                     self.config["out_dir"],
                     "{}{:06d}.jpg".format(self.photo_prefix, self.index),
                 )
+                self.worker.submit(self.device, self.capture, frame, filename)
+                self.index += 1
+            metrics.gauge("capture_backlog", "Captures waiting, per device").set(
+                self.worker.backlog(self.device), device=self.device
+            )
+
+        if (
+            self.worker.backlog(self.device) == 0
+            and self.device_lock.is_held()
+            and self.device_lock.requested()
+        ):
+            self.worker.submit(self.device, self.close_camera)
+
+        if time.time() >= self.stop_time:
+            return math.inf
+        return self.scheduler.next_deadline() - time.monotonic()
+
+
+class Timelapse:
+    """
+    Drives every camera in the config from one loop, with one capture
+    worker pool and one stamp/persist pipeline for all of them.
+    """
+
+    def __init__(self, config_path, capture_options=None, control_backend=None):
+        self.config_path = config_path
+        self.config_watcher = config_watcher.ConfigWatcher(config_path)
+        self.config = self.config_watcher.config
+        self.capture_options = capture_options
+        self.control_backend = control_backend
+        self.worker = scheduler.CaptureWorker()
+        self.pipeline = pipeline.Pipeline(
+            self.config.get("frame_queue", pipeline.FRAME_QUEUE),
+            self.config.get("spill_policy", "block"),
+            self.config.get("spill_dir"),
+        )
+        self.cameras = {}
+        self.last_stats = time.monotonic()
 
-                res = self.take_photo(
-                    self.config["device"], self.config["resolution"], filename
+        self.update_cameras(self.config)
+
+    def update_cameras(self, config):
+        configs = config_watcher.camera_configs(config)
+
+        for device in list(self.cameras):
+            if device not in configs:
+                print("{} removed from the config. Stopping it.".format(device))
+                self.cameras.pop(device).stop()
+
+        for device, camera_config in configs.items():
+            if device in self.cameras:
+                self.cameras[device].update_config(camera_config)
+            else:
+                self.cameras[device] = Camera(
+                    camera_config,
+                    self.worker,
+                    self.pipeline,
+                    self.capture_options,
+                    self.control_backend,
                 )
-                if res == filename:
-                    print("Saving photo to ", filename)
-                else:
-                    print("Error taking photo")
 
-                self.index += 1
+        # Captures mostly wait on the devices, so by default every camera
+        # gets a thread
+        self.worker.add_workers(config.get("capture_workers", len(self.cameras)))
+
+    def config_check(self):
+        new_config = self.config_watcher.poll()
+        if new_config is None:
+            return
+
+        self.config = new_config
+        self.update_cameras(new_config)
 
-            time.sleep(1)
+    def print_stats(self):
+        for camera in self.cameras.values():
+            camera.print_schedule_stats()
+        print("capture queue", self.worker.stats())
+        for name, stats in self.pipeline.stats().items():
+            print("{} queue".format(name), stats)
+
+    def run(self):
+        stats_interval = self.config.get("stats_interval", 60)
+        while True:
+
+            self.config_check()
+
+            # Wake up for the next photo, and at least once a second to check
+            # the config
+            timeout = 1
+            for camera in self.cameras.values():
+                timeout = min(timeout, camera.tick())
+
+            if time.monotonic() - self.last_stats >= stats_interval:
+                self.print_stats()
+                self.last_stats = time.monotonic()
+
+            time.sleep(max(0, timeout))
 
 
 if __name__ == "__main__":
@@ -209,5 +354,11 @@ if __name__ == "__main__":
         raise Exception("Config file not found.")
 
     timelapse = Timelapse(args.config)
-
-    timelapse.run()
+    metrics.start(timelapse.config)
+
+    try:
+        timelapse.run()
+    finally:
+        # Write out the photos still in the pipeline
+        timelapse.pipeline.close()
+        timelapse.print_stats()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+Time to add a one second chunk to the main video as it grows, appending
+fragments compared to re-concatenating the whole file with ffmpeg.
+
+    ./bench_append.py --chunks 60
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+import fmp4
+from timelapse_gen import concat_videos, fragment_options
+
+
+def make_chunk(config, filename, index):
+    subprocess.run(
+        [
+            "ffmpeg",
+            "-y",
+            "-f",
+            "lavfi",
+            "-i",
+            "testsrc=size={}:rate={}:duration=1:decimals={}".format(
+                config["resolution"], config["fps"], index % 3
+            ),
+            "-c:v",
+            "libx264",
+            "-pix_fmt",
+            "yuv420p",
+        ]
+        + fragment_options(config)
+        + [filename],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        check=True,
+    )
+
+
+def append_fragments(config, main_video, chunk):
+    fmp4.FragmentedVideo(main_video).append(chunk)
+
+
+def append_concat(config, main_video, chunk):
+    if not os.path.exists(main_video):
+        shutil.copy(chunk, main_video)
+        return
+    outfile = main_video + ".concat.mp4"
+    concat_videos(config, [main_video, chunk], outfile)
+    os.replace(outfile, main_video)
+
+
+def bench(name, config, chunks, out_dir, append):
+    main_video = os.path.join(out_dir, "{}.mp4".format(name))
+    times = []
+    for chunk in chunks:
+        start = time.monotonic()
+        append(config, main_video, chunk)
+        times.append(time.monotonic() - start)
+
+    for seconds in sorted({1, len(times) // 2, len(times)}):
+        print(
+            "{:10s} {:6d}s of video {:8.1f}ms/append".format(
+                name, seconds, times[seconds - 1] * 1000
+            )
+        )
+    print("{:10s} {:6.2f}s total".format(name, sum(times)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunks", type=int, default=30)
+    parser.add_argument("--resolution", default="640x480")
+    parser.add_argument("--fps", type=int, default=24)
+    args = parser.parse_args()
+
+    out_dir = tempfile.mkdtemp()
+    config = {
+        "name": "bench",
+        "fps": args.fps,
+        "resolution": args.resolution,
+        "out_tmp_dir": out_dir,
+    }
+    try:
+        chunks = []
+        for index in range(args.chunks):
+            chunk = os.path.join(out_dir, "chunk_{:04d}.mp4".format(index))
+            make_chunk(config, chunk, index)
+            chunks.append(chunk)
+
+        bench("fragments", config, chunks, out_dir, append_fragments)
+        bench("concat", config, chunks, out_dir, append_concat)
+    finally:
+        shutil.rmtree(out_dir)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""
+CPU time (timelapse_gen and its ffmpeg processes) of making a timelapse at
+1x, 10x and 100x: one video only, the speeds cascade with and without
+blending, and three separate timelapses that each resize and encode every
+photo, which is what it took before speeds.
+
+    ./bench_cascade.py --photos 600 --resolution 852x480
+"""
+
+import argparse
+import multiprocessing
+import os
+import resource
+import shutil
+import subprocess
+import tempfile
+
+from PIL import Image
+
+import timelapse_gen
+
+SPEEDS = [10, 100]
+
+
+def make_photo(path, index, size):
+    Image.merge(
+        "RGB",
+        (
+            Image.linear_gradient("L")
+            .resize(size)
+            .point(lambda value: (value + index) % 256),
+            Image.effect_noise(size, 24),
+            Image.linear_gradient("L").resize(size).transpose(0),
+        ),
+    ).save(path)
+
+
+def frame_count(video):
+    result = subprocess.run(
+        ["ffmpeg", "-i", video, "-f", "null", "-"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    frames = result.stderr.decode("utf-8").split("frame=")[-1].split()[0]
+    return int(frames)
+
+
+def timelapse(base_dir, src_dir, name, resolution, encoder, **options):
+    return dict(
+        {
+            "name": name,
+            "src_dir": src_dir,
+            "out_dir": os.path.join(base_dir, "videos"),
+            "out_tmp_dir": os.path.join(base_dir, "tmp"),
+            "fps": 24,
+            "resolution": resolution,
+            "encoder": encoder,
+            "previews": False,
+        },
+        **options
+    )
+
+
+def cpu_time():
+    return sum(
+        usage.ru_utime + usage.ru_stime
+        for usage in (
+            resource.getrusage(resource.RUSAGE_SELF),
+            resource.getrusage(resource.RUSAGE_CHILDREN),
+        )
+    )
+
+
+def run(config, results):
+    # Runs in its own process so only its own ffmpeg processes are counted
+    start = cpu_time()
+    queues, sources = timelapse_gen.start_pipeline(config)
+    for source in sources:
+        source.catch_up(full=True)
+    timelapse_gen.stop_pipeline(queues, sources)
+    results.put(cpu_time() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--photos", type=int, default=600)
+    parser.add_argument("--source-resolution", default="1920x1080")
+    parser.add_argument("--resolution", default="852x480")
+    parser.add_argument("--encoder", default="stream")
+    args = parser.parse_args()
+
+    base_dir = tempfile.mkdtemp()
+    try:
+        src_dir = os.path.join(base_dir, "photos")
+        os.makedirs(src_dir)
+        size = tuple(int(value) for value in args.source_resolution.split("x"))
+        for index in range(args.photos):
+            make_photo(os.path.join(src_dir, "{:06d}.jpg".format(index)), index, size)
+
+        def options(name, **extra):
+            return timelapse(
+                base_dir, src_dir, name, args.resolution, args.encoder, **extra
+            )
+
+        runs = [
+            ("single", [options("single")]),
+            ("speeds", [options("speeds", speeds=SPEEDS)]),
+            ("blend", [options("blend", speeds=SPEEDS, speed_blend=True)]),
+            (
+                "separate",
+                [options("separate")]
+                + [options("separate_x{}".format(speed)) for speed in SPEEDS],
+            ),
+        ]
+
+        print(
+            "{} photos {} -> {}, {} encoder".format(
+                args.photos, args.source_resolution, args.resolution, args.encoder
+            )
+        )
+        single = None
+        for name, timelapses in runs:
+            results = multiprocessing.Queue()
+            process = multiprocessing.Process(
+                target=run, args=({"timelapses": timelapses}, results)
+            )
+            process.start()
+            cpu = results.get()
+            process.join()
+            if single is None:
+                single = cpu
+
+            videos = [timelapse_gen.main_video_path(timelapses[0])]
+            if len(timelapses) == 1:
+                videos += [
+                    timelapse_gen.main_video_path(
+                        timelapse_gen.level_config(timelapses[0], speed)
+                    )
+                    for speed in timelapses[0].get("speeds", [])
+                ]
+            print(
+                "{:9s} {:7.2f}s cpu {:5.2f}x  frames {}".format(
+                    name,
+                    cpu,
+                    cpu / single,
+                    " / ".join(
+                        str(frame_count(video)) if os.path.exists(video) else "-"
+                        for video in videos
+                    ),
+                )
+            )
+    finally:
+        shutil.rmtree(base_dir)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+Frames per second of the deflicker stage at each resolution, on the CPU
+only, and how much of the flicker in a synthetic sequence it takes out.
+"measure" runs on the resize queue, "correct" on the encode queue; "save"
+is the JPEG encode every frame needs anyway, for scale.
+
+    ./bench_deflicker.py --frames 100 --resolutions 1280x720,1920x1080
+"""
+
+import argparse
+import io
+import random
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image, ImageEnhance
+
+import deflicker
+import resize
+
+
+def make_frames(count, size, flicker):
+    """
+    A gradient with noise, each frame brightened or darkened by up to
+    flicker (e.g. 0.3 for +-30%).
+    """
+    random.seed(0)
+    gradient = Image.linear_gradient("L").resize(size)
+    image = Image.merge(
+        "RGB", (gradient, Image.effect_noise(size, 40), gradient.transpose(0))
+    )
+    return [
+        ImageEnhance.Brightness(image).enhance(1 + flicker * (2 * random.random() - 1))
+        for _ in range(count)
+    ]
+
+
+def flicker_of(frames):
+    """
+    Average change in mean luminance from one frame to the next.
+    """
+    means = [np.asarray(frame.convert("L")).mean() for frame in frames]
+    return np.abs(np.diff(means)).mean()
+
+
+def run(frames, window):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        return _run(frames, window, tmp_dir)
+
+
+def _run(frames, window, tmp_dir):
+    stage = deflicker.Deflicker(
+        {"deflicker_window": window, "fps": window, "out_tmp_dir": tmp_dir, "name": ""}
+    )
+    start = time.process_time()
+    measured = [stage.measure(frame) for frame in frames]
+    measure_time = time.process_time() - start
+
+    start = time.process_time()
+    corrected = [
+        stage.correct(frame, levels) for frame, levels in zip(frames, measured)
+    ]
+    correct_time = time.process_time() - start
+
+    start = time.process_time()
+    for frame in corrected:
+        frame.save(io.BytesIO(), "JPEG", quality=resize.DEFAULT_QUALITY)
+    save_time = time.process_time() - start
+    return measure_time, correct_time, save_time, corrected
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=100)
+    parser.add_argument("--resolutions", default="640x360,1280x720,1920x1080,3840x2160")
+    parser.add_argument("--window", type=int, default=48)
+    parser.add_argument("--flicker", type=float, default=0.3)
+    args = parser.parse_args()
+
+    print(
+        "{:10s} {:>9s} {:>9s} {:>9s} {:>9s} {:>8s} {:>8s}".format(
+            "resolution", "measure", "correct", "fps", "save fps", "flicker", "after"
+        )
+    )
+    for resolution in args.resolutions.split(","):
+        frames = make_frames(
+            args.frames, resize.parse_resolution(resolution), args.flicker
+        )
+        measure_time, correct_time, save_time, corrected = run(frames, args.window)
+        count = len(frames)
+        print(
+            "{:10s} {:7.2f}ms {:7.2f}ms {:9.1f} {:9.1f} {:8.2f} {:8.2f}".format(
+                resolution,
+                measure_time * 1000 / count,
+                correct_time * 1000 / count,
+                count / (measure_time + correct_time),
+                count / save_time,
+                flicker_of(frames),
+                flicker_of(corrected),
+            )
+        )
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+"""
+CPU time per frame and delay before a frame shows up in the video, for
+the batch encoder (one ffmpeg per fps frames) and the streaming encoder.
+
+    ./bench_encoder.py --frames 240 --resolution 852x480 --interval 0.1
+
+cpu/frame only counts ffmpeg (child processes). The delay is how long a
+frame takes from landing in out_tmp_dir to being part of the video.
+"""
+
+import argparse
+import os
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+
+import fmp4
+import timelapse_gen
+from encoder import StreamEncoder
+
+
+def make_frames(config, frames_dir, count):
+    subprocess.run(
+        [
+            "ffmpeg",
+            "-y",
+            "-f",
+            "lavfi",
+            "-i",
+            "testsrc=size={}:rate={}".format(config["resolution"], config["fps"]),
+            "-frames:v",
+            str(count),
+            "-q:v",
+            "3",
+            os.path.join(frames_dir, "frame_%06d.jpg"),
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        check=True,
+    )
+    return sorted(os.listdir(frames_dir))
+
+
+def children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def stage_frame(config, frames_dir, frame):
+    # What resize_and_move leaves in out_tmp_dir
+    staged = os.path.join(config["out_tmp_dir"], "{}_{}".format(config["name"], frame))
+    shutil.copy(os.path.join(frames_dir, frame), staged)
+    return staged
+
+
+def bench_batch(config, frames_dir, frames):
+    main_video = timelapse_gen.main_video_path(config)
+    delays = []
+    written = []
+    for frame in frames:
+        time.sleep(config["interval"])
+        stage_frame(config, frames_dir, frame)
+        written.append(time.monotonic())
+        tmp_video, _ = timelapse_gen.create_tmp_video(config)
+        if tmp_video:
+            timelapse_gen.append_video(config, main_video, tmp_video)
+            delays += [time.monotonic() - start for start in written]
+            written = []
+    return delays
+
+
+def bench_stream(config, frames_dir, frames):
+    main_video = timelapse_gen.main_video_path(config)
+    delays = []
+    written = {}
+
+    def on_fragment(ftyp, moov, fragment, frames):
+        fmp4.FragmentedVideo(main_video).append_fragments(
+            ftyp, moov, [fragment], frames[-1]
+        )
+        now = time.monotonic()
+        for frame in frames:
+            delays.append(now - written.pop(frame))
+
+    encoder = StreamEncoder(config, on_fragment, timelapse_gen.fragment_options(config))
+    for frame in frames:
+        time.sleep(config["interval"])
+        staged = stage_frame(config, frames_dir, frame)
+        written[os.path.basename(staged)] = time.monotonic()
+        encoder.write(staged)
+    encoder.close()
+    return delays
+
+
+def bench(name, config, frames_dir, frames, function):
+    out_dir = tempfile.mkdtemp()
+    config = dict(config, out_dir=out_dir, out_tmp_dir=out_dir)
+    try:
+        cpu = children_cpu()
+        delays = function(config, frames_dir, frames)
+        cpu = children_cpu() - cpu
+    finally:
+        shutil.rmtree(out_dir)
+
+    delays.sort()
+    print(
+        "{:8s} {:6.2f}ms cpu/frame delay p50 {:6.3f}s max {:6.3f}s".format(
+            name,
+            cpu * 1000 / len(frames),
+            delays[len(delays) // 2],
+            delays[-1],
+        )
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=240)
+    parser.add_argument("--resolution", default="852x480")
+    parser.add_argument("--fps", type=int, default=24)
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=0.1,
+        help="Seconds between frames, like photos arriving from the camera",
+    )
+    args = parser.parse_args()
+
+    config = {
+        "name": "bench",
+        "fps": args.fps,
+        "resolution": args.resolution,
+        "interval": args.interval,
+    }
+
+    frames_dir = tempfile.mkdtemp()
+    try:
+        frames = make_frames(config, frames_dir, args.frames)
+        bench("batch", config, frames_dir, frames, bench_batch)
+        bench("stream", config, frames_dir, frames, bench_stream)
+    finally:
+        shutil.rmtree(frames_dir)
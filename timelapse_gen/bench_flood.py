@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+"""
+Flood a source dir with photos and check that the job queues keep up,
+keep each timelapse in order and don't grow past queue_depth.
+
+    ./bench_flood.py --photos 2000
+
+Photos are written to hidden files in src_dir and renamed, the same way
+the timelapse service saves them, while the watchdog observer is running.
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+from PIL import Image
+from watchdog.observers import Observer
+
+import timelapse_gen
+
+
+def make_photo(path, index, size):
+    Image.linear_gradient("L").resize(size).point(
+        lambda value: (value + index) % 256
+    ).convert("RGB").save(path)
+
+
+def frame_count(video):
+    result = subprocess.run(
+        ["ffmpeg", "-i", video, "-f", "null", "-"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    frames = result.stderr.decode("utf-8").split("frame=")[-1].split()[0]
+    return int(frames)
+
+
+def watch_depth(queues, peaks, done):
+    while not done.is_set():
+        for queue in queues:
+            peaks[queue.name] = max(peaks.get(queue.name, 0), queue.stats()["depth"])
+        time.sleep(0.05)
+
+
+def flood_config(base_dir, queue_depth, resize_workers, encode_workers):
+    src_dir = os.path.join(base_dir, "photos")
+    timelapse = {
+        "src_dir": src_dir,
+        "out_dir": os.path.join(base_dir, "videos"),
+        "out_tmp_dir": os.path.join(base_dir, "tmp"),
+        "fps": 24,
+    }
+    return {
+        "queue_depth": queue_depth,
+        "resize_workers": resize_workers,
+        "encode_workers": encode_workers,
+        "timelapses": [
+            dict(timelapse, name="flood_batch", resolution="160x90"),
+            dict(
+                timelapse, name="flood_stream", resolution="128x128", encoder="stream"
+            ),
+        ],
+    }
+
+
+def flood(config, photos, timeout=600):
+    """
+    Move photos photos into the src_dir of config while timelapse_gen is
+    watching it and wait for them all to be processed. Returns the stopped
+    queues, the peak depth of each queue and the flood and drain times.
+    """
+    src_dir = config["timelapses"][0]["src_dir"]
+    os.makedirs(src_dir, exist_ok=True)
+    names = ["{:06d}.jpg".format(index) for index in range(photos)]
+    for index, name in enumerate(names):
+        make_photo(os.path.join(src_dir, "." + name), index, (320, 180))
+
+    queues, sources = timelapse_gen.start_pipeline(config)
+    observer = Observer()
+    for source in sources:
+        observer.schedule(timelapse_gen.FSChangeHandler(source), source.src_dir)
+    observer.start()
+
+    peaks = {}
+    done = threading.Event()
+    watcher = threading.Thread(target=watch_depth, args=(queues, peaks, done))
+    watcher.start()
+
+    try:
+        start_time = time.monotonic()
+        for name in names:
+            os.rename(os.path.join(src_dir, "." + name), os.path.join(src_dir, name))
+        flood_time = time.monotonic() - start_time
+
+        # Wait for every event to be queued, then for the queues to drain
+        while queues[0].stats()["completed"] < photos:
+            if time.monotonic() - start_time > timeout:
+                raise Exception("Timed out, events were lost")
+            time.sleep(0.1)
+        for queue in queues:
+            queue.join()
+        drain_time = time.monotonic() - start_time
+    finally:
+        observer.stop()
+        observer.join()
+        timelapse_gen.stop_pipeline(queues, sources)
+        done.set()
+        watcher.join()
+
+    return queues, peaks, flood_time, drain_time
+
+
+def expected_frames(timelapse, photos):
+    if timelapse.get("encoder", "batch") == "batch":
+        # A partial batch waits in out_tmp_dir for more photos
+        return photos - photos % timelapse["fps"]
+    return photos
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--photos", type=int, default=2000)
+    parser.add_argument("--queue-depth", type=int, default=32)
+    parser.add_argument("--resize-workers", type=int, default=os.cpu_count())
+    parser.add_argument("--encode-workers", type=int, default=2)
+    parser.add_argument("--timeout", type=float, default=600)
+    args = parser.parse_args()
+
+    base_dir = tempfile.mkdtemp()
+    config = flood_config(
+        base_dir, args.queue_depth, args.resize_workers, args.encode_workers
+    )
+
+    try:
+        print("Creating {} photos".format(args.photos))
+        queues, peaks, flood_time, drain_time = flood(config, args.photos, args.timeout)
+
+        print(
+            "Moved {} photos in {:.2f}s, all processed after {:.2f}s ({:.1f} photos/s)".format(
+                args.photos, flood_time, drain_time, args.photos / drain_time
+            )
+        )
+        for queue in queues:
+            stats = queue.stats()
+            print(
+                "{:8s} peak depth {:4d} (limit {:4d}) latency p50 {:.3f}s p99 {:.3f}s "
+                "submit blocked {:.2f}s".format(
+                    queue.name,
+                    peaks.get(queue.name, 0),
+                    queue.max_depth,
+                    stats["latency"]["p50"],
+                    stats["latency"]["p99"],
+                    stats["blocked_time"],
+                )
+            )
+
+        for timelapse in config["timelapses"]:
+            frames = frame_count(timelapse_gen.main_video_path(timelapse))
+            expected = expected_frames(timelapse, args.photos)
+            print(
+                "{:14s} {:6d} frames {}".format(
+                    timelapse["name"],
+                    frames,
+                    "ok" if frames == expected else "expected {}".format(expected),
+                )
+            )
+    finally:
+        shutil.rmtree(base_dir)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+"""
+Encode the same frames with each encoder profile and report encoding
+speed, CPU time, output size and quality (SSIM and PSNR against the
+frames), to pick an encoder_profile from numbers.
+
+    ./bench_profiles.py --frames 240 --resolution 1920x1080
+    ./bench_profiles.py --src /srv/timelapse/photos --profiles default,fast
+"""
+
+import argparse
+import os
+import re
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+
+import profiles
+
+FRAME_PATTERN = "frame_%06d.jpg"
+
+
+def make_frames(frames_dir, count, resolution, fps, src=None):
+    width, height = resolution.split("x")
+    if src:
+        # Real photos, cropped to fill the resolution like resize does
+        inputs = ["-pattern_type", "glob", "-i", os.path.join(src, "*.jpg")]
+        filters = [
+            "scale={}:{}:force_original_aspect_ratio=increase".format(width, height),
+            "crop={}:{}".format(width, height),
+        ]
+    else:
+        # Moving detail plus sensor noise that changes every frame, which is
+        # what makes timelapses expensive to encode
+        inputs = [
+            "-f",
+            "lavfi",
+            "-i",
+            "testsrc2=size={}:rate={}".format(resolution, fps),
+        ]
+        filters = ["noise=alls=4:allf=t"]
+
+    subprocess.run(
+        ["ffmpeg", "-y"]
+        + inputs
+        + [
+            "-vf",
+            ",".join(filters),
+            "-frames:v",
+            str(count),
+            "-q:v",
+            "2",
+            os.path.join(frames_dir, FRAME_PATTERN),
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        check=True,
+    )
+    return len(os.listdir(frames_dir))
+
+
+def children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def encode(frames_dir, fps, profile, outfile):
+    """
+    Return (seconds, cpu seconds), or None if ffmpeg failed.
+    """
+    cpu = children_cpu()
+    start = time.monotonic()
+    result = subprocess.run(
+        [
+            "ffmpeg",
+            "-y",
+            "-framerate",
+            str(fps),
+            "-i",
+            os.path.join(frames_dir, FRAME_PATTERN),
+        ]
+        + profiles.video_options(profile)
+        + [outfile],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    if result.returncode:
+        return None
+    return time.monotonic() - start, children_cpu() - cpu
+
+
+def quality(frames_dir, fps, video):
+    """
+    (SSIM, PSNR) of video against the frames. Both are compared as yuv420p,
+    so chroma subsampling isn't counted against the encoder.
+    """
+    result = subprocess.run(
+        [
+            "ffmpeg",
+            "-i",
+            video,
+            "-framerate",
+            str(fps),
+            "-i",
+            os.path.join(frames_dir, FRAME_PATTERN),
+            "-lavfi",
+            "[0:v]split[a][b];[1:v]format=yuv420p,split[c][d];[a][c]ssim;[b][d]psnr",
+            "-f",
+            "null",
+            "-",
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    output = result.stderr.decode("utf-8")
+    ssim = re.search(r"SSIM .*All:([0-9.]+)", output)
+    psnr = re.search(r"PSNR .*average:([0-9.]+|inf)", output)
+    return (
+        float(ssim.group(1)) if ssim else float("nan"),
+        float(psnr.group(1)) if psnr else float("nan"),
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--src", help="Directory of sample JPEGs")
+    parser.add_argument("--frames", type=int, default=240)
+    parser.add_argument("--resolution", default="1920x1080")
+    parser.add_argument("--fps", type=int, default=24)
+    parser.add_argument(
+        "--profiles",
+        default=",".join(profiles.PROFILES),
+        help="Comma separated profile names",
+    )
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        frames_dir = os.path.join(work_dir, "frames")
+        os.makedirs(frames_dir)
+        count = make_frames(
+            frames_dir, args.frames, args.resolution, args.fps, args.src
+        )
+        print(
+            "{} frames at {}\n".format(count, args.resolution)
+            + "{:10s} {:>8s} {:>10s} {:>9s} {:>10s} {:>7s} {:>8s}".format(
+                "profile", "fps", "cpu/frame", "size", "bitrate", "ssim", "psnr"
+            )
+        )
+
+        encoders = profiles.available_encoders()
+        for name in args.profiles.split(","):
+            profile = profiles.PROFILES[name]
+            if profile["codec"] not in encoders:
+                print("{:10s} no {} encoder".format(name, profile["codec"]))
+                continue
+
+            video = os.path.join(work_dir, "{}.mp4".format(name))
+            timing = encode(frames_dir, args.fps, profile, video)
+            if timing is None:
+                print("{:10s} {} failed".format(name, profile["codec"]))
+                continue
+
+            seconds, cpu = timing
+            size = os.path.getsize(video)
+            ssim, psnr = quality(frames_dir, args.fps, video)
+            print(
+                "{:10s} {:8.1f} {:8.1f}ms {:7.1f}MB {:6.0f}kb/s {:7.4f} {:6.2f}dB".format(
+                    name,
+                    count / seconds,
+                    cpu * 1000 / count,
+                    size / 1e6,
+                    size * 8 / 1000 / (count / args.fps),
+                    ssim,
+                    psnr,
+                )
+            )
+    finally:
+        shutil.rmtree(work_dir)
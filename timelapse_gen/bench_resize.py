@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""
+Throughput and peak RSS of resizing photos in process (Pillow) compared
+to running ImageMagick convert for each photo.
+
+    ./bench_resize.py --src /srv/timelapse/photos --resolution 852x480
+    ./bench_resize.py   # synthetic 1920x1080 frames
+"""
+
+import argparse
+import glob
+import multiprocessing
+import os
+import resource
+import shutil
+import tempfile
+import time
+
+from PIL import Image
+
+import resize
+from timelapse_gen import resize_and_move
+
+
+def make_frames(frames_dir, count, size):
+    for index in range(count):
+        noise = Image.effect_noise(size, 32 + index % 16)
+        gradient = Image.linear_gradient("L").resize(size)
+        image = Image.merge("RGB", (noise, gradient, gradient.transpose(0)))
+        image.save(os.path.join(frames_dir, "frame_{:06d}.jpg".format(index)))
+    return sorted(glob.glob(os.path.join(frames_dir, "*.jpg")))
+
+
+def peak_rss_kb(who):
+    return resource.getrusage(who).ru_maxrss
+
+
+def run(photos, out_dir, resolution, resizer):
+    start = time.monotonic()
+    for photo in photos:
+        resize_and_move(photo, out_dir, resolution, "bench", resizer)
+    return len(photos) / (time.monotonic() - start)
+
+
+def run_pil(photos, out_dir, resolution, results):
+    # Runs in its own process so its peak RSS isn't mixed with the parent
+    baseline = peak_rss_kb(resource.RUSAGE_SELF)
+    resizer = resize.Resizer(resolution)
+    rate = run(photos, out_dir, resolution, resizer)
+    results.put((rate, baseline, peak_rss_kb(resource.RUSAGE_SELF), resizer))
+
+
+def report(name, rate, peak_rss):
+    print(
+        "{:10s} {:8.1f} frames/s {:10.1f} MB peak RSS".format(
+            name, rate, peak_rss / 1024
+        )
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--src", help="Directory of sample JPEGs")
+    parser.add_argument("--frames", type=int, default=50)
+    parser.add_argument("--resolution", default="852x480")
+    parser.add_argument("--source-resolution", default="1920x1080")
+    args = parser.parse_args()
+
+    frames_dir = None
+    out_dir = tempfile.mkdtemp()
+    try:
+        if args.src:
+            photos = sorted(glob.glob(os.path.join(args.src, "*.jpg")))[: args.frames]
+        else:
+            frames_dir = tempfile.mkdtemp()
+            photos = make_frames(
+                frames_dir,
+                args.frames,
+                resize.parse_resolution(args.source_resolution),
+            )
+
+        with Image.open(photos[0]) as image:
+            print(
+                "{} photos {}x{} -> {}".format(
+                    len(photos), image.size[0], image.size[1], args.resolution
+                )
+            )
+
+        # convert runs first so RUSAGE_CHILDREN only covers convert
+        if shutil.which("convert") is None:
+            print("convert    skipped (ImageMagick not installed)")
+        else:
+            rate = run(photos, out_dir, args.resolution, None)
+            report("convert", rate, peak_rss_kb(resource.RUSAGE_CHILDREN))
+
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(
+            target=run_pil, args=(photos, out_dir, args.resolution, results)
+        )
+        process.start()
+        rate, baseline, peak_rss, resizer = results.get()
+        process.join()
+        report("pil", rate, peak_rss)
+        print(
+            "{:10s} {:10.1f} MB of that is the interpreter, {}/{} frames used draft".format(
+                "", baseline / 1024, resizer.draft_frames, resizer.frames
+            )
+        )
+    finally:
+        shutil.rmtree(out_dir)
+        if frames_dir:
+            shutil.rmtree(frames_dir)
@@ -0,0 +1,84 @@
+"""
+Faster copies of a timelapse, made from the frames it has already resized.
+
+A timelapse with speeds: [10, 100] also makes <name>_x10.mp4 and
+<name>_x100.mp4. The levels form a cascade: each one takes every stride-th
+frame of the level above it (10 and then 10 again here), so a frame is
+only decoded and resized once, and each level encodes 1/stride of the
+frames of the one above. All levels together cost about 1.11x one video.
+
+With speed_blend: true, a level's frame is the average of the stride
+frames instead, which turns e.g. passing clouds into a smooth blur rather
+than jumps. Only the running average is kept, never the stride frames.
+"""
+
+from PIL import Image
+
+
+def level_strides(speeds):
+    """
+    The stride of each level relative to the one above, for speeds given
+    relative to the timelapse.
+    """
+    strides = []
+    last = 1
+    for speed in speeds:
+        if speed <= last or speed % last:
+            raise ValueError(
+                "Speeds must be increasing multiples of each other, got {}".format(
+                    speeds
+                )
+            )
+        strides.append(speed // last)
+        last = speed
+    return strides
+
+
+class Level:
+    """
+    Counts (and optionally averages) the frames of the level above.
+    """
+
+    def __init__(self, timelapse, stride, blend=False):
+        self.timelapse = timelapse
+        self.stride = stride
+        self.blend = blend
+        self.count = 0
+        self.mean = None
+        self.frames = 0
+
+    def add(self, frame, image=None):
+        """
+        Add the next frame of the level above: its path, and the image if
+        it is already decoded. Returns None, or the image to use for this
+        level's next frame when blending (the caller closes it), or frame
+        itself when not.
+        """
+        self.count += 1
+        if self.blend:
+            if image is None:
+                with Image.open(frame) as opened:
+                    image = opened.convert("RGB")
+                self.accumulate(image)
+                image.close()
+            else:
+                self.accumulate(image)
+
+        if self.count < self.stride:
+            return None
+
+        self.count = 0
+        self.frames += 1
+        if not self.blend:
+            return frame
+        mean, self.mean = self.mean, None
+        return mean
+
+    def accumulate(self, image):
+        if self.mean is None:
+            self.mean = image.copy()
+        else:
+            # Running average, so only one image is ever kept
+            mean = Image.blend(self.mean, image, 1 / self.count)
+            self.mean.close()
+            self.mean = mean
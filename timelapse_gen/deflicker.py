@@ -0,0 +1,180 @@
+"""
+Even out the exposure of consecutive frames before they are encoded.
+
+With manual exposure pinned in z_camera_settings, every change in the light
+shows up in the video as flicker. For each frame the 5th, 50th and 95th
+percentiles of a luminance histogram (its levels) are measured. The target
+levels are a straight line fitted through the last deflicker_window frames'
+levels, taken at the current frame: flicker averages out, while a steady
+change like dawn is followed without lagging behind as a plain average
+would. A gain curve through the frame's levels and the target levels is
+then applied to every channel.
+
+Only the levels of the last window frames are kept, so memory doesn't grow
+with the length of the timelapse. They are saved every window frames and on
+exit. Measuring runs on the resize queue in
+any order; correcting has to see the frames in order and runs on the
+encode queue, which adds them in photo order for each timelapse.
+"""
+
+import collections
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+PERCENTILES = (5, 50, 95)
+
+# A frame's levels are moved by at most this factor either way
+DEFAULT_MAX_GAIN = 2.0
+
+# The histogram is taken from every STEP-th pixel of every STEP-th row
+STEP = 2
+
+# Rec. 601 luma weights, out of 256
+LUMA_WEIGHTS = (77, 150, 29)
+
+# Keeps the curve's points strictly increasing for np.interp
+RAMP = np.arange(len(PERCENTILES)) * 0.01
+
+
+def luminance_histogram(image, step=STEP):
+    """
+    256 bin histogram of the luminance of an RGB or L image.
+    """
+    pixels = np.asarray(image)[::step, ::step]
+    if pixels.ndim == 3:
+        red, green, blue = LUMA_WEIGHTS
+        luma = pixels[..., 0] * np.uint16(red)
+        luma += pixels[..., 1] * np.uint16(green)
+        luma += pixels[..., 2] * np.uint16(blue)
+        pixels = (luma >> 8).astype(np.uint8)
+    return np.bincount(pixels.ravel(), minlength=256)
+
+
+def levels(histogram, percentiles=PERCENTILES):
+    """
+    Luminance at each of percentiles, interpolated between bins.
+    """
+    cumulative = np.cumsum(histogram, dtype=np.float64)
+    points = np.array(percentiles, dtype=np.float64) / 100 * cumulative[-1]
+    return np.interp(points, cumulative, np.arange(256, dtype=np.float64))
+
+
+def trend(recent):
+    """
+    Levels at the last of recent (frames by levels) on a least squares line
+    through all of them.
+    """
+    recent = np.asarray(recent, dtype=np.float64)
+    mean = recent.mean(axis=0)
+    if len(recent) < 3:
+        return mean
+    x = np.arange(len(recent)) - (len(recent) - 1) / 2
+    slope = x @ (recent - mean) / (x @ x)
+    return mean + slope * x[-1]
+
+
+def gain_curve(frame_levels, target_levels, max_gain=DEFAULT_MAX_GAIN):
+    """
+    256 entry lookup table that moves frame_levels to target_levels, with
+    0 and 255 fixed.
+    """
+    frame_levels = np.clip(frame_levels, 1, 254) + RAMP
+    target_levels = np.clip(
+        target_levels, frame_levels / max_gain, frame_levels * max_gain
+    )
+    curve = np.interp(
+        np.arange(256),
+        np.concatenate(([0], frame_levels, [255])),
+        np.concatenate(([0], np.clip(target_levels, 0, 255), [255])),
+    )
+    return np.round(curve).astype(np.uint8)
+
+
+class Deflicker:
+    def __init__(self, config):
+        # Changes in the light that are steady over this many frames
+        # (default two seconds of video, e.g. a sunset) are left alone
+        self.window = config.get("deflicker_window", 2 * config["fps"])
+        self.max_gain = config.get("deflicker_max_gain", DEFAULT_MAX_GAIN)
+        self.recent = collections.deque(maxlen=self.window)
+
+        # The window is kept across restarts
+        self.state_path = os.path.join(
+            config["out_tmp_dir"], "{}_deflicker.json".format(config["name"])
+        )
+        if os.path.exists(self.state_path):
+            try:
+                with open(self.state_path, "r") as state_file:
+                    self.recent.extend(
+                        np.array(saved) for saved in json.load(state_file)
+                    )
+            except (OSError, ValueError) as e:
+                print("Ignoring {} ({})".format(self.state_path, e))
+
+        self.lock = threading.Lock()
+        self.frames = 0
+        self.measure_time = 0
+        self.correct_time = 0
+        self.stops = 0
+
+    def measure(self, image):
+        """
+        Levels of a resized frame. Safe to call from any thread.
+        """
+        start_time = time.monotonic()
+        frame_levels = levels(luminance_histogram(image))
+        with self.lock:
+            self.measure_time += time.monotonic() - start_time
+        return frame_levels
+
+    def correct(self, image, frame_levels):
+        """
+        Return image with its levels moved to the trend of the window.
+        Frames must be corrected in order. The caller closes both images.
+        """
+        start_time = time.monotonic()
+        self.recent.append(frame_levels)
+        target_levels = trend(self.recent)
+        curve = gain_curve(frame_levels, target_levels, self.max_gain)
+        corrected = image.point(curve.tolist() * len(image.getbands()))
+
+        with self.lock:
+            self.frames += 1
+            self.correct_time += time.monotonic() - start_time
+            midtone = int(round(frame_levels[1]))
+            self.stops += abs(float(np.log2((curve[midtone] + 1) / (midtone + 1))))
+            save = self.frames % self.window == 0
+
+        if save:
+            # So a crash doesn't restart from an empty window
+            try:
+                self.save()
+            except OSError as e:
+                print("Unable to save {} ({})".format(self.state_path, e))
+        return corrected
+
+    def stats(self):
+        """
+        Average measure and correct time per frame, and the average midtone
+        correction in stops.
+        """
+        with self.lock:
+            return {
+                "frames": self.frames,
+                "measure_time": self.measure_time / max(self.frames, 1),
+                "correct_time": self.correct_time / max(self.frames, 1),
+                "stops": self.stops / max(self.frames, 1),
+            }
+
+    def save(self):
+        tmp_path = "{}.tmp".format(self.state_path)
+        with open(tmp_path, "w") as state_file:
+            json.dump([saved.tolist() for saved in self.recent], state_file)
+        os.replace(tmp_path, self.state_path)
+
+    def close(self):
+        self.save()
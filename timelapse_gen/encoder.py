@@ -0,0 +1,248 @@
+"""
+Streaming encoder.
+
+Instead of starting ffmpeg for every batch of fps frames, one ffmpeg
+process per timelapse stays alive and resized frames are written to its
+stdin as they arrive. ffmpeg writes a fragmented MP4 to stdout and every
+fragment is handed to on_fragment as soon as it is complete.
+
+Frames stay on disk until the fragment holding them has been appended, so
+if ffmpeg dies the frames it hadn't finished are fed to a new process, and
+if timelapse_gen itself dies they are picked up again on the next start.
+"""
+
+import os
+import subprocess
+import threading
+import time
+
+import fmp4
+import profiles
+from timelapse_metrics import metrics
+
+
+class EncoderError(Exception):
+    pass
+
+
+class StreamEncoder:
+    """
+    One long lived ffmpeg process fed JPEG frames over a pipe.
+
+    on_fragment(ftyp, moov, (moof, mdat), frames) is called from a reader
+    thread for every fragment, with the names of the frames it holds.
+    The process is restarted (rotated) every segment_frames frames.
+    """
+
+    def __init__(self, config, on_fragment, output_options=(), profile=None):
+        self.config = config
+        self.profile = profile or profiles.get_profile(config)
+        self.on_fragment = on_fragment
+        self.output_options = list(output_options)
+        self.segment_frames = config.get("segment_frames", config["fps"] * 60 * 60)
+        self.fragment_frames = config.get("fragment_frames", max(1, config["fps"] // 4))
+
+        self.process = None
+        self.reader = None
+        self.lock = threading.Lock()
+        # [(frame path, time written)] sent to ffmpeg but not in the video yet
+        self.pending = []
+        self.segment_count = 0
+
+        self.frames = 0
+        self.fragments = 0
+        self.restarts = 0
+
+    def command(self):
+        options = profiles.video_options(self.profile)
+        options += ["-g", str(self.config["fps"])]
+        if self.profile["codec"] == "libx264":
+            # Without lookahead a fragment is ready a few frames after its
+            # last one is written instead of ~40 frames later
+            options += ["-x264-params", "rc-lookahead=0"]
+
+        return (
+            [
+                "ffmpeg",
+                "-y",
+                # Don't wait for several frames to probe the input
+                "-probesize",
+                "32",
+                "-analyzeduration",
+                "0",
+                "-f",
+                "image2pipe",
+                "-framerate",
+                str(self.config["fps"]),
+                "-c:v",
+                "mjpeg",
+                "-i",
+                "pipe:0",
+            ]
+            + options
+            + self.output_options
+            + [
+                # Don't wait for the next keyframe to finish a fragment
+                "-frag_duration",
+                str(self.fragment_frames * 1000000 // self.config["fps"]),
+                "-flush_packets",
+                "1",
+                "-f",
+                "mp4",
+                "pipe:1",
+            ]
+        )
+
+    def log_path(self):
+        return os.path.join(
+            self.config["out_tmp_dir"], "{}_encoder.log".format(self.config["name"])
+        )
+
+    def _start(self):
+        with open(self.log_path(), "ab") as log:
+            self.process = metrics.popen(
+                self.command(),
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=log,
+            )
+        self.reader = threading.Thread(
+            target=self._read_fragments, args=(self.process,), daemon=True
+        )
+        self.reader.start()
+        self.segment_count = 0
+
+        # Frames a previous process didn't finish go first
+        with self.lock:
+            frames = [frame for frame, _ in self.pending]
+        for frame in frames:
+            self._feed(frame)
+
+    def _stop(self):
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.process.wait()
+        self.reader.join()
+        returncode = self.process.returncode
+        self.process = None
+        self.reader = None
+        return returncode
+
+    def _feed(self, frame_path):
+        with open(frame_path, "rb") as frame:
+            data = frame.read()
+        try:
+            self.process.stdin.write(data)
+            self.process.stdin.flush()
+        except BrokenPipeError:
+            raise EncoderError("ffmpeg exited, see {}".format(self.log_path()))
+        self.segment_count += 1
+
+    def _restart(self):
+        returncode = self._stop()
+        self.restarts += 1
+        print(
+            "Encoder for {} exited ({}), restarting with {} pending frames".format(
+                self.config["name"], returncode, len(self.pending)
+            )
+        )
+        self._start()
+
+    def write(self, frame_path):
+        """
+        Send a frame to the encoder. The file is removed once it is part of
+        the video.
+        """
+        if self.process is None:
+            self._start()
+        elif self.process.poll() is not None:
+            self._restart()
+
+        with self.lock:
+            self.pending.append((frame_path, time.monotonic()))
+
+        try:
+            self._feed(frame_path)
+        except EncoderError:
+            # The frame is pending, so a new process will pick it up
+            self._restart()
+
+        self.frames += 1
+        if self.segment_count >= self.segment_frames:
+            self.rotate()
+
+    def rotate(self):
+        """
+        Finish the current segment. ffmpeg flushes the last (short)
+        fragment and exits; the next frame starts a new process.
+        """
+        if self.process is None:
+            return
+        returncode = self._stop()
+        if returncode:
+            print(
+                "Encoder for {} exited with {}, see {}".format(
+                    self.config["name"], returncode, self.log_path()
+                )
+            )
+
+    def close(self):
+        self.rotate()
+
+    def _read_fragments(self, process):
+        ftyp = moov = moof = None
+        while True:
+            try:
+                box = fmp4.read_box(process.stdout)
+            except fmp4.FragmentError as e:
+                print("Encoder for {}: {}".format(self.config["name"], e))
+                process.kill()
+                break
+            if box is None:
+                break
+
+            box_type, data = box
+            if box_type == b"ftyp":
+                ftyp = data
+            elif box_type == b"moov":
+                moov = data
+            elif box_type == b"moof":
+                moof = data
+            elif box_type == b"mdat" and moof is not None:
+                try:
+                    self._append(ftyp, moov, moof, data)
+                except (fmp4.FragmentError, OSError) as e:
+                    # The frames are still pending and go to the next process
+                    print("Unable to append to {} ({})".format(self.config["name"], e))
+                    process.kill()
+                    break
+                moof = None
+
+    def _append(self, ftyp, moov, moof, mdat):
+        count = fmp4.fragment_sample_count(moof)
+        with self.lock:
+            frames = self.pending[:count]
+        if not frames:
+            return
+
+        start_time = time.monotonic()
+        self.on_fragment(
+            ftyp, moov, (moof, mdat), [os.path.basename(frame) for frame, _ in frames]
+        )
+        self.fragments += 1
+
+        with self.lock:
+            del self.pending[:count]
+        for frame, _ in frames:
+            os.remove(frame)
+
+        print(
+            "Appended {} frames to {} in {:.3f}s, {:.2f}s after the first was written".format(
+                len(frames),
+                self.config["name"],
+                time.monotonic() - start_time,
+                time.monotonic() - frames[0][1],
+            )
+        )
@@ -0,0 +1,606 @@
+"""
+Append-only fragmented MP4 output.
+
+Each chunk produced by create_timelapse is itself a fragmented MP4
+(ftyp + moov followed by moof/mdat pairs). Appending a chunk to the main
+video only copies its fragments to the end of the file and renumbers them,
+so the cost depends on the size of the chunk, not the length of the video.
+Only box headers and the small moof/moov boxes are read into memory; media
+data is copied between files in blocks.
+
+Progress is kept in a small state file next to the video. If the process
+dies half way through an append, the video is truncated back to the last
+recorded size before the next append.
+"""
+
+import json
+import os
+import struct
+import tempfile
+
+from v4l2.files import write_atomic
+
+TFHD_DEFAULT_SAMPLE_DURATION = 0x08
+TRUN_DATA_OFFSET = 0x001
+TRUN_FIRST_SAMPLE_FLAGS = 0x004
+TRUN_SAMPLE_DURATION = 0x100
+TRUN_SAMPLE_SIZE = 0x200
+TRUN_SAMPLE_FLAGS = 0x400
+TRUN_SAMPLE_CTO = 0x800
+
+COPY_BLOCK_SIZE = 1 << 20
+
+
+class FragmentError(Exception):
+    pass
+
+
+def read_boxes(data, start=0, end=None):
+    """
+    Return [(type, offset, size, header_size)] for the boxes between start
+    and end.
+    """
+    if end is None:
+        end = len(data)
+
+    boxes = []
+    offset = start
+    while offset + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", data, offset)
+        header_size = 8
+        if size == 1:
+            (size,) = struct.unpack_from(">Q", data, offset + 8)
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size or offset + size > end:
+            raise FragmentError("Truncated {} box at {}".format(box_type, offset))
+        boxes.append((box_type, offset, size, header_size))
+        offset += size
+
+    return boxes
+
+
+def find_box(data, path, start=0, end=None):
+    """
+    Return (offset, size, header_size) of the first box matching path, a
+    list of box types from the outermost container inward.
+    """
+    for box_type, offset, size, header_size in read_boxes(data, start, end):
+        if box_type != path[0]:
+            continue
+        if len(path) == 1:
+            return offset, size, header_size
+        return find_box(data, path[1:], offset + header_size, offset + size)
+    return None
+
+
+def _payload(box):
+    offset, size, header_size = box
+    return offset + header_size
+
+
+def _trex_duration(moov):
+    trex = find_box(moov, [b"moov", b"mvex", b"trex"])
+    if trex is None:
+        return 0
+    # version/flags, track_ID, default_sample_description_index, duration
+    (duration,) = struct.unpack_from(">I", moov, _payload(trex) + 12)
+    return duration
+
+
+def fragment_duration(moof, default_duration):
+    """
+    Sum of sample durations in a moof box, in track timescale units.
+    """
+    duration = 0
+    for box_type, offset, size, header_size in read_boxes(moof, 8):
+        if box_type != b"traf":
+            continue
+        traf_default = default_duration
+        for child_type, child, child_size, child_header in read_boxes(
+            moof, offset + header_size, offset + size
+        ):
+            payload = child + child_header
+            (flags,) = struct.unpack_from(">I", moof, payload)
+            flags &= 0xFFFFFF
+            if child_type == b"tfhd":
+                field = payload + 8
+                # base_data_offset, sample_description_index
+                if flags & 0x01:
+                    field += 8
+                if flags & 0x02:
+                    field += 4
+                if flags & TFHD_DEFAULT_SAMPLE_DURATION:
+                    (traf_default,) = struct.unpack_from(">I", moof, field)
+            elif child_type == b"trun":
+                (sample_count,) = struct.unpack_from(">I", moof, payload + 4)
+                field = payload + 8
+                if flags & TRUN_DATA_OFFSET:
+                    field += 4
+                if flags & TRUN_FIRST_SAMPLE_FLAGS:
+                    field += 4
+                if not flags & TRUN_SAMPLE_DURATION:
+                    duration += sample_count * traf_default
+                    continue
+                sample_size = 4 * bin(
+                    flags
+                    & (
+                        TRUN_SAMPLE_DURATION
+                        | TRUN_SAMPLE_SIZE
+                        | TRUN_SAMPLE_FLAGS
+                        | TRUN_SAMPLE_CTO
+                    )
+                ).count("1")
+                for index in range(sample_count):
+                    (sample_duration,) = struct.unpack_from(
+                        ">I", moof, field + index * sample_size
+                    )
+                    duration += sample_duration
+        # Only a single video track is written
+        break
+
+    return duration
+
+
+def fragment_sample_count(moof):
+    """
+    Number of samples (frames) in a moof box.
+    """
+    count = 0
+    traf = find_box(moof, [b"moof", b"traf"])
+    if traf is None:
+        return 0
+    offset, size, header_size = traf
+    for box_type, child, child_size, child_header in read_boxes(
+        moof, offset + header_size, offset + size
+    ):
+        if box_type == b"trun":
+            count += struct.unpack_from(">I", moof, child + child_header + 4)[0]
+    return count
+
+
+def fragment_decode_time(moof):
+    tfdt = find_box(moof, [b"moof", b"traf", b"tfdt"])
+    if tfdt is None:
+        raise FragmentError("Fragments must have a tfdt box")
+    payload = _payload(tfdt)
+    if moof[payload] == 1:
+        return struct.unpack_from(">Q", moof, payload + 4)[0]
+    return struct.unpack_from(">I", moof, payload + 4)[0]
+
+
+def renumber_fragment(moof, sequence, decode_time_offset):
+    """
+    Return a copy of moof with its sequence number replaced and its decode
+    time shifted by decode_time_offset.
+    """
+    moof = bytearray(moof)
+
+    mfhd = find_box(moof, [b"moof", b"mfhd"])
+    if mfhd is None:
+        raise FragmentError("moof without mfhd")
+    struct.pack_into(">I", moof, _payload(mfhd) + 4, sequence)
+
+    tfdt = find_box(moof, [b"moof", b"traf", b"tfdt"])
+    if tfdt is None:
+        raise FragmentError("Fragments must have a tfdt box")
+    payload = _payload(tfdt)
+    if moof[payload] == 1:
+        (decode_time,) = struct.unpack_from(">Q", moof, payload + 4)
+        struct.pack_into(">Q", moof, payload + 4, decode_time + decode_time_offset)
+    else:
+        (decode_time,) = struct.unpack_from(">I", moof, payload + 4)
+        decode_time += decode_time_offset
+        if decode_time >= 1 << 32:
+            raise FragmentError("tfdt overflow, use version 1 tfdt boxes")
+        struct.pack_into(">I", moof, payload + 4, decode_time)
+
+    return bytes(moof)
+
+
+def read_box(stream):
+    """
+    Read one complete box from a file object. Returns (type, box) or None
+    at the end of the stream.
+    """
+    header = stream.read(8)
+    if len(header) < 8:
+        return None
+    size, box_type = struct.unpack(">I4s", header)
+    if size == 1:
+        extended = stream.read(8)
+        if len(extended) < 8:
+            return None
+        header += extended
+        (size,) = struct.unpack(">Q", extended)
+    if size < len(header):
+        raise FragmentError("Unsupported {} box size {}".format(box_type, size))
+
+    body = stream.read(size - len(header))
+    if len(body) < size - len(header):
+        return None
+    return box_type, header + body
+
+
+def scan_boxes(stream, start=0):
+    """
+    Return [(type, offset, size, header_size)] for the complete top-level
+    boxes of a file object, from their headers alone. Stops at the first
+    box that runs past the end of the file.
+    """
+    end = stream.seek(0, os.SEEK_END)
+    boxes = []
+    offset = start
+    while offset + 8 <= end:
+        stream.seek(offset)
+        header = stream.read(16)
+        size, box_type = struct.unpack_from(">I4s", header)
+        header_size = 8
+        if size == 1:
+            if len(header) < 16:
+                break
+            (size,) = struct.unpack_from(">Q", header, 8)
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size or offset + size > end:
+            break
+        boxes.append((box_type, offset, size, header_size))
+        offset += size
+
+    return boxes
+
+
+def _read_at(stream, offset, size):
+    stream.seek(offset)
+    return stream.read(size)
+
+
+def index_fragmented(stream, boxes=None):
+    """
+    Split a fragmented MP4 file object into (ftyp, moov, [(moof, mdat)])
+    without reading its media data: each mdat is the (offset, size) of the
+    box in the file. boxes defaults to all of scan_boxes(stream), and a
+    truncated box at the end is an error.
+    """
+    if boxes is None:
+        boxes = scan_boxes(stream)
+        end = boxes[-1][1] + boxes[-1][2] if boxes else 0
+        if end != stream.seek(0, os.SEEK_END):
+            raise FragmentError("Truncated box at {}".format(end))
+
+    ftyp = moov = None
+    fragments = []
+    moof = None
+    for box_type, offset, size, header_size in boxes:
+        if box_type == b"ftyp":
+            ftyp = _read_at(stream, offset, size)
+        elif box_type == b"moov":
+            moov = _read_at(stream, offset, size)
+        elif box_type == b"moof":
+            moof = _read_at(stream, offset, size)
+        elif box_type == b"mdat" and moof is not None:
+            fragments.append((moof, (offset, size)))
+            moof = None
+
+    if ftyp is None or moov is None:
+        raise FragmentError("Missing ftyp/moov")
+    if find_box(moov, [b"moov", b"mvex"]) is None:
+        raise FragmentError("Not a fragmented MP4")
+
+    return ftyp, moov, fragments
+
+
+def copy_range(source, dest, offset, size):
+    """
+    Copy size bytes at offset in the file object source to dest.
+    """
+    source.seek(offset)
+    while size > 0:
+        block = source.read(min(size, COPY_BLOCK_SIZE))
+        if not block:
+            raise FragmentError("{} ended early".format(source.name))
+        dest.write(block)
+        size -= len(block)
+
+
+def write_fragments(video, fragments, media=None):
+    """
+    Write [(moof, mdat)] to video. An mdat is either the box itself, or the
+    (offset, size) of the box in the file object media.
+    """
+    for moof, mdat in fragments:
+        video.write(moof)
+        if media is None:
+            video.write(mdat)
+        else:
+            copy_range(media, video, *mdat)
+
+
+def _sample_description(moov):
+    stsd = find_box(moov, [b"moov", b"trak", b"mdia", b"minf", b"stbl", b"stsd"])
+    if stsd is None:
+        raise FragmentError("Missing stsd")
+    offset, size, header_size = stsd
+    return moov[offset : offset + size]
+
+
+def _timescales(moov):
+    mvhd = find_box(moov, [b"moov", b"mvhd"])
+    payload = _payload(mvhd)
+    if moov[payload] == 1:
+        (movie_timescale,) = struct.unpack_from(">I", moov, payload + 20)
+    else:
+        (movie_timescale,) = struct.unpack_from(">I", moov, payload + 12)
+
+    mdhd = find_box(moov, [b"moov", b"trak", b"mdia", b"mdhd"])
+    payload = _payload(mdhd)
+    if moov[payload] == 1:
+        (track_timescale,) = struct.unpack_from(">I", moov, payload + 20)
+    else:
+        (track_timescale,) = struct.unpack_from(">I", moov, payload + 12)
+
+    return movie_timescale, track_timescale
+
+
+def _add_mehd(moov):
+    """
+    Return moov with an empty version 1 mehd box at the start of mvex, so
+    the total duration can later be updated in place.
+    """
+    existing = find_box(moov, [b"moov", b"mvex", b"mehd"])
+    if existing is not None and moov[_payload(existing)] == 1:
+        return moov
+
+    moov = bytearray(moov)
+    if existing is not None:
+        # 32-bit mehd, replace it with a 64-bit one
+        offset, size, header_size = existing
+        del moov[offset : offset + size]
+        mvex_offset, mvex_size, mvex_header = find_box(moov, [b"moov", b"mvex"])
+        struct.pack_into(">I", moov, mvex_offset, mvex_size - size)
+        struct.pack_into(">I", moov, 0, len(moov))
+
+    mehd = struct.pack(">I4sIQ", 20, b"mehd", 0x01000000, 0)
+    mvex_offset, mvex_size, mvex_header = find_box(moov, [b"moov", b"mvex"])
+    if mvex_header != 8 or len(moov) + len(mehd) >= 1 << 32:
+        raise FragmentError("Unsupported moov layout")
+
+    moov[mvex_offset + 8 : mvex_offset + 8] = mehd
+    struct.pack_into(">I", moov, mvex_offset, mvex_size + len(mehd))
+    struct.pack_into(">I", moov, 0, len(moov))
+    return bytes(moov)
+
+
+class FragmentedVideo:
+    """
+    A fragmented MP4 that chunks can be appended to in O(chunk size).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.state_path = "{}.state".format(path)
+        self.state = None
+        if os.path.exists(self.state_path) and os.path.exists(self.path):
+            with open(self.state_path, "r") as state_file:
+                self.state = json.load(state_file)
+
+    def is_tracked(self):
+        return self.state is not None
+
+    def replace(self, source_path):
+        """
+        Atomically replace the video with the fragmented MP4 source_path.
+        """
+        with open(source_path, "rb") as source:
+            ftyp, moov, fragments = index_fragmented(source)
+            self._create(ftyp, moov, fragments, media=source)
+
+    def _save_state(self):
+        write_atomic(self.state_path, json.dumps(self.state).encode("utf-8"))
+
+    def _init_state(self, ftyp, moov):
+        movie_timescale, track_timescale = _timescales(moov)
+        mvhd = find_box(moov, [b"moov", b"mvhd"])
+        mehd = find_box(moov, [b"moov", b"mvex", b"mehd"])
+
+        self.state = {
+            "sequence": 0,
+            "decode_time": 0,
+            "size": len(ftyp) + len(moov),
+            "movie_timescale": movie_timescale,
+            "track_timescale": track_timescale,
+            "default_duration": _trex_duration(moov),
+            "mvhd_offset": len(ftyp) + _payload(mvhd),
+            "mehd_offset": len(ftyp) + _payload(mehd),
+            "sample_description": _sample_description(moov).hex(),
+            "source": None,
+        }
+
+    def _renumber(self, fragments, start_time, default_duration):
+        """
+        Renumber fragments so they continue from the current state, shifted
+        so the first one starts at start_time. Returns the renumbered
+        [(moof, mdat)].
+        """
+        renumbered = []
+        sequence = self.state["sequence"]
+        end_time = start_time
+        if fragments:
+            offset = start_time - fragment_decode_time(fragments[0][0])
+        for moof, mdat in fragments:
+            sequence += 1
+            renumbered.append((renumber_fragment(moof, sequence, offset), mdat))
+            end_time = max(
+                end_time,
+                fragment_decode_time(moof)
+                + offset
+                + fragment_duration(moof, default_duration),
+            )
+
+        self.state["sequence"] = sequence
+        self.state["decode_time"] = end_time
+        return renumbered
+
+    def _create(self, ftyp, moov, fragments=(), source=None, media=None):
+        """
+        Write a new video (atomically) from an init segment and fragments,
+        whose mdats are in media if given (see write_fragments).
+        """
+        # A stale state file must never describe the new video
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+
+        moov = _add_mehd(moov)
+        self._init_state(ftyp, moov)
+
+        if fragments:
+            start_time = fragment_decode_time(fragments[0][0])
+            fragments = self._renumber(fragments, start_time, _trex_duration(moov))
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)))
+        try:
+            with os.fdopen(fd, "wb") as video:
+                video.write(ftyp)
+                video.write(moov)
+                write_fragments(video, fragments, media)
+                self.state["size"] = video.tell()
+                video.flush()
+                os.fsync(video.fileno())
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        os.replace(tmp_path, self.path)
+
+        self.state["source"] = source
+        self._write_duration()
+        self._save_state()
+
+    def rebuild_state(self):
+        """
+        Recover the state of an existing fragmented video by scanning it.
+        Anything after the last complete box is dropped by the next append.
+        """
+        with open(self.path, "rb") as video:
+            boxes = scan_boxes(video)
+            ftyp, moov, fragments = index_fragmented(video, boxes)
+
+            mehd = find_box(moov, [b"moov", b"mvex", b"mehd"])
+            written_here = (
+                mehd is not None
+                and moov[_payload(mehd)] == 1
+                and [box[0] for box in boxes[:2]] == [b"ftyp", b"moov"]
+            )
+            if not written_here:
+                # Videos from ffmpeg need a 64-bit mehd box, which means
+                # rewriting them once
+                self._create(ftyp, moov, fragments, media=video)
+                return
+
+        self._init_state(ftyp, moov)
+        if fragments:
+            last_moof = fragments[-1][0]
+            mfhd = find_box(last_moof, [b"moof", b"mfhd"])
+            (self.state["sequence"],) = struct.unpack_from(
+                ">I", last_moof, _payload(mfhd) + 4
+            )
+            self.state["decode_time"] = fragment_decode_time(
+                last_moof
+            ) + fragment_duration(last_moof, self.state["default_duration"])
+            mdat_offset, mdat_size = fragments[-1][1]
+            self.state["size"] = mdat_offset + mdat_size
+        self._save_state()
+
+    def _write_duration(self):
+        """
+        Update the duration in mvhd and mehd in place.
+        """
+        movie_duration = (
+            self.state["decode_time"]
+            * self.state["movie_timescale"]
+            // self.state["track_timescale"]
+        )
+
+        with open(self.path, "r+b") as video:
+            video.seek(self.state["mehd_offset"] + 4)
+            video.write(struct.pack(">Q", movie_duration))
+            video.seek(self.state["mvhd_offset"])
+            if video.read(1) == b"\x01":
+                video.seek(self.state["mvhd_offset"] + 24)
+                video.write(struct.pack(">Q", movie_duration))
+            else:
+                video.seek(self.state["mvhd_offset"] + 16)
+                video.write(struct.pack(">I", min(movie_duration, 0xFFFFFFFF)))
+
+    def append(self, chunk_path, source=None):
+        """
+        Append the fragments of chunk_path (a fragmented MP4 with the same
+        codec settings) to the video. Returns the number of bytes appended.
+        """
+        with open(chunk_path, "rb") as chunk_file:
+            ftyp, moov, fragments = index_fragmented(chunk_file)
+            return self.append_fragments(ftyp, moov, fragments, source, chunk_file)
+
+    def append_fragments(self, ftyp, moov, fragments, source=None, media=None):
+        """
+        Append [(moof, mdat)] fragments that use the init segment ftyp/moov,
+        with their mdats in media if given (see write_fragments).
+        source (e.g. the name of the last frame) is kept in the state file
+        so callers can tell what has already made it into the video.
+        """
+        if self.state is not None and os.path.getsize(self.path) < self.state["size"]:
+            # The video was replaced behind our back
+            self.state = None
+
+        if self.state is None:
+            if os.path.exists(self.path):
+                self.rebuild_state()
+            else:
+                self._create(ftyp, moov, fragments, source, media)
+                return os.path.getsize(self.path)
+
+        if _sample_description(moov).hex() != self.state["sample_description"]:
+            raise FragmentError("Chunk codec settings differ from the video")
+
+        if _timescales(moov)[1] != self.state["track_timescale"]:
+            raise FragmentError("Chunk timescale differs from the video")
+
+        size = self.state["size"]
+        fragments = self._renumber(
+            fragments, self.state["decode_time"], _trex_duration(moov)
+        )
+
+        with open(self.path, "r+b") as video:
+            # Drop anything left over from an interrupted append
+            video.truncate(size)
+            video.seek(size)
+            write_fragments(video, fragments, media)
+            end = video.tell()
+            video.flush()
+            os.fsync(video.fileno())
+
+        self._write_duration()
+        self.state["size"] = end
+        self.state["source"] = source
+        self._save_state()
+
+        return end - size
+
+    def sequence(self):
+        """
+        Sequence number of the last fragment in the video.
+        """
+        if self.state is None:
+            return 0
+        return self.state["sequence"]
+
+    def source(self):
+        if self.state is None:
+            return None
+        return self.state.get("source")
+
+    def duration(self):
+        if self.state is None:
+            return 0
+        return self.state["decode_time"] / self.state["track_timescale"]
@@ -0,0 +1,194 @@
+"""
+Drop bad frames and collapse runs of near identical ones before they are
+resized and encoded.
+
+Each photo is decoded once at 1/8 scale in grayscale. For a JPEG that
+only needs the DC coefficient of every 8x8 block, so it costs a fraction
+of a full decode. The thumbnail gives the photo's mean and standard
+deviation and a 64 bit difference hash (dHash) of its structure.
+
+A timelapse with frame_filter: true then rejects a photo that is
+
+- flat: standard deviation below reject_flat (default 2), e.g. the black
+  or grey frame of a failed capture
+- dark: mean below reject_dark (off by default, night frames are dark)
+- bright: mean above reject_bright (default 250), overexposed
+- a duplicate: its hash is within duplicate_distance bits (default 4) of
+  one of the last duplicate_window frames that were kept (default fps),
+  and no pixel of their 64x64 thumbnails differs by more than
+  duplicate_difference (default 4). A still night collapses into a few
+  frames, while a small cloud moving, which barely changes the hash, is
+  kept. Set duplicate_distance: null to keep duplicates.
+
+The recent hashes are indexed by duplicate_distance + 1 bands of bits.
+Two hashes within duplicate_distance bits of each other have at least one
+band in common, so a photo is only compared with the few kept frames that
+share a band, not the whole window.
+"""
+
+import collections
+
+from PIL import Image, ImageChops, ImageStat
+
+HASH_SIZE = 8
+
+THUMBNAIL_SIZE = (64, 64)
+
+# Neighbours closer than this count as equal, so the noise in flat areas
+# (e.g. a night sky) doesn't change the hash
+HASH_MARGIN = 2
+
+
+class PhotoStats:
+    def __init__(self, mean, stddev, dhash, thumbnail):
+        self.mean = mean
+        self.stddev = stddev
+        self.dhash = dhash
+        self.thumbnail = thumbnail
+
+    def difference(self, other):
+        """
+        Largest difference between the thumbnails of two photos.
+        """
+        return ImageChops.difference(self.thumbnail, other.thumbnail).getextrema()[1]
+
+
+def difference_hash(image, size=HASH_SIZE):
+    """
+    64 bit dHash of a grayscale image: one bit per pixel of a (size + 1) x
+    size thumbnail, set where it is brighter than its right neighbour.
+    """
+    pixels = list(image.resize((size + 1, size), Image.BOX).getdata())
+    value = 0
+    for row in range(size):
+        for column in range(size):
+            left = pixels[row * (size + 1) + column]
+            right = pixels[row * (size + 1) + column + 1]
+            value = (value << 1) | (left > right + HASH_MARGIN)
+    return value
+
+
+def analyze(photo_path):
+    """
+    PhotoStats of photo_path, from its JPEG DC coefficients.
+    """
+    with Image.open(photo_path) as image:
+        image.draft("L", (image.size[0] // 8, image.size[1] // 8))
+        decoded = image.convert("L")
+    try:
+        stat = ImageStat.Stat(decoded)
+        return PhotoStats(
+            stat.mean[0],
+            stat.stddev[0],
+            difference_hash(decoded),
+            decoded.resize(THUMBNAIL_SIZE, Image.BOX),
+        )
+    finally:
+        decoded.close()
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+class HashIndex:
+    """
+    The PhotoStats of the last size frames, looked up by hash band.
+    """
+
+    def __init__(self, distance, size, bits=HASH_SIZE * HASH_SIZE):
+        self.distance = distance
+        self.size = size
+        bands = distance + 1
+        self.bands = [
+            (bits * band // bands, bits * (band + 1) // bands - bits * band // bands)
+            for band in range(bands)
+        ]
+        self.recent = collections.deque()
+        self.buckets = {}
+
+    def keys(self, value):
+        return [
+            (band, (value >> shift) & ((1 << width) - 1))
+            for band, (shift, width) in enumerate(self.bands)
+        ]
+
+    def near(self, stats):
+        """
+        The recent PhotoStats with a hash within distance bits of stats'.
+        """
+        found = set()
+        for key in self.keys(stats.dhash):
+            for other in self.buckets.get(key, ()):
+                if other not in found and (
+                    hamming(stats.dhash, other.dhash) <= self.distance
+                ):
+                    found.add(other)
+                    yield other
+
+    def add(self, stats):
+        self.recent.append(stats)
+        for key in self.keys(stats.dhash):
+            self.buckets.setdefault(key, set()).add(stats)
+
+        if len(self.recent) > self.size:
+            old = self.recent.popleft()
+            for key in self.keys(old.dhash):
+                bucket = self.buckets[key]
+                bucket.discard(old)
+                if not bucket:
+                    del self.buckets[key]
+
+
+class FrameFilter:
+    """
+    Decides which photos a timelapse keeps. check() has to see the photos
+    in order.
+    """
+
+    def __init__(self, config):
+        self.flat = config.get("reject_flat", 2)
+        self.dark = config.get("reject_dark")
+        self.bright = config.get("reject_bright", 250)
+        self.difference = config.get("duplicate_difference", 4)
+        self.index = None
+        if config.get("duplicate_distance", 4) is not None:
+            self.index = HashIndex(
+                config.get("duplicate_distance", 4),
+                config.get("duplicate_window", config["fps"]),
+            )
+        # Photos kept recently, so one queued twice isn't its own duplicate
+        self.kept = collections.deque(maxlen=64)
+        self.rejected = collections.Counter()
+
+    def duplicate(self, stats):
+        return any(
+            stats.difference(other) <= self.difference
+            for other in self.index.near(stats)
+        )
+
+    def check(self, photo, stats):
+        """
+        Return why photo should be rejected, or None to keep it.
+        """
+        if photo in self.kept:
+            return None
+
+        reason = None
+        if self.flat is not None and stats.stddev < self.flat:
+            reason = "flat"
+        elif self.dark is not None and stats.mean < self.dark:
+            reason = "dark"
+        elif self.bright is not None and stats.mean > self.bright:
+            reason = "bright"
+        elif self.index is not None and self.duplicate(stats):
+            reason = "duplicate"
+
+        if reason is not None:
+            self.rejected[reason] += 1
+            return reason
+
+        self.kept.append(photo)
+        if self.index is not None:
+            self.index.add(stats)
+        return None
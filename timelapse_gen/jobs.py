@@ -0,0 +1,153 @@
+"""
+Bounded job queue run by a pool of worker threads.
+
+Jobs submitted with the same key run one at a time in the order they were
+submitted, jobs with different keys (or no key) run in parallel. When the
+queue is full, submit() blocks, which holds back the watchdog thread
+instead of letting work pile up without limit.
+"""
+
+import collections
+import threading
+import time
+from concurrent.futures import Future
+
+from timelapse_metrics import metrics
+
+
+class Job:
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+        self.future = Future()
+        self.submitted = time.monotonic()
+
+
+class JobQueue:
+    def __init__(self, name, workers, max_depth):
+        self.name = name
+        self.max_depth = max_depth
+        self.condition = threading.Condition()
+        # key -> jobs waiting for that key, in order
+        self.queues = {}
+        # keys that have jobs waiting and none running
+        self.ready = collections.deque()
+        self.running = set()
+        self.depth = 0
+        self.closed = False
+
+        self.completed = 0
+        self.failed = 0
+        self.max_seen_depth = 0
+        self.blocked_time = 0
+        self.latencies = collections.deque(maxlen=1000)
+        self.wait_times = collections.deque(maxlen=1000)
+
+        self.threads = [
+            threading.Thread(
+                target=self._worker, name="{}-{}".format(name, index), daemon=True
+            )
+            for index in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, key, function, *args):
+        """
+        Queue function(*args) and return a Future for its result. Jobs
+        with key None have no ordering.
+        """
+        job = Job(function, args)
+        with self.condition:
+            start_time = time.monotonic()
+            while self.depth >= self.max_depth and not self.closed:
+                self.condition.wait()
+            self.blocked_time += time.monotonic() - start_time
+            if self.closed:
+                raise RuntimeError("{} queue is closed".format(self.name))
+
+            if key is None:
+                # Unordered jobs each get their own key
+                key = job
+            queue = self.queues.setdefault(key, collections.deque())
+            queue.append(job)
+            self.depth += 1
+            self.max_seen_depth = max(self.max_seen_depth, self.depth)
+            metrics.queue_depth(self.name, self.depth)
+            if len(queue) == 1 and key not in self.running:
+                self.ready.append(key)
+                self.condition.notify_all()
+        return job.future
+
+    def _next_job(self):
+        with self.condition:
+            while not self.ready:
+                if self.closed and self.depth == 0:
+                    return None, None
+                self.condition.wait()
+            key = self.ready.popleft()
+            self.running.add(key)
+            return key, self.queues[key].popleft()
+
+    def _worker(self):
+        while True:
+            key, job = self._next_job()
+            if job is None:
+                return
+
+            start_time = time.monotonic()
+            try:
+                job.future.set_result(job.function(*job.args))
+            except Exception as e:
+                print("{} job failed: {!r}".format(self.name, e))
+                job.future.set_exception(e)
+                self.failed += 1
+            end_time = time.monotonic()
+
+            with self.condition:
+                self.running.discard(key)
+                if self.queues[key]:
+                    self.ready.append(key)
+                else:
+                    del self.queues[key]
+                self.depth -= 1
+                metrics.queue_depth(self.name, self.depth)
+                self.completed += 1
+                self.wait_times.append(start_time - job.submitted)
+                self.latencies.append(end_time - job.submitted)
+                self.condition.notify_all()
+
+    def join(self):
+        """
+        Wait until every queued job has finished.
+        """
+        with self.condition:
+            while self.depth:
+                self.condition.wait()
+
+    def close(self):
+        """
+        Finish the queued jobs and stop the workers.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+    def stats(self):
+        """
+        Queue depth, and wait/latency percentiles (seconds) over the last
+        1000 jobs.
+        """
+        with self.condition:
+            return {
+                "depth": self.depth,
+                "max_depth": self.max_seen_depth,
+                "running": len(self.running),
+                "completed": self.completed,
+                "failed": self.failed,
+                "blocked_time": self.blocked_time,
+                "wait": metrics.percentiles(self.wait_times),
+                "latency": metrics.percentiles(self.latencies),
+            }
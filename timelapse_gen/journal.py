@@ -0,0 +1,158 @@
+"""
+Per timelapse journal of the photos that have been added to it.
+
+Each photo is recorded as "staged" when its resized frame is moved into
+out_tmp_dir, and as "encoded" (with the video fragment sequence number
+that holds it) once it is part of the video. Photos the frame filter drops
+are recorded as "rejected", and the photos that were already in src_dir
+when the journal was created as "skipped". On startup, the photos in
+src_dir that aren't in the journal are the ones left to add.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+STAGED = "staged"
+ENCODED = "encoded"
+REJECTED = "rejected"
+SKIPPED = "skipped"
+
+# Photos looked up per query, under SQLite's limit on query parameters
+LOOKUP_BATCH = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS frames (
+    photo TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    segment INTEGER,
+    added REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS frames_state ON frames (state);
+"""
+
+
+def journal_path(config):
+    return config.get(
+        "journal", os.path.join(config["out_dir"], "{}.journal".format(config["name"]))
+    )
+
+
+class Journal:
+    """
+    SQLite backed journal. Safe to use from several threads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.created = not os.path.exists(path)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        with self.lock:
+            # WAL with synchronous=NORMAL survives a crash of the process
+            # without an fsync per frame
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.executescript(SCHEMA)
+
+    def has(self, photo):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT 1 FROM frames WHERE photo = ?", (photo,)
+            ).fetchone()
+        return row is not None
+
+    def add(self, photo):
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO frames (photo, state, added) VALUES (?, ?, ?)",
+                (photo, STAGED, time.time()),
+            )
+
+    def reject(self, photo):
+        """
+        Record photo as handled without adding it. A photo that is already
+        in the journal is left as it is.
+        """
+        with self.lock:
+            self.db.execute(
+                "INSERT OR IGNORE INTO frames (photo, state, added) VALUES (?, ?, ?)",
+                (photo, REJECTED, time.time()),
+            )
+
+    def skip(self, photos):
+        """
+        Record photos as handled without adding them.
+        """
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN")
+            self.db.executemany(
+                "INSERT OR IGNORE INTO frames (photo, state, added) VALUES (?, ?, ?)",
+                [(photo, SKIPPED, now) for photo in photos],
+            )
+            self.db.execute("COMMIT")
+
+    def mark_encoded(self, photos, segment):
+        with self.lock:
+            self.db.execute("BEGIN")
+            self.db.executemany(
+                "UPDATE frames SET state = ?, segment = ? WHERE photo = ?",
+                [(ENCODED, segment, photo) for photo in photos],
+            )
+            self.db.execute("COMMIT")
+
+    def forget(self, photos):
+        with self.lock:
+            self.db.execute("BEGIN")
+            self.db.executemany(
+                "DELETE FROM frames WHERE photo = ?", [(photo,) for photo in photos]
+            )
+            self.db.execute("COMMIT")
+
+    def staged(self):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT photo FROM frames WHERE state = ? ORDER BY photo", (STAGED,)
+            ).fetchall()
+        return [photo for (photo,) in rows]
+
+    def rejected(self):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT photo FROM frames WHERE state = ?", (REJECTED,)
+            ).fetchall()
+        return {photo for (photo,) in rows}
+
+    def missing(self, photos):
+        """
+        The photos (in order) that aren't in the journal.
+        """
+        known = set()
+        with self.lock:
+            for start in range(0, len(photos), LOOKUP_BATCH):
+                batch = photos[start : start + LOOKUP_BATCH]
+                known.update(
+                    photo
+                    for (photo,) in self.db.execute(
+                        "SELECT photo FROM frames WHERE photo IN ({})".format(
+                            ",".join("?" * len(batch))
+                        ),
+                        batch,
+                    )
+                )
+        return [photo for photo in photos if photo not in known]
+
+    def watermark(self):
+        """
+        Name of the newest photo (in name order) that has been handled, or
+        None.
+        """
+        with self.lock:
+            (newest,) = self.db.execute("SELECT MAX(photo) FROM frames").fetchone()
+        return newest
+
+    def close(self):
+        with self.lock:
+            self.db.close()
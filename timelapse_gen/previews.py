@@ -0,0 +1,317 @@
+"""
+Poster, sprite sheet and preview clip for a timelapse, kept up to date as
+frames are added so the videos page never has to load the full video.
+
+One frame every preview_stride frames (default fps, so one per second of
+video) is sampled:
+
+- The poster is the newest sample.
+- The sprite sheet holds sprite_count thumbnails spread evenly over the
+  whole video. Samples are kept at a stride that doubles whenever twice as
+  many as needed have piled up, so only a bounded set of small thumbnails
+  is ever kept around.
+- The preview clip is a small, low bitrate video of every sample. It is
+  encoded preview_clip_fps samples at a time and appended like the main
+  video.
+
+Each output is published under a name derived from its content and listed
+in manifest.json, so it can be served with long lived cache headers.
+"""
+
+import hashlib
+import io
+import json
+import os
+import subprocess
+import time
+
+from PIL import Image
+
+import fmp4
+import resize
+from timelapse_metrics import metrics
+from v4l2.files import write_atomic
+
+PREVIEW_WIDTH = 320
+SPRITE_WIDTH = 160
+SPRITE_COUNT = 16
+SPRITE_COLUMNS = 4
+CLIP_FPS = 12
+CLIP_BITRATE = "150k"
+THUMB_QUALITY = 80
+
+
+def previews_dir(config):
+    return config.get(
+        "previews_dir",
+        os.path.join(config["out_dir"], "{}.previews".format(config["name"])),
+    )
+
+
+def scaled_size(resolution, width):
+    """
+    Size with the aspect ratio of resolution and at most width pixels wide.
+    Both sides are even, which yuv420p needs.
+    """
+    out_width, out_height = resize.parse_resolution(resolution)
+    width = min(width, out_width)
+    height = max(2, round(width * out_height / out_width / 2) * 2)
+    return width - width % 2, height
+
+
+def encode_jpeg(image):
+    data = io.BytesIO()
+    image.save(data, "JPEG", quality=THUMB_QUALITY)
+    return data.getvalue()
+
+
+class Previews:
+    def __init__(self, config):
+        self.config = config
+        self.dir = previews_dir(config)
+        self.work_dir = os.path.join(self.dir, "work")
+        os.makedirs(self.work_dir, exist_ok=True)
+
+        self.stride = config.get("preview_stride", config["fps"])
+        self.size = scaled_size(
+            config["resolution"], config.get("preview_width", PREVIEW_WIDTH)
+        )
+        self.sprite_size = scaled_size(config["resolution"], SPRITE_WIDTH)
+        self.sprite_count = config.get("sprite_count", SPRITE_COUNT)
+        self.clip_fps = config.get("preview_clip_fps", CLIP_FPS)
+        self.clip = fmp4.FragmentedVideo(os.path.join(self.work_dir, "clip.mp4"))
+
+        self.state_path = os.path.join(self.work_dir, "state.json")
+        self.state = {
+            "frames": 0,
+            "samples": 0,
+            "sprite_step": 1,
+            "sprite": [],
+            "clip_pending": [],
+            "manifest": {},
+            "previous": {},
+        }
+        if os.path.exists(self.state_path):
+            with open(self.state_path, "r") as state_file:
+                self.state.update(json.load(state_file))
+
+        self.samples = 0
+        self.update_time = 0
+
+    def manifest_path(self):
+        return os.path.join(self.dir, "manifest.json")
+
+    def add(self, frame_path):
+        """
+        Count a frame that was added to the timelapse, and sample it if it
+        is due.
+        """
+        index = self.state["frames"]
+        self.state["frames"] += 1
+        if index % self.stride:
+            return
+
+        start_time = time.monotonic()
+        sample = self.state["samples"]
+        self.state["samples"] += 1
+
+        image = resize.open_photo(frame_path, [self.size])
+        try:
+            thumb = image.resize(
+                self.size, Image.LANCZOS, box=resize.fill_box(image.size, self.size)
+            )
+        finally:
+            image.close()
+
+        try:
+            poster = encode_jpeg(thumb)
+            sprite_changed = self._add_sprite_thumb(sample, thumb)
+        finally:
+            thumb.close()
+
+        manifest = dict(self.state["manifest"])
+        manifest["poster"] = self._publish("poster", poster, "jpg")
+        if sprite_changed:
+            manifest.update(self._build_sprite())
+        if self._add_clip_frame(sample, poster):
+            manifest["clip"] = self._publish_clip()
+        manifest["frames"] = self.state["frames"]
+        self._save_manifest(manifest)
+
+        self.samples += 1
+        self.update_time += time.monotonic() - start_time
+
+    def _thumb_path(self, sample):
+        return os.path.join(self.work_dir, "sprite_{:08d}.jpg".format(sample))
+
+    def _add_sprite_thumb(self, sample, thumb):
+        step = self.state["sprite_step"]
+        if sample % step:
+            return False
+
+        sprite_thumb = thumb.resize(self.sprite_size, Image.LANCZOS)
+        try:
+            write_atomic(self._thumb_path(sample), encode_jpeg(sprite_thumb))
+        finally:
+            sprite_thumb.close()
+        self.state["sprite"].append(sample)
+
+        if len(self.state["sprite"]) > 2 * self.sprite_count:
+            # Keep every other one and halve the rate new ones are kept at
+            step *= 2
+            kept = []
+            for kept_sample in self.state["sprite"]:
+                if kept_sample % step:
+                    os.remove(self._thumb_path(kept_sample))
+                else:
+                    kept.append(kept_sample)
+            self.state["sprite"] = kept
+            self.state["sprite_step"] = step
+        return True
+
+    def _build_sprite(self):
+        kept = self.state["sprite"]
+        count = min(self.sprite_count, len(kept))
+        if count > 1:
+            picks = [
+                kept[round(i * (len(kept) - 1) / (count - 1))] for i in range(count)
+            ]
+        else:
+            picks = kept[:count]
+
+        columns = min(SPRITE_COLUMNS, count)
+        rows = -(-count // columns)
+        width, height = self.sprite_size
+        sheet = Image.new("RGB", (columns * width, rows * height))
+        try:
+            for position, sample in enumerate(picks):
+                with Image.open(self._thumb_path(sample)) as thumb:
+                    sheet.paste(
+                        thumb,
+                        ((position % columns) * width, (position // columns) * height),
+                    )
+            sprite = self._publish("sprite", encode_jpeg(sheet), "jpg")
+        finally:
+            sheet.close()
+
+        return {
+            "sprite": sprite,
+            "sprite_count": count,
+            "sprite_columns": columns,
+            "thumb_width": width,
+            "thumb_height": height,
+        }
+
+    def _add_clip_frame(self, sample, data):
+        """
+        Queue a frame for the clip. Returns True once the clip has grown.
+        """
+        name = "clip_{:08d}.jpg".format(sample)
+        write_atomic(os.path.join(self.work_dir, name), data)
+        self.state["clip_pending"].append(name)
+        if len(self.state["clip_pending"]) < self.clip_fps:
+            return False
+
+        pending = self.state["clip_pending"]
+        self.state["clip_pending"] = []
+        try:
+            return self._append_clip(
+                [os.path.join(self.work_dir, name) for name in pending]
+            )
+        finally:
+            for name in pending:
+                os.remove(os.path.join(self.work_dir, name))
+
+    def _append_clip(self, frame_paths):
+        chunk_path = os.path.join(self.work_dir, "clip_chunk.mp4")
+        frames = b""
+        for frame_path in frame_paths:
+            with open(frame_path, "rb") as frame:
+                frames += frame.read()
+
+        result = metrics.run(
+            [
+                "ffmpeg",
+                "-y",
+                "-f",
+                "image2pipe",
+                "-framerate",
+                str(self.clip_fps),
+                "-c:v",
+                "mjpeg",
+                "-i",
+                "pipe:0",
+                "-vcodec",
+                "libx264",
+                "-pix_fmt",
+                "yuv420p",
+                "-b:v",
+                CLIP_BITRATE,
+                "-maxrate",
+                CLIP_BITRATE,
+                "-bufsize",
+                CLIP_BITRATE,
+                "-g",
+                str(self.clip_fps),
+                "-movflags",
+                "+frag_keyframe+empty_moov+default_base_moof",
+                "-video_track_timescale",
+                str(self.clip_fps * 1000),
+                chunk_path,
+            ],
+            input=frames,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        if result.returncode:
+            print(result.stderr.decode("utf-8"))
+            print("Error encoding preview clip for {}".format(self.config["name"]))
+            return False
+
+        try:
+            self.clip.append(chunk_path)
+        except fmp4.FragmentError as e:
+            # e.g. the resolution changed. Start the clip over
+            print("Restarting preview clip for {} ({})".format(self.config["name"], e))
+            self.clip.replace(chunk_path)
+        os.remove(chunk_path)
+        return True
+
+    def _publish_clip(self):
+        with open(self.clip.path, "rb") as clip:
+            return self._publish("clip", clip.read(), "mp4")
+
+    def _publish(self, kind, data, extension):
+        name = "{}-{}.{}".format(kind, hashlib.sha256(data).hexdigest()[:16], extension)
+        path = os.path.join(self.dir, name)
+        if not os.path.exists(path):
+            write_atomic(path, data)
+        return name
+
+    def _save_manifest(self, manifest):
+        # Save the state first: a published file the state doesn't know
+        # about is only cleaned up later, a missing one would break pages
+        if manifest != self.state["manifest"]:
+            self.state["previous"] = self.state["manifest"]
+            self.state["manifest"] = manifest
+        write_atomic(self.state_path, json.dumps(self.state).encode("utf-8"))
+        write_atomic(
+            self.manifest_path(), json.dumps(manifest, sort_keys=True).encode("utf-8")
+        )
+
+        # Pages rendered from the previous manifest may still load its files
+        referenced = set(manifest.values()) | set(self.state["previous"].values())
+        for entry in os.scandir(self.dir):
+            if entry.is_file() and entry.name.split("-")[0] in (
+                "poster",
+                "sprite",
+                "clip",
+            ):
+                if entry.name not in referenced:
+                    os.remove(entry.path)
+
+    def stats(self):
+        return {
+            "samples": self.samples,
+            "update_time": self.update_time / max(self.samples, 1),
+        }
@@ -0,0 +1,102 @@
+"""
+Encoder profiles: which ffmpeg encoder makes the timelapse chunks and how.
+
+A timelapse picks one with encoder_profile, either the name of a profile
+below or a dict of the same keys:
+
+    codec    ffmpeg encoder, e.g. libx264, libx265 or h264_v4l2m2m (the
+             Raspberry Pi's hardware encoder)
+    preset   encoder speed/size trade off (x264/x265 presets)
+    tune     e.g. stillimage, which suits timelapses
+    crf      constant quality, lower is better
+    bitrate  target bitrate, for encoders without crf (e.g. hardware ones)
+    threads  encoder threads, 0 lets the encoder decide
+
+bench_profiles.py reports speed, size and quality for each profile.
+"""
+
+import subprocess
+
+from timelapse_metrics import metrics
+
+DEFAULT_PROFILE = "default"
+
+PROFILES = {
+    # What timelapse_gen has always used: libx264's defaults
+    "default": {"codec": "libx264"},
+    "fast": {"codec": "libx264", "preset": "veryfast", "tune": "stillimage", "crf": 23},
+    "small": {"codec": "libx264", "preset": "slow", "tune": "stillimage", "crf": 26},
+    "archive": {"codec": "libx264", "preset": "medium", "crf": 18},
+    "hevc": {"codec": "libx265", "preset": "fast", "crf": 28},
+    "v4l2m2m": {"codec": "h264_v4l2m2m", "bitrate": "4M"},
+}
+
+_encoders = None
+
+
+def get_profile(config):
+    """
+    The encoder profile of a timelapse config.
+    """
+    profile = config.get("encoder_profile", DEFAULT_PROFILE)
+    if isinstance(profile, dict):
+        return dict(PROFILES[DEFAULT_PROFILE], **profile)
+    if profile not in PROFILES:
+        raise ValueError(
+            "Unknown encoder profile {} (use {} or a dict)".format(
+                profile, ", ".join(sorted(PROFILES))
+            )
+        )
+    return PROFILES[profile]
+
+
+def select_profile(config):
+    """
+    get_profile(), or the default profile if this ffmpeg doesn't have the
+    profile's encoder (e.g. a hardware encoder on another machine).
+    """
+    profile = get_profile(config)
+    if profile["codec"] not in available_encoders():
+        print(
+            "ffmpeg has no {} encoder, using the {} profile for {}".format(
+                profile["codec"], DEFAULT_PROFILE, config["name"]
+            )
+        )
+        return PROFILES[DEFAULT_PROFILE]
+    return profile
+
+
+def video_options(profile):
+    """
+    ffmpeg output options for profile.
+    """
+    options = ["-vcodec", profile["codec"], "-pix_fmt", "yuv420p"]
+    for key, option in (
+        ("preset", "-preset"),
+        ("tune", "-tune"),
+        ("crf", "-crf"),
+        ("bitrate", "-b:v"),
+        ("threads", "-threads"),
+    ):
+        if profile.get(key) is not None:
+            options += [option, str(profile[key])]
+    return options
+
+
+def available_encoders():
+    """
+    Names of the video encoders this ffmpeg was built with.
+    """
+    global _encoders
+    if _encoders is None:
+        result = metrics.run(
+            ["ffmpeg", "-hide_banner", "-encoders"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        _encoders = set()
+        for line in result.stdout.decode("utf-8").splitlines():
+            fields = line.split()
+            if len(fields) > 1 and fields[0].startswith("V"):
+                _encoders.add(fields[1])
+    return _encoders
@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+"""
+Render a clip of a time range of a timelapse's photos, optionally keeping
+only one photo per stride (e.g. one an hour over a year).
+
+    ./render.py config.yml timelapse_1080 --start -24h --output last_day.mp4
+    ./render.py config.yml timelapse_1080 --start 2024-01-01 --end 2025-01-01 \\
+        --stride 1h --output year.mp4
+
+Frames are picked from the time index (see timeindex.py). They are split
+into segments of about segment_frames frames that start at fixed points in
+time, which are encoded in parallel and joined without re-encoding.
+Segments and whole renders are cached in render_cache under a hash of what
+went into them, so a repeated query is a file copy and a moving one ("the
+last 24 hours") only encodes its ends.
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import re
+import shutil
+import subprocess
+import time
+import yaml
+from datetime import datetime
+from timelapse_metrics import metrics
+
+import profiles
+import timeindex
+from jobs import JobQueue
+from journal import Journal, journal_path
+
+SEGMENT_FRAMES = 240
+
+# Stride slots and segments start at UTC midnight. The local UTC offset
+# changes with daylight saving time, which would move every segment (and
+# miss the cache) twice a year
+ANCHOR = 0
+
+CACHE_SIZE = 2 * 1024**3
+
+UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+
+def parse_duration(value):
+    """
+    Seconds in e.g. 90, 90s, 15m, 1h, 2d or 1w.
+    """
+    match = re.fullmatch(r"([0-9.]+)([smhdw]?)", value.strip())
+    if match is None:
+        raise ValueError("Invalid duration {}".format(value))
+    return float(match.group(1)) * UNITS[match.group(2) or "s"]
+
+
+def parse_time(value, now=None):
+    """
+    Seconds since the epoch of a local ISO date/time, or of a duration
+    before now (e.g. -24h).
+    """
+    if value.startswith("-"):
+        return (time.time() if now is None else now) - parse_duration(value[1:])
+    return time.mktime(datetime.fromisoformat(value).timetuple())
+
+
+def render_cache_path(config):
+    return config.get(
+        "render_cache",
+        os.path.join(config["out_dir"], "{}.renders".format(config["name"])),
+    )
+
+
+def cache_key(*parts):
+    return hashlib.sha1(json.dumps(parts).encode("utf-8")).hexdigest()[:20]
+
+
+class Renderer:
+    """
+    Renders clips of one timelapse's photos.
+    """
+
+    def __init__(self, config, workers=None):
+        self.config = config
+        self.cache_dir = render_cache_path(config)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.cache_size = config.get("render_cache_size", CACHE_SIZE)
+        self.profile = profiles.select_profile(config)
+        self.index = timeindex.TimeIndex(
+            timeindex.time_index_path(config), config["src_dir"]
+        )
+        self.queue = JobQueue(
+            "render", workers or os.cpu_count(), config.get("queue_depth", 64)
+        )
+
+        self.segments = 0
+        self.cached_segments = 0
+
+    def rejected(self):
+        """
+        Photos the timelapse's frame filter rejected.
+        """
+        path = journal_path(self.config)
+        if not os.path.exists(path):
+            return set()
+        journal = Journal(path)
+        try:
+            return journal.rejected()
+        finally:
+            journal.close()
+
+    def frames(self, start=None, end=None, stride=None):
+        """
+        [(photo, time)] a render of start to end at stride would use.
+        """
+        added, removed = self.index.update()
+        if added or removed:
+            print("Time index: {} photos added, {} removed".format(added, removed))
+        return self.index.frames(start, end, stride, ANCHOR, exclude=self.rejected())
+
+    def split(self, frames, stride):
+        """
+        Group frames into segments that start at fixed points in time.
+        """
+        if not stride:
+            # The photo interval, rounded to a power of two so that the
+            # segments don't move with the query
+            gaps = sorted(b[1] - a[1] for a, b in zip(frames, frames[1:]))
+            gap = gaps[len(gaps) // 2] if gaps else 1
+            stride = 2 ** round(math.log2(max(gap, 1)))
+        span = stride * self.config.get("segment_frames", SEGMENT_FRAMES)
+
+        segments = []
+        last = None
+        for photo, taken in frames:
+            number = int((taken - ANCHOR) // span)
+            if number != last:
+                segments.append([])
+                last = number
+            segments[-1].append(photo)
+        return segments
+
+    def render_segment(self, photos, resolution, fps, path):
+        list_path = "{}.txt".format(path)
+        with open(list_path, "w") as list_file:
+            for photo in photos:
+                list_file.write(
+                    "file '{}'\n".format(os.path.join(self.config["src_dir"], photo))
+                )
+
+        width, height = resolution.split("x")
+        tmp_path = "{}.tmp".format(path)
+        try:
+            result = metrics.run(
+                [
+                    "ffmpeg",
+                    "-f",
+                    "concat",
+                    "-r",
+                    str(fps),
+                    "-safe",
+                    "0",
+                    "-y",
+                    "-i",
+                    list_path,
+                    "-vf",
+                    "scale={}:{}:force_original_aspect_ratio=increase:flags=lanczos,"
+                    "crop={}:{}".format(width, height, width, height),
+                ]
+                + profiles.video_options(self.profile)
+                + ["-f", "mp4", tmp_path],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+        finally:
+            os.remove(list_path)
+
+        if result.returncode:
+            print(result.stderr.decode("utf-8"))
+            raise OSError("Error rendering {}".format(path))
+        os.replace(tmp_path, path)
+        return path
+
+    def join(self, segments, path):
+        if len(segments) == 1:
+            shutil.copyfile(segments[0], path)
+            return path
+
+        list_path = "{}.txt".format(path)
+        with open(list_path, "w") as list_file:
+            for segment in segments:
+                list_file.write("file '{}'\n".format(segment))
+
+        tmp_path = "{}.tmp".format(path)
+        try:
+            result = metrics.run(
+                [
+                    "ffmpeg",
+                    "-f",
+                    "concat",
+                    "-safe",
+                    "0",
+                    "-y",
+                    "-i",
+                    list_path,
+                    "-c",
+                    "copy",
+                    "-movflags",
+                    "+faststart",
+                    "-f",
+                    "mp4",
+                    tmp_path,
+                ],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+        finally:
+            os.remove(list_path)
+
+        if result.returncode:
+            print(result.stderr.decode("utf-8"))
+            raise OSError("Error joining {}".format(path))
+        os.replace(tmp_path, path)
+        return path
+
+    def render(
+        self, start=None, end=None, stride=None, outfile=None, resolution=None, fps=None
+    ):
+        """
+        Render the photos taken in [start, end) (seconds since the epoch,
+        None for no limit), one per stride seconds if given. Returns the
+        path of the clip (outfile, or the one in the cache), or None if
+        no photos match.
+        """
+        resolution = resolution or self.config["resolution"]
+        fps = fps or self.config["fps"]
+        options = [resolution, fps, profiles.video_options(self.profile)]
+
+        start_time = time.monotonic()
+        frames = self.frames(start, end, stride)
+        if not frames:
+            print("No photos between {} and {}".format(start, end))
+            return None
+
+        segments = self.split(frames, stride)
+        keys = [cache_key(options, photos) for photos in segments]
+        path = os.path.join(self.cache_dir, "render-{}.mp4".format(cache_key(keys)))
+        if os.path.exists(path):
+            print("Render of {} frames cached in {}".format(len(frames), path))
+            self.touch(path)
+        else:
+            paths = []
+            futures = []
+            for photos, key in zip(segments, keys):
+                segment = os.path.join(self.cache_dir, "segment-{}.mp4".format(key))
+                paths.append(segment)
+                self.segments += 1
+                if os.path.exists(segment):
+                    self.cached_segments += 1
+                    self.touch(segment)
+                    continue
+                futures.append(
+                    self.queue.submit(
+                        None, self.render_segment, photos, resolution, fps, segment
+                    )
+                )
+            for future in futures:
+                future.result()
+            self.join(paths, path)
+            print(
+                "Rendered {} frames in {} segments ({} cached) in {:.1f}s".format(
+                    len(frames),
+                    len(paths),
+                    len(paths) - len(futures),
+                    time.monotonic() - start_time,
+                )
+            )
+
+        self.trim_cache(keep=path)
+        if outfile is None:
+            return path
+        shutil.copyfile(path, outfile)
+        return outfile
+
+    def touch(self, path):
+        # The cache is trimmed least recently used first
+        os.utime(path)
+
+    def trim_cache(self, keep=None):
+        """
+        Remove the least recently used files until the cache fits in
+        render_cache_size.
+        """
+        entries = sorted(
+            (entry.stat().st_mtime, entry.stat().st_size, entry.path)
+            for entry in os.scandir(self.cache_dir)
+            if entry.name.endswith(".mp4")
+        )
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.cache_size:
+                break
+            if path != keep:
+                os.remove(path)
+                total -= size
+
+    def close(self):
+        self.queue.close()
+        self.index.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config", help="Config file location")
+    parser.add_argument("timelapse", help="Name of the timelapse in the config")
+    parser.add_argument(
+        "--start", help="Local ISO date/time, or a duration ago (e.g. -24h)"
+    )
+    parser.add_argument("--end", help="Same as --start, default now")
+    parser.add_argument("--stride", help="One photo per stride (e.g. 1h, 1d)")
+    parser.add_argument("--resolution", help="Default: the timelapse's")
+    parser.add_argument("--fps", type=int, help="Default: the timelapse's")
+    parser.add_argument("--workers", type=int, help="Segments encoded at once")
+    parser.add_argument("--output", help="Default: print the path in the cache")
+    args = parser.parse_args()
+
+    with open(args.config, "r") as config_file:
+        config = yaml.safe_load(config_file)
+    timelapses = {timelapse["name"]: timelapse for timelapse in config["timelapses"]}
+    if args.timelapse not in timelapses:
+        raise Exception(
+            "No timelapse {} in {} (there is {})".format(
+                args.timelapse, args.config, ", ".join(sorted(timelapses))
+            )
+        )
+
+    renderer = Renderer(timelapses[args.timelapse], args.workers)
+    try:
+        path = renderer.render(
+            parse_time(args.start) if args.start else None,
+            parse_time(args.end) if args.end else None,
+            parse_duration(args.stride) if args.stride else None,
+            args.output,
+            args.resolution,
+            args.fps,
+        )
+        if path is not None:
+            print(path)
+    finally:
+        renderer.close()
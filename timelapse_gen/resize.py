@@ -0,0 +1,141 @@
+"""
+In-process replacement for
+
+    convert photo.jpg -resize WxH^ -gravity center -extent WxH out.jpg
+
+The photo is scaled to fill WxH and the overflow is cropped evenly from
+both sides. When the output is at least 2x smaller than the photo, the
+JPEG is decoded at 1/2, 1/4 or 1/8 scale (draft mode), which skips most
+of the decode work.
+"""
+
+import os
+
+from PIL import Image
+
+DEFAULT_QUALITY = 92
+
+# Pillow frees image memory as soon as an image is closed. Keeping a few
+# blocks in its arena lets every frame reuse the memory of the last one
+# instead of allocating (and page faulting) a full frame each time.
+ARENA_BLOCKS = 16
+
+
+def parse_resolution(resolution):
+    width, height = resolution.lower().split("x")
+    return int(width), int(height)
+
+
+def fill_scale(source_size, size):
+    """
+    Scale that makes source_size fill size.
+    """
+    return max(size[0] / source_size[0], size[1] / source_size[1])
+
+
+def fill_box(source_size, size):
+    """
+    Return the (left, top, right, bottom) box of source_size that, scaled
+    to size, fills it exactly with the centre kept.
+    """
+    source_width, source_height = source_size
+    scale = fill_scale(source_size, size)
+    crop_width = size[0] / scale
+    crop_height = size[1] / scale
+    left = (source_width - crop_width) / 2
+    top = (source_height - crop_height) / 2
+    return (left, top, left + crop_width, top + crop_height)
+
+
+def decode(image, sizes):
+    """
+    Decode image (opened but not loaded) once so it can be resized to every
+    size in sizes. JPEGs at least 2x larger than all of them are decoded at
+    the smallest 1/2^n scale that still fills the largest one.
+    """
+    scale = max(fill_scale(image.size, size) for size in sizes)
+    if scale <= 0.5 and image.format == "JPEG":
+        source_width, source_height = image.size
+        image.draft(
+            "RGB", (int(source_width * scale) + 1, int(source_height * scale) + 1)
+        )
+
+    image.load()
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    return image
+
+
+def open_photo(file_path, sizes):
+    """
+    Open and decode file_path once for every size in sizes. The caller
+    closes the returned image.
+    """
+    return decode(Image.open(file_path), sizes)
+
+
+class Resizer:
+    """
+    Resize JPEGs to a fixed resolution.
+    """
+
+    def __init__(self, resolution, quality=DEFAULT_QUALITY):
+        self.size = parse_resolution(resolution)
+        self.quality = quality
+
+        if Image.core.get_blocks_max() < ARENA_BLOCKS:
+            Image.core.set_blocks_max(ARENA_BLOCKS)
+
+        self.frames = 0
+        self.draft_frames = 0
+
+    def resize_decoded(self, image, outfile):
+        """
+        Resize a decoded image (see decode()) into outfile. EXIF data
+        (DateTimeOriginal) is kept. The output is written to a temporary
+        file and renamed so a partial frame is never left behind.
+        """
+        resized = self.resize_image(image)
+        try:
+            self.save(resized, outfile, image.info)
+        finally:
+            resized.close()
+
+    def resize_image(self, image):
+        """
+        Resize a decoded image (see decode()) without saving it. The caller
+        closes the returned image.
+        """
+        resized = image.resize(
+            self.size, Image.LANCZOS, box=fill_box(image.size, self.size)
+        )
+        self.frames += 1
+        return resized
+
+    def save(self, resized, outfile, info):
+        """
+        Save a resized image into outfile, with the EXIF data and colour
+        profile from info (the source image's info).
+        """
+        options = {"quality": self.quality}
+        for key in ("exif", "icc_profile"):
+            if info.get(key):
+                options[key] = info[key]
+
+        tmp_path = "{}.tmp".format(outfile)
+        resized.save(tmp_path, "JPEG", **options)
+        os.replace(tmp_path, outfile)
+
+    def resize(self, file_path, outfile):
+        """
+        Resize the JPEG file_path into outfile.
+        """
+        image = Image.open(file_path)
+        try:
+            source_size = image.size
+            image = decode(image, [self.size])
+            if image.size != source_size:
+                self.draft_frames += 1
+            self.resize_decoded(image, outfile)
+        finally:
+            image.close()
@@ -0,0 +1,89 @@
+"""
+Which photos catch up queues after a restart.
+
+    python -m pytest test_catch_up.py
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import timelapse_gen
+
+
+class CatchUpTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.config = {
+            "name": "test",
+            "src_dir": os.path.join(self.tmp_dir, "photos"),
+            "out_dir": os.path.join(self.tmp_dir, "videos"),
+            "out_tmp_dir": os.path.join(self.tmp_dir, "tmp"),
+            "resolution": "64x36",
+            "fps": 24,
+            "previews": False,
+        }
+        for key in ("src_dir", "out_dir", "out_tmp_dir"):
+            os.makedirs(self.config[key])
+        self.timelapse = timelapse_gen.Timelapse(self.config)
+
+    def tearDown(self):
+        self.timelapse.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def encoded(self, *photos):
+        for photo in photos:
+            self.timelapse.journal.add(photo)
+        self.timelapse.journal.mark_encoded(photos, 1)
+
+    def catch_up(self, names, full=False):
+        return self.timelapse.catch_up_photos(sorted(names), full)
+
+    def test_new_journal_skips_existing_photos(self):
+        existing = ["a_000000.jpg", "a_000001.jpg"]
+        self.assertEqual(self.catch_up(existing), [])
+        self.assertEqual(self.catch_up(existing + ["a_000002.jpg"]), ["a_000002.jpg"])
+
+    def test_other_prefix_sorting_before_the_newest_is_caught_up(self):
+        # A second camera's photos, or a renamed prefix, that sort after
+        # the main camera's new ones
+        self.catch_up(["test_2026-01-01T00:00:00_000000.jpg"])
+        self.encoded("test_2026-01-01T00:00:00_000000.jpg", "test_video2_x_000000.jpg")
+
+        new = [
+            "test_2026-01-01T00:00:00_000001.jpg",
+            "test_2026-01-02T00:00:00_000000.jpg",
+        ]
+        names = [
+            "test_2026-01-01T00:00:00_000000.jpg",
+            "test_video2_x_000000.jpg",
+        ] + new
+        self.assertEqual(self.catch_up(names), new)
+
+    def test_clock_jump_within_a_run_is_caught_up(self):
+        # The daemon restarted with its clock set back: the new run sorts
+        # before the photos already added
+        self.timelapse.journal.created = False
+        self.encoded("p_2026-06-01T00:00:00_000000.jpg")
+        names = [
+            "p_2026-06-01T00:00:00_000000.jpg",
+            "p_2020-01-01T00:00:00_000000.jpg",
+            "p_2020-01-01T00:00:00_000001.jpg",
+        ]
+        self.assertEqual(
+            self.catch_up(names),
+            ["p_2020-01-01T00:00:00_000000.jpg", "p_2020-01-01T00:00:00_000001.jpg"],
+        )
+
+    def test_rejected_and_added_photos_are_not_redone(self):
+        self.timelapse.journal.created = False
+        self.encoded("p_000000.jpg")
+        self.timelapse.journal.reject("p_000001.jpg")
+        names = ["p_000000.jpg", "p_000001.jpg", "p_000002.jpg"]
+        self.assertEqual(self.catch_up(names), ["p_000002.jpg"])
+        self.assertEqual(self.catch_up(names, full=True), ["p_000002.jpg"])
+
+
+if __name__ == "__main__":
+    unittest.main()
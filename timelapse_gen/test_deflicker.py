@@ -0,0 +1,66 @@
+"""
+Deflicker on synthetic sequences.
+
+    python -m pytest test_deflicker.py
+"""
+
+import os
+import random
+import tempfile
+import unittest
+
+import numpy as np
+from PIL import Image
+
+import deflicker
+
+
+def gray(level):
+    return Image.new("RGB", (64, 36), (int(level),) * 3)
+
+
+def mean(image):
+    return float(np.asarray(image.convert("L")).mean())
+
+
+class DeflickerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.config = {"name": "test", "fps": 12, "out_tmp_dir": self.tmp_dir.name}
+
+    def run_levels(self, stage, levels):
+        out = []
+        for level in levels:
+            image = gray(level)
+            out.append(mean(stage.correct(image, stage.measure(image))))
+        return np.array(out)
+
+    def test_follows_a_steady_change_without_lag(self):
+        # Dawn: the light rises steadily over many windows
+        ramp = np.linspace(50, 160, 200)
+        out = self.run_levels(deflicker.Deflicker(self.config), ramp)
+        self.assertLess(np.abs(out - ramp).max(), 2.5)
+
+    def test_evens_out_flicker(self):
+        random.seed(0)
+        flicker = [100 * (1 + 0.3 * (2 * random.random() - 1)) for _ in range(200)]
+        out = self.run_levels(deflicker.Deflicker(self.config), flicker)
+        before = np.abs(np.diff(flicker)).mean()
+        after = np.abs(np.diff(out[24:])).mean()
+        self.assertLess(after, before / 4)
+
+    def test_window_is_saved_without_close(self):
+        stage = deflicker.Deflicker(self.config)
+        self.run_levels(stage, [100] * stage.window)
+        self.assertTrue(os.path.exists(stage.state_path))
+
+        # A restart after a crash carries on from the saved window, rather
+        # than passing the next frame through as it is
+        restarted = deflicker.Deflicker(self.config)
+        self.assertEqual(len(restarted.recent), stage.window)
+        self.assertLess(self.run_levels(restarted, [120])[0], 105)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+"""
+Flood a watched source dir with thousands of photos.
+
+    python -m pytest test_flood.py
+"""
+
+import os
+import sqlite3
+import tempfile
+import unittest
+
+import bench_flood
+import timelapse_gen
+from journal import journal_path
+
+PHOTOS = 2000
+
+
+class FloodTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        cls.config = bench_flood.flood_config(
+            cls.tmp_dir.name, queue_depth=16, resize_workers=2, encode_workers=2
+        )
+        cls.queues, cls.peaks, flood_time, drain_time = bench_flood.flood(
+            cls.config, PHOTOS, timeout=300
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp_dir.cleanup()
+
+    def test_every_photo_is_processed(self):
+        for queue in self.queues:
+            stats = queue.stats()
+            self.assertEqual(stats["failed"], 0, queue.name)
+            self.assertEqual(stats["depth"], 0, queue.name)
+        resize, encode = self.queues
+        self.assertEqual(resize.stats()["completed"], PHOTOS)
+        self.assertEqual(encode.stats()["completed"], PHOTOS * 2)
+
+    def test_queues_stay_bounded(self):
+        for queue in self.queues:
+            self.assertLessEqual(self.peaks[queue.name], queue.max_depth, queue.name)
+        # The flood is far bigger than the queues, so submit() held it back
+        self.assertGreater(self.queues[0].stats()["blocked_time"], 0)
+
+    def test_each_timelapse_stays_in_order(self):
+        for timelapse in self.config["timelapses"]:
+            with sqlite3.connect(journal_path(timelapse)) as db:
+                photos = [
+                    row[0]
+                    for row in db.execute("SELECT photo FROM frames ORDER BY rowid")
+                ]
+            self.assertEqual(len(photos), PHOTOS, timelapse["name"])
+            self.assertEqual(photos, sorted(photos), timelapse["name"])
+
+    def test_videos_have_every_frame(self):
+        for timelapse in self.config["timelapses"]:
+            video = timelapse_gen.main_video_path(timelapse)
+            self.assertTrue(os.path.exists(video))
+            self.assertEqual(
+                bench_flood.frame_count(video),
+                bench_flood.expected_frames(timelapse, PHOTOS),
+                timelapse["name"],
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
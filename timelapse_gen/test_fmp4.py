@@ -0,0 +1,97 @@
+"""
+Appending fragmented MP4 chunks made by ffmpeg.
+
+    python -m pytest test_fmp4.py
+"""
+
+import os
+import re
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+
+import fmp4
+from bench_append import make_chunk
+
+
+def frame_count(path):
+    result = subprocess.run(
+        ["ffmpeg", "-v", "error", "-stats", "-i", path, "-f", "null", "-"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        check=True,
+    )
+    stderr = result.stderr.decode("utf-8")
+    assert "rror" not in stderr, stderr
+    return int(re.findall(r"frame=\s*(\d+)", stderr)[-1])
+
+
+class FragmentedVideoTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.config = {"resolution": "64x36", "fps": 12}
+        self.path = os.path.join(self.tmp_dir.name, "video.mp4")
+
+    def chunk(self, index):
+        path = os.path.join(self.tmp_dir.name, "chunk{}.mp4".format(index))
+        make_chunk(self.config, path, index)
+        return path
+
+    def test_append_chunks(self):
+        chunks = [self.chunk(index) for index in range(3)]
+        video = fmp4.FragmentedVideo(self.path)
+        # Media data is copied in blocks smaller than a frame
+        with mock.patch.object(fmp4, "COPY_BLOCK_SIZE", 100):
+            for chunk in chunks:
+                size = video.state["size"] if video.is_tracked() else 0
+                appended = video.append(chunk, chunk)
+
+        self.assertEqual(appended, os.path.getsize(self.path) - size)
+        self.assertEqual(video.state["size"], os.path.getsize(self.path))
+        self.assertEqual(video.source(), chunks[-1])
+        self.assertAlmostEqual(video.duration(), 3)
+        self.assertEqual(frame_count(self.path), 36)
+
+    def test_rebuild_state_drops_a_partial_append(self):
+        video = fmp4.FragmentedVideo(self.path)
+        video.append(self.chunk(0))
+        video.append(self.chunk(1))
+        state = dict(video.state)
+
+        with open(self.path, "ab") as video_file:
+            video_file.write(b"\x00\x01\x00\x00mdat partial")
+        os.remove(video.state_path)
+
+        rebuilt = fmp4.FragmentedVideo(self.path)
+        self.assertFalse(rebuilt.is_tracked())
+        rebuilt.rebuild_state()
+        for key in ("size", "sequence", "decode_time"):
+            self.assertEqual(rebuilt.state[key], state[key], key)
+
+        rebuilt.append(self.chunk(2))
+        self.assertEqual(frame_count(self.path), 36)
+
+    def test_replace_adds_mehd(self):
+        chunk = self.chunk(0)
+        video = fmp4.FragmentedVideo(self.path)
+        video.replace(chunk)
+
+        with open(self.path, "rb") as video_file:
+            ftyp, moov, fragments = fmp4.index_fragmented(video_file)
+        self.assertIsNotNone(fmp4.find_box(moov, [b"moov", b"mvex", b"mehd"]))
+        self.assertEqual(video.sequence(), len(fragments))
+        self.assertEqual(frame_count(self.path), 12)
+
+    def test_truncated_chunk_is_rejected(self):
+        chunk = self.chunk(0)
+        with open(chunk, "r+b") as chunk_file:
+            chunk_file.truncate(os.path.getsize(chunk) - 10)
+        with self.assertRaises(fmp4.FragmentError):
+            fmp4.FragmentedVideo(self.path).append(chunk)
+        self.assertFalse(os.path.exists(self.path))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+"""
+Which photos FrameFilter rejects, on generated JPEGs.
+
+    python -m pytest test_frame_filter.py
+"""
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from PIL import Image, ImageDraw
+
+import frame_filter
+
+SIZE = (640, 480)
+
+
+def scene(seed):
+    """
+    A photo of random grey rectangles.
+    """
+    rng = random.Random(seed)
+    image = Image.new("L", SIZE, 128)
+    draw = ImageDraw.Draw(image)
+    for _ in range(40):
+        x, y = rng.randrange(SIZE[0]), rng.randrange(SIZE[1])
+        draw.rectangle(
+            (x, y, x + rng.randrange(20, 200), y + rng.randrange(20, 200)),
+            fill=rng.randrange(30, 220),
+        )
+    return image
+
+
+class FrameFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.photos = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def photo(self, image):
+        """
+        (name, PhotoStats) of image saved as the next photo.
+        """
+        name = "p_{:06d}.jpg".format(self.photos)
+        self.photos += 1
+        path = os.path.join(self.tmp_dir, name)
+        image.save(path, "JPEG", quality=90)
+        return name, frame_filter.analyze(path)
+
+    def make_filter(self, **config):
+        return frame_filter.FrameFilter(dict({"fps": 24}, **config))
+
+    def test_flat_dark_and_bright_are_rejected(self):
+        frames = self.make_filter(reject_dark=40)
+        flat = Image.new("L", SIZE, 128)
+        dark = scene(0).point(lambda value: value // 8)
+        bright = Image.new("L", SIZE, 255)
+        ImageDraw.Draw(bright).rectangle((0, 0, SIZE[0] // 20, SIZE[1]), fill=200)
+
+        self.assertEqual(frames.check(*self.photo(flat)), "flat")
+        self.assertEqual(frames.check(*self.photo(dark)), "dark")
+        self.assertEqual(frames.check(*self.photo(bright)), "bright")
+        self.assertIsNone(frames.check(*self.photo(scene(0))))
+        self.assertEqual(frames.rejected, {"flat": 1, "dark": 1, "bright": 1})
+
+    def test_dark_frames_are_kept_by_default(self):
+        frames = self.make_filter()
+        dark = scene(0).point(lambda value: value // 8)
+        self.assertIsNone(frames.check(*self.photo(dark)))
+
+    def test_identical_frame_collapses_a_local_change_is_kept(self):
+        frames = self.make_filter()
+        name, first = self.photo(scene(0))
+        self.assertIsNone(frames.check(name, first))
+        self.assertEqual(frames.check(*self.photo(scene(0))), "duplicate")
+
+        changed = scene(0)
+        ImageDraw.Draw(changed).rectangle((300, 200, 339, 239), fill=255)
+        name, stats = self.photo(changed)
+        # Too small to move the hash far, the thumbnails tell them apart
+        self.assertLessEqual(frame_filter.hamming(first.dhash, stats.dhash), 4)
+        self.assertIsNone(frames.check(name, stats))
+        self.assertEqual(frames.rejected, {"duplicate": 1})
+
+    def test_photo_checked_twice_is_not_its_own_duplicate(self):
+        frames = self.make_filter()
+        name, stats = self.photo(scene(0))
+        self.assertIsNone(frames.check(name, stats))
+        self.assertIsNone(frames.check(name, stats))
+
+    def test_frames_leave_the_window(self):
+        frames = self.make_filter(duplicate_window=2)
+        for seed in (0, 1, 2):
+            self.assertIsNone(frames.check(*self.photo(scene(seed))))
+
+        # Scene 0 was pushed out by 1 and 2, scene 2 is still there
+        self.assertIsNone(frames.check(*self.photo(scene(0))))
+        self.assertEqual(frames.check(*self.photo(scene(2))), "duplicate")
+        self.assertEqual(frames.rejected, {"duplicate": 1})
+        self.assertEqual(len(frames.index.recent), 2)
+        # Evicted frames leave no buckets behind
+        self.assertEqual(
+            set.union(*frames.index.buckets.values()), set(frames.index.recent)
+        )
+
+    def test_duplicates_kept_without_a_distance(self):
+        frames = self.make_filter(duplicate_distance=None)
+        for _ in range(2):
+            self.assertIsNone(frames.check(*self.photo(scene(0))))
+
+
+if __name__ == "__main__":
+    unittest.main()
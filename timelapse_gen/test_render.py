@@ -0,0 +1,55 @@
+"""
+Segments and stride slots of a render.
+
+    python -m pytest test_render.py
+"""
+
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import render
+
+
+class SplitTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        config = {
+            "name": "test",
+            "src_dir": self.tmp_dir.name,
+            "out_dir": self.tmp_dir.name,
+            "segment_frames": 240,
+        }
+        self.renderer = render.Renderer(config, workers=1)
+        self.addCleanup(self.renderer.queue.close)
+        self.addCleanup(self.renderer.index.close)
+
+    def split_in(self, tz, frames, stride):
+        with mock.patch.dict(os.environ, {"TZ": tz}):
+            time.tzset()
+            try:
+                return self.renderer.split(frames, stride)
+            finally:
+                time.tzset()
+
+    def test_segments_dont_move_with_the_utc_offset(self):
+        # Two days of 10s photos across the end of summer time in Berlin
+        start = 1729987200
+        frames = [
+            ("{}.jpg".format(index), start + index * 10) for index in range(17280)
+        ]
+        segments = self.split_in("Europe/Berlin", frames, 10)
+        for tz in ("UTC", "Asia/Kolkata", "America/New_York"):
+            self.assertEqual(self.split_in(tz, frames, 10), segments, tz)
+
+        # Every segment but the first starts on a multiple of its span
+        times = dict(frames)
+        for segment in segments[1:]:
+            self.assertEqual(times[segment[0]] % 2400, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,170 @@
+"""
+Index of when every photo in a src_dir was taken, so renders can pick
+frames by time without opening the photos again.
+
+A photo's time is its EXIF DateTimeOriginal (which the timelapse daemon
+stamps), else a date and time in its name (e.g. 2020-01-01_12-00-00.jpg),
+else its modification time. Each photo is only read once, when update()
+first sees it.
+"""
+
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+TAG_EXIF_IFD = 0x8769
+TAG_DATETIME_ORIGINAL = 0x9003
+
+NAME_TIME = re.compile(r"(\d{4})-?(\d{2})-?(\d{2})[T_ ](\d{2})[-:]?(\d{2})[-:]?(\d{2})")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS photos (
+    photo TEXT PRIMARY KEY,
+    time REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS photos_time ON photos (time);
+"""
+
+
+def time_index_path(config):
+    return config.get(
+        "time_index",
+        os.path.join(config["out_dir"], "{}.index".format(config["name"])),
+    )
+
+
+def exif_time(photo_path):
+    if Image is None:
+        return None
+    try:
+        with Image.open(photo_path) as image:
+            value = image.getexif().get_ifd(TAG_EXIF_IFD).get(TAG_DATETIME_ORIGINAL)
+        if not value:
+            return None
+        return time.mktime(
+            datetime.strptime(value.strip("\x00 "), "%Y:%m:%d %H:%M:%S").timetuple()
+        )
+    except (OSError, ValueError, SyntaxError):
+        return None
+
+
+def name_time(photo):
+    match = NAME_TIME.search(photo)
+    if match is None:
+        return None
+    try:
+        return time.mktime(datetime(*map(int, match.groups())).timetuple())
+    except ValueError:
+        return None
+
+
+def photo_time(photo_path):
+    """
+    When photo_path was taken, in seconds since the epoch.
+    """
+    taken = exif_time(photo_path)
+    if taken is None:
+        taken = name_time(os.path.basename(photo_path))
+    if taken is None:
+        taken = os.path.getmtime(photo_path)
+    return taken
+
+
+class TimeIndex:
+    """
+    SQLite backed time index of one src_dir. Safe to use from several
+    threads.
+    """
+
+    def __init__(self, path, src_dir):
+        self.path = path
+        self.src_dir = src_dir
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        with self.lock:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.executescript(SCHEMA)
+
+    def update(self):
+        """
+        Add the photos that are new in src_dir and drop the ones that are
+        gone. Returns (added, removed).
+        """
+        names = {
+            entry.name
+            for entry in os.scandir(self.src_dir)
+            if entry.name.endswith(".jpg") and not entry.name.startswith(".")
+        }
+        with self.lock:
+            known = {photo for (photo,) in self.db.execute("SELECT photo FROM photos")}
+
+        added = []
+        for name in sorted(names - known):
+            try:
+                added.append((name, photo_time(os.path.join(self.src_dir, name))))
+            except OSError:
+                # Removed since the scan
+                continue
+        removed = known - names
+
+        with self.lock:
+            self.db.execute("BEGIN")
+            self.db.executemany(
+                "INSERT OR REPLACE INTO photos (photo, time) VALUES (?, ?)", added
+            )
+            self.db.executemany(
+                "DELETE FROM photos WHERE photo = ?", [(name,) for name in removed]
+            )
+            self.db.execute("COMMIT")
+        return len(added), len(removed)
+
+    def frames(self, start=None, end=None, stride=None, anchor=0, exclude=()):
+        """
+        [(photo, time)] taken in [start, end), in time order. With stride
+        (seconds), only the first photo of every stride long slot is
+        picked. Slots start at anchor, so the same slots are picked
+        whatever start is. Photos in exclude are skipped.
+        """
+        start = -1e99 if start is None else start
+        end = 1e99 if end is None else end
+        if stride:
+            query = (
+                "SELECT photo, MIN(time) FROM photos WHERE time >= ? AND time < ? "
+                "{}GROUP BY CAST((time - ?) / ? AS INTEGER) ORDER BY time"
+            )
+            args = (start, end, anchor, stride)
+        else:
+            query = (
+                "SELECT photo, time FROM photos WHERE time >= ? AND time < ? "
+                "{}ORDER BY time"
+            )
+            args = (start, end)
+
+        with self.lock:
+            if exclude:
+                # Excluded photos are left out before the slots are picked
+                self.db.execute(
+                    "CREATE TEMP TABLE IF NOT EXISTS exclude (photo TEXT PRIMARY KEY)"
+                )
+                self.db.execute("DELETE FROM exclude")
+                self.db.executemany(
+                    "INSERT OR IGNORE INTO exclude (photo) VALUES (?)",
+                    [(photo,) for photo in exclude],
+                )
+                query = query.format("AND photo NOT IN (SELECT photo FROM exclude) ")
+            else:
+                query = query.format("")
+            return self.db.execute(query, args).fetchall()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -3,15 +3,42 @@
 import argparse
 import glob
 import os
-import shutil
 import subprocess
 import tempfile
+import threading
 import time
 import yaml
 from datetime import datetime
 
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
+from timelapse_metrics import metrics
+from v4l2.files import write_atomic
+
+import fmp4
+import profiles
+from encoder import EncoderError, StreamEncoder
+from jobs import JobQueue
+from journal import Journal, journal_path
+
+try:
+    import cascade
+    import frame_filter
+    import previews
+    import resize
+except ImportError:
+    # Without Pillow, photos are resized with ImageMagick and there are no
+    # previews, frame filter or faster videos
+    cascade = None
+    frame_filter = None
+    previews = None
+    resize = None
+
+try:
+    import deflicker
+except ImportError:
+    # Without NumPy, frames aren't deflickered
+    deflicker = None
 
 
 def load_config(config_path):
@@ -24,8 +51,57 @@ def load_config(config_path):
     return config
 
 
-def resize_and_move(file_path, out_dir, resolution, prefix):
-    result = subprocess.run(
+def make_resizer(config):
+    if resize is None or config.get("resizer", "pil") == "convert":
+        return None
+    return resize.Resizer(
+        config["resolution"], config.get("jpeg_quality", resize.DEFAULT_QUALITY)
+    )
+
+
+# Settings of a timelapse that its faster videos don't share
+LEVEL_EXCLUDED = (
+    "deflicker",
+    "frame_filter",
+    "journal",
+    "previews_dir",
+    "render_cache",
+    "speeds",
+    "time_index",
+)
+
+
+def level_config(config, speed):
+    """
+    Config of the speed times faster video of a timelapse.
+    """
+    name = "{}_x{}".format(config["name"], speed)
+    level = {key: value for key, value in config.items() if key not in LEVEL_EXCLUDED}
+    # Its own out_tmp_dir, so globs for the timelapse's frames don't match
+    level.update(
+        name=name,
+        out_tmp_dir=os.path.join(config["out_tmp_dir"], name),
+        previews=False,
+    )
+    return level
+
+
+def resized_path(out_dir, prefix, file_path):
+    return os.path.join(out_dir, "{}_{}".format(prefix, os.path.split(file_path)[1]))
+
+
+def resize_and_move(file_path, out_dir, resolution, prefix, resizer=None):
+    outfile = resized_path(out_dir, prefix, file_path)
+
+    if resizer is not None:
+        try:
+            resizer.resize(file_path, outfile)
+        except (OSError, ValueError) as e:
+            print("Error resizing {} ({})".format(file_path, e))
+            return None
+        return outfile
+
+    result = metrics.run(
         [
             "convert",
             file_path,
@@ -35,7 +111,7 @@ def resize_and_move(file_path, out_dir, resolution, prefix):
             "center",
             "-extent",
             resolution,
-            os.path.join(out_dir, "{}_{}".format(prefix, os.path.split(file_path)[1])),
+            outfile,
         ],
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
@@ -43,40 +119,56 @@ def resize_and_move(file_path, out_dir, resolution, prefix):
 
     if result.returncode:
         print("Error resizing {}".format(file_path))
+        return None
+
+    return outfile
 
 
-def create_tmp_video(config):
+def create_tmp_video(config, profile=None):
     photo_list = glob.glob(
         os.path.join(config["out_tmp_dir"], "{}_*.jpg".format(config["name"]))
     )
     if len(photo_list) < config["fps"]:
-        return
+        return None, []
 
+    photo_list.sort()
     photo_files_path = os.path.join(
         config["out_tmp_dir"], "{}_photo_files.txt".format(config["name"])
     )
 
     with open(photo_files_path, "w") as outfile:
         print("Writing to {}".format(photo_files_path))
-        for photo_path in sorted(photo_list):
+        for photo_path in photo_list:
             outfile.write("file '{}'\n".format(photo_path))
 
-    outfile = create_timelapse(config, photo_files_path)
+    outfile = create_timelapse(config, photo_files_path, profile)
     os.remove(photo_files_path)
 
-    if outfile is not None:
-        for photo in sorted(photo_list):
-            os.remove(photo)
+    if outfile is None:
+        return None, []
 
-    return outfile
+    for photo in photo_list:
+        os.remove(photo)
+
+    return outfile, [os.path.basename(photo) for photo in photo_list]
 
 
-def create_timelapse(config, photo_files_path):
+def fragment_options(config):
+    # Fragmented output with a fixed timescale so chunks can be appended
+    return [
+        "-movflags",
+        "+frag_keyframe+empty_moov+default_base_moof",
+        "-video_track_timescale",
+        str(config["fps"] * 1000),
+    ]
+
+
+def create_timelapse(config, photo_files_path, profile=None):
     print("Creating timelapse for {}".format(photo_files_path))
 
     outfile = os.path.join(config["out_tmp_dir"], "{}_tmp.mp4".format(config["name"]))
 
-    result = subprocess.run(
+    result = metrics.run(
         [
             "ffmpeg",
             "-f",
@@ -88,12 +180,10 @@ def create_timelapse(config, photo_files_path):
             "-y",
             "-i",
             photo_files_path,
-            "-vcodec",
-            "libx264",
-            "-pix_fmt",
-            "yuv420p",
-            outfile,
-        ],
+        ]
+        + profiles.video_options(profile or profiles.get_profile(config))
+        + fragment_options(config)
+        + [outfile],
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
     )
@@ -122,7 +212,7 @@ def concat_videos(config, files, outfile):
             concat_file.write("file '{}'\n".format(file))
 
     start_time = time.time()
-    result = subprocess.run(
+    result = metrics.run(
         [
             "ffmpeg",
             "-f",
@@ -134,14 +224,11 @@ def concat_videos(config, files, outfile):
             "-y",
             "-i",
             concat_files_path,
-            "-vcodec",
-            "libx264",
-            "-pix_fmt",
-            "yuv420p",
             "-c",
             "copy",
-            outfile,
-        ],
+        ]
+        + fragment_options(config)
+        + [outfile],
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
     )
@@ -159,80 +246,797 @@ def concat_videos(config, files, outfile):
         return outfile
 
 
-def process_photo(config, photo_path):
-    # Don't mess with other files
-    if ".jpg" in photo_path:
-        resize_and_move(
-            photo_path, config["out_tmp_dir"], config["resolution"], config["name"]
-        )
-
-    tmp_video_filename = create_tmp_video(config)
-    main_video_filename = os.path.join(
-        config["out_dir"], "{}.mp4".format(config["name"])
+def remux_video(config, infile, outfile):
+    result = metrics.run(
+        ["ffmpeg", "-y", "-i", infile, "-c", "copy"]
+        + fragment_options(config)
+        + [outfile],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
     )
+
+    if result.returncode:
+        print(result.stderr.decode("utf-8"))
+        print("Error creating {}".format(outfile))
+        return None
+    else:
+        return outfile
+
+
+def main_video_path(config):
+    return os.path.join(config["out_dir"], "{}.mp4".format(config["name"]))
+
+
+def photo_series(photo):
+    """
+    The part of a photo's name before its last _, e.g. one run of the
+    timelapse daemon (<prefix><start time>_<index>.jpg). Photos of one
+    series sort in the order they were taken, whatever the clock did.
+    """
+    return photo.rpartition("_")[0]
+
+
+def photo_name(config, frame_name):
+    """
+    Name of the source photo for a resized frame in out_tmp_dir.
+    """
+    return frame_name[len(config["name"]) + 1 :]
+
+
+def add_frame(config, resized, encoder=None, journal=None, profile=None):
+    """
+    Add a resized frame (or None if there isn't one) to the timelapse.
+    """
+    if encoder is not None:
+        if resized is not None:
+            try:
+                encoder.write(resized)
+            except EncoderError as e:
+                # The frame stays pending and is retried with the next one
+                print("Error encoding {} ({})".format(resized, e))
+        return
+
+    tmp_video_filename, frames = create_tmp_video(config, profile)
+    main_video_filename = main_video_path(config)
     if tmp_video_filename:
-        if os.path.exists(main_video_filename):
-            print("Joining videos", main_video_filename, tmp_video_filename)
-            concat_outfile = tempfile.mktemp(".mp4")
-            concat_file = concat_videos(
-                config, [main_video_filename, tmp_video_filename], concat_outfile
+        segment = append_video(
+            config, main_video_filename, tmp_video_filename, frames[-1]
+        )
+        if segment is not None and journal is not None:
+            journal.mark_encoded(
+                [photo_name(config, frame) for frame in frames], segment
+            )
+
+
+def open_video(config, main_video_filename):
+    video = fmp4.FragmentedVideo(main_video_filename)
+
+    if os.path.exists(main_video_filename) and not video.is_tracked():
+        try:
+            video.rebuild_state()
+        except fmp4.FragmentError:
+            # Videos from before fragmented output was used need one remux
+            print("Converting {} to fragmented MP4".format(main_video_filename))
+            remux_outfile = tempfile.mktemp(".mp4")
+            if remux_video(config, main_video_filename, remux_outfile) is None:
+                return None
+            video.replace(remux_outfile)
+            os.remove(remux_outfile)
+
+    return video
+
+
+def append_video(config, main_video_filename, tmp_video_filename, source=None):
+    """
+    Append tmp_video_filename to the main video. Returns the sequence
+    number of the last fragment in the video, or None on failure.
+    """
+    video = open_video(config, main_video_filename)
+    if video is None:
+        return None
+
+    try:
+        start_time = time.time()
+        video.append(tmp_video_filename, source)
+        metrics.bytes_written("video", os.path.getsize(tmp_video_filename))
+        print(
+            "Appended {} to {} in {:.3f}s".format(
+                tmp_video_filename, main_video_filename, time.time() - start_time
             )
-            if concat_file is not None:
-                os.replace(concat_outfile, main_video_filename)
-                os.remove(tmp_video_filename)
+        )
+    except fmp4.FragmentError as e:
+        # e.g. the resolution changed. Fall back to joining the whole video
+        print("Unable to append to {} ({})".format(main_video_filename, e))
+        print("Joining videos", main_video_filename, tmp_video_filename)
+        concat_outfile = tempfile.mktemp(".mp4")
+        concat_file = concat_videos(
+            config, [main_video_filename, tmp_video_filename], concat_outfile
+        )
+        if concat_file is None:
+            return None
+        video.replace(concat_outfile)
+        os.remove(concat_outfile)
+
+    os.remove(tmp_video_filename)
+    return video.sequence()
+
+
+def append_fragment(config, journal, ftyp, moov, fragment, frames):
+    main_video_filename = main_video_path(config)
+    video = open_video(config, main_video_filename)
+    if video is None:
+        raise fmp4.FragmentError("Unable to open {}".format(main_video_filename))
+
+    try:
+        video.append_fragments(ftyp, moov, [fragment], frames[-1])
+        metrics.bytes_written("video", sum(len(part) for part in fragment))
+        segment = video.sequence()
+    except fmp4.FragmentError as e:
+        print("Unable to append to {} ({})".format(main_video_filename, e))
+        tmp_video_filename = os.path.join(
+            config["out_tmp_dir"], "{}_tmp.mp4".format(config["name"])
+        )
+        write_atomic(tmp_video_filename, b"".join((ftyp, moov) + fragment))
+        segment = append_video(
+            config, main_video_filename, tmp_video_filename, frames[-1]
+        )
+        if segment is None:
+            raise
+
+    if journal is not None:
+        journal.mark_encoded([photo_name(config, frame) for frame in frames], segment)
+
+
+def start_encoder(config, journal=None, profile=None):
+    """
+    Start a streaming encoder for config and feed it the frames left over
+    from the last run that didn't make it into the video.
+    """
+    encoder = StreamEncoder(
+        config,
+        lambda *fragment: append_fragment(config, journal, *fragment),
+        fragment_options(config),
+        profile,
+    )
+
+    video = open_video(config, main_video_path(config))
+    last_source = video.source() if video is not None else None
+
+    leftover = sorted(
+        glob.glob(
+            os.path.join(config["out_tmp_dir"], "{}_*.jpg".format(config["name"]))
+        )
+    )
+    for frame in leftover:
+        if last_source is not None and os.path.basename(frame) <= last_source:
+            # Appended just before the last run stopped
+            os.remove(frame)
         else:
-            print("Moving video", tmp_video_filename, main_video_filename)
-            shutil.move(tmp_video_filename, main_video_filename)
+            encoder.write(frame)
 
+    return encoder
+
+
+class Timelapse:
+    """
+    One configured timelapse and the encoder, resizer and journal it uses.
+    """
 
-class FSChangeHandler(FileSystemEventHandler):
     def __init__(self, config):
         self.config = config
+        # Checked once, the encoders use the result from then on
+        self.profile = profiles.select_profile(config)
+        self.journal = Journal(journal_path(config))
+        self.resizer = make_resizer(config)
+        self.previews = None
+        if previews is not None and config.get("previews", True):
+            self.previews = previews.Previews(config)
+        self.frame_filter = None
+        if config.get("frame_filter", False):
+            if frame_filter is None:
+                print("Not filtering {}, it needs Pillow".format(config["name"]))
+            else:
+                self.frame_filter = frame_filter.FrameFilter(config)
+        self.deflicker = None
+        if config.get("deflicker", False):
+            if deflicker is None or self.resizer is None:
+                print(
+                    "Not deflickering {}, it needs NumPy and the pil resizer".format(
+                        config["name"]
+                    )
+                )
+            else:
+                self.deflicker = deflicker.Deflicker(config)
+        self.encoder = None
+        if config.get("encoder", "batch") == "stream":
+            self.encoder = start_encoder(config, self.journal, self.profile)
+
+        self.frames = 0
+        self.resize_time = 0
+        self.encode_time = 0
+
+        self.levels = []
+        if config.get("speeds"):
+            if cascade is None:
+                print("No faster videos of {}, they need Pillow".format(config["name"]))
+            else:
+                strides = cascade.level_strides(config["speeds"])
+                for speed, stride in zip(config["speeds"], strides):
+                    level = level_config(config, speed)
+                    os.makedirs(level["out_tmp_dir"], exist_ok=True)
+                    self.levels.append(
+                        cascade.Level(
+                            Timelapse(level), stride, config.get("speed_blend", False)
+                        )
+                    )
+
+    def frame_path(self, photo):
+        return resized_path(self.config["out_tmp_dir"], self.config["name"], photo)
+
+    def catch_up_photos(self, names, full=False):
+        """
+        Return the photos in names (sorted) that still need to be added:
+        the ones that aren't in the journal. Without full, photos of the
+        same series as the newest one in the journal that sort before it
+        are taken as handled without looking them up.
+        """
+        # Staged frames lost with out_tmp_dir (e.g. on reboot) are redone,
+        # unless the video shows they were added
+        video = fmp4.FragmentedVideo(main_video_path(self.config))
+        last_frame = video.source() or ""
+        encoded = []
+        lost = []
+        for photo in self.journal.staged():
+            if os.path.exists(self.frame_path(photo)):
+                continue
+            if os.path.basename(self.frame_path(photo)) <= last_frame:
+                encoded.append(photo)
+            else:
+                lost.append(photo)
+        if encoded:
+            self.journal.mark_encoded(encoded, video.sequence())
+        self.journal.forget(lost)
+
+        if full:
+            return self.journal.missing(names)
+
+        if self.journal.created and names:
+            # No history yet, start from what is there now
+            print(
+                "New journal for {}, skipping {} existing photos".format(
+                    self.config["name"], len(names)
+                )
+            )
+            self.journal.skip(names)
+            self.journal.created = False
+
+        watermark = self.journal.watermark()
+        if watermark is not None:
+            series = photo_series(watermark)
+            names = [
+                name
+                for name in names
+                if name > watermark or photo_series(name) != series
+            ]
+        return self.journal.missing(names)
+
+    def close(self):
+        if self.encoder is not None:
+            # Flush the last fragment
+            self.encoder.close()
+        if self.deflicker is not None:
+            self.deflicker.close()
+        for level in self.levels:
+            level.timelapse.close()
+        self.journal.close()
+
+
+class PendingFrame:
+    """
+    A resized frame held in memory until it has been deflickered, which
+    has to happen in photo order.
+    """
+
+    def __init__(self, image, levels, info, path):
+        self.image = image
+        self.levels = levels
+        self.info = info
+        self.path = path
+
+    def close(self):
+        self.image.close()
+
+
+class SourceDir:
+    """
+    All the timelapses made from one src_dir. Each new photo is decoded
+    once and resized for every timelapse from the decoded pixels.
+
+    Resizing runs on resize_queue in any order. Adding frames runs on
+    encode_queue, in photo order for each timelapse. Resized frames are
+    written with a hidden name and only renamed into out_tmp_dir in order,
+    so a batch never picks up a frame ahead of one still being resized.
+    """
+
+    def __init__(self, src_dir, timelapses, resize_queue, encode_queue):
+        self.src_dir = src_dir
+        self.timelapses = timelapses
+        self.resize_queue = resize_queue
+        self.encode_queue = encode_queue
+
+        # Held while queueing, so catch up and new events stay in order
+        self.submit_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.photos = 0
+        self.decode_time = 0
+        self.filtered = 0
+        self.filter_time = 0
+
+    def submit(self, photo_path, timelapses=None):
+        """
+        Queue photo_path for timelapses (default: all of them). Blocks
+        while the queues are full.
+        """
+        if timelapses is None:
+            timelapses = self.timelapses
+        with self.submit_lock:
+            self._submit(photo_path, timelapses)
+
+    def _submit(self, photo_path, timelapses):
+        timelapses = self.filter_photo(photo_path, timelapses)
+        if not timelapses:
+            return
+
+        resized = self.resize_queue.submit(
+            None, self.resize_photo, photo_path, timelapses
+        )
+        for timelapse in timelapses:
+            self.encode_queue.submit(
+                timelapse.config["name"],
+                self.add_frame,
+                timelapse,
+                photo_path,
+                resized,
+            )
+
+    def catch_up(self, full=False):
+        """
+        Queue the photos in src_dir that aren't in the journals yet, e.g.
+        ones that arrived while timelapse_gen wasn't running. New events
+        wait until they are all queued.
+        """
+        with self.submit_lock:
+            start_time = time.monotonic()
+            names = sorted(
+                entry.name
+                for entry in os.scandir(self.src_dir)
+                if entry.name.endswith(".jpg") and not entry.name.startswith(".")
+            )
+
+            needed = {}
+            for timelapse in self.timelapses:
+                for name in timelapse.catch_up_photos(names, full):
+                    needed.setdefault(name, []).append(timelapse)
+
+            print(
+                "Catching up on {} photos in {} (scanned {} in {:.3f}s)".format(
+                    len(needed),
+                    self.src_dir,
+                    len(names),
+                    time.monotonic() - start_time,
+                )
+            )
+            for name in sorted(needed):
+                self._submit(os.path.join(self.src_dir, name), needed[name])
+
+    def filter_photo(self, photo_path, timelapses):
+        """
+        Return the timelapses that keep photo_path, and journal it as
+        rejected for the others. Runs under submit_lock, so every frame
+        filter sees the photos in order.
+        """
+        if ".jpg" not in photo_path or all(
+            timelapse.frame_filter is None for timelapse in timelapses
+        ):
+            return timelapses
+
+        start_time = time.monotonic()
+        try:
+            stats = frame_filter.analyze(photo_path)
+        except (OSError, ValueError) as e:
+            # Left to resize_photo to report
+            print("Error analyzing {} ({})".format(photo_path, e))
+            return timelapses
+        filter_time = time.monotonic() - start_time
+        metrics.observe_stage("filter", filter_time)
+        with self.lock:
+            self.filtered += 1
+            self.filter_time += filter_time
+
+        photo = os.path.basename(photo_path)
+        kept = []
+        for timelapse in timelapses:
+            reason = None
+            if timelapse.frame_filter is not None:
+                with self.lock:
+                    reason = timelapse.frame_filter.check(photo, stats)
+            if reason is None:
+                kept.append(timelapse)
+            else:
+                print(
+                    "Rejected {} for {} ({})".format(
+                        photo, timelapse.config["name"], reason
+                    )
+                )
+                timelapse.journal.reject(photo)
+        return kept
+
+    def resize_photo(self, photo_path, timelapses):
+        """
+        Return {timelapse name: staged frame path, PendingFrame or None}.
+        """
+        resized = {}
+        # Don't mess with other files
+        if ".jpg" not in photo_path:
+            return resized
+
+        image = None
+        sizes = [
+            timelapse.resizer.size
+            for timelapse in timelapses
+            if timelapse.resizer is not None
+        ]
+        if sizes:
+            start_time = time.monotonic()
+            try:
+                image = resize.open_photo(photo_path, sizes)
+            except (OSError, ValueError) as e:
+                print("Error decoding {} ({})".format(photo_path, e))
+                return resized
+            decode_time = time.monotonic() - start_time
+            metrics.observe_stage("decode", decode_time)
+            with self.lock:
+                self.decode_time += decode_time
+                self.photos += 1
+
+        resize_times = []
+        try:
+            for timelapse in timelapses:
+                start_time = time.monotonic()
+                resized[timelapse.config["name"]] = self._resize(
+                    timelapse, photo_path, image
+                )
+                resize_time = time.monotonic() - start_time
+                metrics.observe_stage("resize", resize_time)
+                resize_times.append(resize_time)
+                with self.lock:
+                    timelapse.frames += 1
+                    timelapse.resize_time += resize_time
+        finally:
+            if image is not None:
+                image.close()
+
+        if image is not None:
+            print(
+                "Decoded {} in {:.3f}s, resized {}".format(
+                    photo_path,
+                    decode_time,
+                    ", ".join(
+                        "{} {:.3f}s".format(timelapse.config["name"], resize_time)
+                        for timelapse, resize_time in zip(timelapses, resize_times)
+                    ),
+                )
+            )
+        return resized
+
+    def _resize(self, timelapse, photo_path, image):
+        config = timelapse.config
+        # Hidden until add_frame moves it into place
+        prefix = ".{}".format(config["name"])
+        if image is None or timelapse.resizer is None:
+            return resize_and_move(
+                photo_path, config["out_tmp_dir"], config["resolution"], prefix
+            )
+
+        staged = resized_path(config["out_tmp_dir"], prefix, photo_path)
+        try:
+            if timelapse.deflicker is not None:
+                resized = timelapse.resizer.resize_image(image)
+                levels = timelapse.deflicker.measure(resized)
+                return PendingFrame(resized, levels, dict(image.info), staged)
+            timelapse.resizer.resize_decoded(image, staged)
+        except (OSError, ValueError) as e:
+            print("Error resizing {} ({})".format(photo_path, e))
+            return None
+        return staged
+
+    def deflicker_frame(self, timelapse, photo_path, pending):
+        """
+        Correct and save a PendingFrame. Returns the staged path, or None.
+        """
+        try:
+            with metrics.timer("deflicker"):
+                corrected = timelapse.deflicker.correct(pending.image, pending.levels)
+            try:
+                timelapse.resizer.save(corrected, pending.path, pending.info)
+            finally:
+                corrected.close()
+        except (OSError, ValueError) as e:
+            print("Error deflickering {} ({})".format(photo_path, e))
+            return None
+        finally:
+            pending.close()
+        return pending.path
+
+    def add_frame(self, timelapse, photo_path, resized):
+        staged = resized.result().get(timelapse.config["name"])
+        start_time = time.monotonic()
+        try:
+            self._add_frame(timelapse, photo_path, staged)
+        finally:
+            encode_time = time.monotonic() - start_time
+            metrics.observe_stage("encode", encode_time)
+            with self.lock:
+                timelapse.encode_time += encode_time
+
+    def _add_frame(self, timelapse, photo_path, staged):
+        config = timelapse.config
+        photo = os.path.basename(photo_path)
+        if staged is not None and timelapse.journal.has(photo):
+            # Queued by both the catch up scan and an event
+            if isinstance(staged, PendingFrame):
+                staged.close()
+            else:
+                os.remove(staged)
+            return
+        if isinstance(staged, PendingFrame):
+            staged = self.deflicker_frame(timelapse, photo_path, staged)
+
+        frame = None
+        if staged is not None:
+            # Journal first: a frame that is journaled but missing is redone
+            # on the next start, an unjournaled one would end up twice
+            timelapse.journal.add(photo)
+            frame = timelapse.frame_path(photo)
+            os.replace(staged, frame)
+            metrics.bytes_written("frame", os.path.getsize(frame))
+            if timelapse.previews is not None:
+                try:
+                    timelapse.previews.add(frame)
+                except (OSError, ValueError) as e:
+                    print("Error updating previews for {} ({})".format(photo, e))
+            if timelapse.levels:
+                self.add_levels(timelapse, photo, frame)
+        add_frame(
+            config, frame, timelapse.encoder, timelapse.journal, timelapse.profile
+        )
+
+    def stage_levels(self, timelapse, photo, frame):
+        """
+        Return [(level, frame)] for the faster videos that frame adds a
+        frame to. All of them are staged before any is encoded, as the
+        encoders remove frames once they are in the video.
+        """
+        staged = []
+        image = None
+        try:
+            for level in timelapse.levels:
+                made = level.add(frame, image)
+                if image is not None:
+                    image.close()
+                    image = None
+                if made is None:
+                    break
+
+                level_frame = level.timelapse.frame_path(photo)
+                tmp_path = "{}.tmp".format(level_frame)
+                if level.blend:
+                    image = made
+                    image.save(
+                        tmp_path,
+                        "JPEG",
+                        quality=level.timelapse.config.get(
+                            "jpeg_quality", resize.DEFAULT_QUALITY
+                        ),
+                    )
+                else:
+                    # Same pixels as the level above
+                    os.link(frame, tmp_path)
+                os.replace(tmp_path, level_frame)
+                staged.append((level, level_frame))
+                frame = level_frame
+        finally:
+            if image is not None:
+                image.close()
+        return staged
+
+    def add_levels(self, timelapse, photo, frame):
+        try:
+            staged = self.stage_levels(timelapse, photo, frame)
+        except (OSError, ValueError) as e:
+            print(
+                "Error adding {} to the faster videos of {} ({})".format(
+                    photo, timelapse.config["name"], e
+                )
+            )
+            return
+
+        for level, level_frame in staged:
+            level.timelapse.journal.add(photo)
+            add_frame(
+                level.timelapse.config,
+                level_frame,
+                level.timelapse.encoder,
+                level.timelapse.journal,
+                level.timelapse.profile,
+            )
+
+    def stats(self):
+        """
+        Average decode time per photo, filter time per photo, resize time
+        per timelapse, preview update time per sample, frames added to each
+        faster video and deflicker times per frame. For each frame filter,
+        the photos it rejected by reason and the resize and encode time that
+        saved (at the average time per frame).
+        """
+        with self.lock:
+            return {
+                "photos": self.photos,
+                "decode_time": self.decode_time / max(self.photos, 1),
+                "filter_time": self.filter_time / max(self.filtered, 1),
+                "rejected": {
+                    timelapse.config["name"]: dict(
+                        timelapse.frame_filter.rejected,
+                        saved_time=sum(timelapse.frame_filter.rejected.values())
+                        * (timelapse.resize_time + timelapse.encode_time)
+                        / max(timelapse.frames, 1),
+                    )
+                    for timelapse in self.timelapses
+                    if timelapse.frame_filter is not None
+                },
+                "resize_time": {
+                    timelapse.config["name"]: timelapse.resize_time
+                    / max(timelapse.frames, 1)
+                    for timelapse in self.timelapses
+                },
+                "previews": {
+                    timelapse.config["name"]: timelapse.previews.stats()
+                    for timelapse in self.timelapses
+                    if timelapse.previews is not None
+                },
+                "levels": {
+                    level.timelapse.config["name"]: level.frames
+                    for timelapse in self.timelapses
+                    for level in timelapse.levels
+                },
+                "deflicker": {
+                    timelapse.config["name"]: timelapse.deflicker.stats()
+                    for timelapse in self.timelapses
+                    if timelapse.deflicker is not None
+                },
+            }
+
+    def close(self):
+        for timelapse in self.timelapses:
+            timelapse.close()
+
+
+class FSChangeHandler(FileSystemEventHandler):
+    def __init__(self, source):
+        self.source = source
 
     def on_moved(self, event):
-        print(self.config["name"], event.dest_path)
-        process_photo(self.config, event.dest_path)
+        print(self.source.src_dir, event.dest_path)
+        self.source.submit(event.dest_path)
 
 
-parser = argparse.ArgumentParser()
-parser.add_argument("config", help="Config file location")
-parser.add_argument(
-    "--test", action="store_true", help="Test mode. Run on all files from source dir"
-)
+def print_stats(queues, sources):
+    for queue in queues:
+        print("{} queue".format(queue.name), queue.stats())
+    for source in sources:
+        print(source.src_dir, source.stats())
 
-args = parser.parse_args()
 
-if not os.path.exists(args.config):
-    raise Exception("Config file not found.")
+def start_pipeline(config):
+    """
+    Create the timelapses, grouped by src_dir, and the job queues that run
+    them. Returns (queues, sources).
+    """
+    sources = {}
+    for timelapse in config["timelapses"]:
+        if not os.path.exists(timelapse["src_dir"]):
+            print("{} not found. Creating".format(timelapse["src_dir"]))
+            os.makedirs(timelapse["src_dir"], exist_ok=True)
 
-config = load_config(args.config)
+        if not os.path.exists(timelapse["out_dir"]):
+            print("{} not found. Creating".format(timelapse["out_dir"]))
+            os.makedirs(timelapse["out_dir"], exist_ok=True)
+
+        if not os.path.exists(timelapse["out_tmp_dir"]):
+            print("{} not found. Creating".format(timelapse["out_tmp_dir"]))
+            os.makedirs(timelapse["out_tmp_dir"], exist_ok=True)
+
+        # Timelapses sharing a src_dir decode each photo once
+        sources.setdefault(timelapse["src_dir"], []).append(Timelapse(timelapse))
+
+    # Resizing is Pillow (which releases the GIL) or convert, and encoding
+    # is ffmpeg, so threads are enough to keep every core busy
+    resize_queue = JobQueue(
+        "resize",
+        config.get("resize_workers", os.cpu_count()),
+        config.get("queue_depth", 64),
+    )
+    encode_queue = JobQueue(
+        "encode",
+        config.get("encode_workers", len(config["timelapses"])),
+        config.get("queue_depth", 64) * len(config["timelapses"]),
+    )
 
-observer = Observer()
-for timelapse in config["timelapses"]:
-    if not os.path.exists(timelapse["src_dir"]):
-        print("{} not found. Creating".format(timelapse["src_dir"]))
-        os.makedirs(timelapse["src_dir"], exist_ok=True)
+    sources = [
+        SourceDir(src_dir, timelapses, resize_queue, encode_queue)
+        for src_dir, timelapses in sources.items()
+    ]
+    return [resize_queue, encode_queue], sources
 
-    if not os.path.exists(timelapse["out_dir"]):
-        print("{} not found. Creating".format(timelapse["out_dir"]))
-        os.makedirs(timelapse["out_dir"], exist_ok=True)
 
-    if not os.path.exists(timelapse["out_tmp_dir"]):
-        print("{} not found. Creating".format(timelapse["out_tmp_dir"]))
-        os.makedirs(timelapse["out_tmp_dir"], exist_ok=True)
+def stop_pipeline(queues, sources):
+    """
+    Finish all queued work and flush the encoders.
+    """
+    # Resize jobs never wait on encode jobs, so close in this order
+    for queue in queues:
+        queue.close()
+    for source in sources:
+        source.close()
+    print_stats(queues, sources)
 
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config", help="Config file location")
+    parser.add_argument(
+        "--test",
+        action="store_true",
+        help="Test mode. Run on all files from source dir that aren't in the "
+        "journal yet, then exit",
+    )
+
+    args = parser.parse_args()
+
+    if not os.path.exists(args.config):
+        raise Exception("Config file not found.")
+
+    config = load_config(args.config)
+    metrics.start(config)
+
+    observer = Observer()
+    queues, sources = start_pipeline(config)
     if args.test:
-        for photo in sorted(glob.glob(os.path.join(timelapse["src_dir"], "*.jpg"))):
-            process_photo(timelapse, photo)
+        for source in sources:
+            source.catch_up(full=True)
     else:
-        event_handler = FSChangeHandler(timelapse)
-        observer.schedule(event_handler, timelapse["src_dir"])
+        for source in sources:
+            event_handler = FSChangeHandler(source)
+            observer.schedule(event_handler, source.src_dir)
+        observer.start()
 
-if not args.test:
-    observer.start()
-    try:
-        while True:
-            time.sleep(1)
-    except KeyboardInterrupt:
-        observer.stop()
-    observer.join()
+        # Events wait while each source dir catches up
+        catch_up = [
+            threading.Thread(target=source.catch_up, daemon=True) for source in sources
+        ]
+        for thread in catch_up:
+            thread.start()
+
+        try:
+            stats_interval = config.get("stats_interval", 60)
+            last_stats = time.monotonic()
+            while True:
+                time.sleep(1)
+                if time.monotonic() - last_stats >= stats_interval:
+                    print_stats(queues, sources)
+                    last_stats = time.monotonic()
+        except KeyboardInterrupt:
+            observer.stop()
+        observer.join()
+
+    stop_pipeline(queues, sources)
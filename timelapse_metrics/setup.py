@@ -0,0 +1,13 @@
+from setuptools import setup
+
+setup(
+    name="timelapse_metrics",
+    version="0.1",
+    description="Prometheus metrics shared by timelapse, timelapse_gen and the UI",
+    url="",
+    author="Alvaro Prieto",
+    author_email="source@alvaroprieto.com",
+    license="MIT",
+    packages=["timelapse_metrics"],
+    zip_safe=False,
+)
@@ -0,0 +1,55 @@
+"""
+Rendering and serving the shared metrics.
+
+    python -m pytest test_metrics.py
+"""
+
+import socket
+import unittest
+import urllib.request
+from unittest import mock
+
+from timelapse_metrics import metrics
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class MetricsTest(unittest.TestCase):
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = metrics.Histogram("test_seconds", "Test", buckets=(1, 10))
+        for value in (0.5, 5, 50):
+            histogram.observe(value, stage="a")
+        lines = histogram.render()
+        self.assertIn('test_seconds_bucket{stage="a",le="1.0"} 1', lines)
+        self.assertIn('test_seconds_bucket{stage="a",le="10.0"} 2', lines)
+        self.assertIn('test_seconds_bucket{stage="a",le="+Inf"} 3', lines)
+        self.assertIn('test_seconds_sum{stage="a"} 55.5', lines)
+
+    def test_percentiles(self):
+        self.assertEqual(
+            metrics.percentiles(reversed(range(200))),
+            {"p50": 100, "p99": 198, "max": 199},
+        )
+        self.assertEqual(metrics.percentiles([]), {"p50": 0, "p99": 0, "max": 0})
+
+    def test_served_on_loopback_only(self):
+        port = free_port()
+        metrics.counter("test_total", "Test").inc(kind="x")
+        with mock.patch.object(
+            metrics, "ThreadingHTTPServer", wraps=metrics.ThreadingHTTPServer
+        ) as server:
+            metrics.start({"metrics_port": port})
+        self.assertEqual(server.call_args[0][0], ("127.0.0.1", port))
+
+        url = "http://127.0.0.1:{}/metrics".format(port)
+        with urllib.request.urlopen(url) as response:
+            body = response.read().decode("utf-8")
+        self.assertIn('timelapse_test_total{kind="x"} 1', body)
+
+
+if __name__ == "__main__":
+    unittest.main()
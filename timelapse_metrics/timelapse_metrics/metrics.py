@@ -0,0 +1,455 @@
+"""
+Process wide metrics, in the Prometheus text format, shared by the
+timelapse daemon, timelapse_gen and the UI.
+
+Metrics are created by name on first use and labelled with keyword
+arguments. Every name gets the timelapse_ prefix:
+
+    metrics.histogram("stage_seconds").observe(0.2, stage="resize")
+    with metrics.timer("resize"):
+        ...
+    metrics.run(["ffmpeg", ...])  # subprocess.run, counted and timed
+
+The common ones have helpers: timer() and observe_stage() for per stage
+latency, run() and popen() for subprocesses, queue_depth() and
+bytes_written(). percentiles() summarises latencies kept in memory.
+
+start(config) publishes them, using these keys of the process' config:
+
+    metrics_port      serve /metrics (and /profile) on 127.0.0.1:<port>.
+                      Only on loopback: the profile shows code paths and
+                      neither needs to be public
+    metrics_file      rewrite this file every metrics_interval seconds
+                      (default 15), e.g. for node_exporter's textfile
+                      collector
+    metrics_profile   sample every thread's stack metrics_profile_rate
+                      times a second (default 50), served at /profile in
+                      collapsed stack format (flamegraph.pl, speedscope)
+"""
+
+import collections
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+NAMESPACE = "timelapse"
+
+# Seconds, from a quick v4l2 ioctl to a long ffmpeg run
+BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    300,
+)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{{{}}}".format(
+        ",".join('{}="{}"'.format(key, escape(value)) for key, value in pairs)
+    )
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels):
+        return tuple(sorted(labels.items()))
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.help),
+            "# TYPE {} {}".format(self.name, self.kind),
+        ]
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(
+                    "{}{} {}".format(
+                        self.name, format_labels(labels), format_value(value)
+                    )
+                )
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # One count per bucket, then the sum and the total count
+                # (the +Inf bucket)
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            counts[-2] += value
+            counts[-1] += 1
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.help),
+            "# TYPE {} {}".format(self.name, self.kind),
+        ]
+        with self.lock:
+            for labels, counts in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    lines.append(
+                        "{}_bucket{} {}".format(
+                            self.name,
+                            format_labels(labels, [("le", format_value(float(bound)))]),
+                            cumulative,
+                        )
+                    )
+                lines.append(
+                    "{}_bucket{} {}".format(
+                        self.name, format_labels(labels, [("le", "+Inf")]), counts[-1]
+                    )
+                )
+                lines.append(
+                    "{}_sum{} {}".format(
+                        self.name, format_labels(labels), format_value(counts[-2])
+                    )
+                )
+                lines.append(
+                    "{}_count{} {}".format(self.name, format_labels(labels), counts[-1])
+                )
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = collections.OrderedDict()
+        self.started = time.time()
+
+    def get(self, cls, name, help, *args):
+        name = "{}_{}".format(NAMESPACE, name)
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help or name, *args)
+            elif not isinstance(metric, cls):
+                raise ValueError("{} is a {}".format(name, metric.kind))
+        return metric
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = [
+            "# HELP {}_process_cpu_seconds CPU time used by this process".format(
+                NAMESPACE
+            ),
+            "# TYPE {}_process_cpu_seconds counter".format(NAMESPACE),
+            "{}_process_cpu_seconds {}".format(NAMESPACE, time.process_time()),
+            "# HELP {}_uptime_seconds Seconds since the process started".format(
+                NAMESPACE
+            ),
+            "# TYPE {}_uptime_seconds gauge".format(NAMESPACE),
+            "{}_uptime_seconds {}".format(NAMESPACE, time.time() - self.started),
+        ]
+        for metric in metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help=None):
+    return REGISTRY.get(Counter, name, help)
+
+
+def gauge(name, help=None):
+    return REGISTRY.get(Gauge, name, help)
+
+
+def histogram(name, help=None, buckets=BUCKETS):
+    return REGISTRY.get(Histogram, name, help, buckets)
+
+
+def observe_stage(stage, seconds):
+    histogram("stage_seconds", "Time spent in each stage").observe(seconds, stage=stage)
+
+
+class timer:
+    """
+    Context manager that observes the time spent in it as stage.
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe_stage(self.stage, time.monotonic() - self.start)
+
+
+def command_name(args):
+    if isinstance(args, (str, bytes)):
+        args = args.split()
+    name = args[0]
+    if isinstance(name, bytes):
+        name = name.decode("utf-8", "replace")
+    return os.path.basename(str(name))
+
+
+def run(args, **kwargs):
+    """
+    subprocess.run(), counting the runs and their time per command.
+    """
+    command = command_name(args)
+    start = time.monotonic()
+    try:
+        result = subprocess.run(args, **kwargs)
+    except OSError:
+        counter("subprocess_failures_total", "Subprocesses that failed").inc(
+            command=command
+        )
+        raise
+    histogram("subprocess_seconds", "Time subprocesses took to run").observe(
+        time.monotonic() - start, command=command
+    )
+    if result.returncode:
+        counter("subprocess_failures_total", "Subprocesses that failed").inc(
+            command=command
+        )
+    return result
+
+
+def popen(args, **kwargs):
+    """
+    subprocess.Popen(), counting the processes started per command.
+    """
+    counter("subprocess_started_total", "Long running subprocesses started").inc(
+        command=command_name(args)
+    )
+    return subprocess.Popen(args, **kwargs)
+
+
+def queue_depth(queue, depth):
+    gauge("queue_depth", "Items waiting in each queue").set(depth, queue=queue)
+
+
+def bytes_written(kind, count):
+    counter("bytes_written_total", "Bytes written, by kind of file").inc(
+        count, kind=kind
+    )
+
+
+def percentiles(values):
+    """
+    p50, p99 and max of values, e.g. the latencies a queue keeps for its
+    stats.
+    """
+    values = sorted(values)
+    if not values:
+        return {"p50": 0, "p99": 0, "max": 0}
+    return {
+        "p50": values[len(values) // 2],
+        "p99": values[len(values) * 99 // 100],
+        "max": values[-1],
+    }
+
+
+class Sampler:
+    """
+    Sampling profiler: counts the stacks of every thread at a fixed rate.
+    """
+
+    def __init__(self, rate=50):
+        self.interval = 1.0 / rate
+        self.lock = threading.Lock()
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="sampler", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            sampled = []
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        "{} ({}:{})".format(
+                            code.co_name,
+                            os.path.basename(code.co_filename),
+                            code.co_firstlineno,
+                        )
+                    )
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                sampled.append(";".join(reversed(stack)))
+            with self.lock:
+                self.stacks.update(sampled)
+                self.samples += 1
+
+    def collapsed(self):
+        """
+        Stack counts, one "thread;outer;...;inner count" line each.
+        """
+        with self.lock:
+            return "".join(
+                "{} {}\n".format(stack, count)
+                for stack, count in self.stacks.most_common()
+            )
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+sampler = None
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            body = REGISTRY.render()
+            content_type = CONTENT_TYPE
+        elif self.path == "/profile" and sampler is not None:
+            body = sampler.collapsed()
+            content_type = "text/plain; charset=utf-8"
+        else:
+            self.send_error(404)
+            return
+
+        data = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would drown the logs
+        pass
+
+
+def write_file(path):
+    # Renamed into place, so the textfile collector never reads half of it
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), prefix=".", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb") as metrics_file:
+            metrics_file.write(REGISTRY.render().encode("utf-8"))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _write_loop(path, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            write_file(path)
+        except OSError as e:
+            print("Unable to write metrics to {}: {}".format(path, e))
+
+
+def start(config):
+    """
+    Publish the metrics as configured (see above). Does nothing without
+    any of the metrics_ keys.
+    """
+    global sampler
+
+    if config.get("metrics_profile") and sampler is None:
+        sampler = Sampler(config.get("metrics_profile_rate", 50))
+
+    if config.get("metrics_port"):
+        server = ThreadingHTTPServer(
+            ("127.0.0.1", config["metrics_port"]),
+            MetricsHandler,
+        )
+        server.daemon_threads = True
+        threading.Thread(
+            target=server.serve_forever, name="metrics", daemon=True
+        ).start()
+        print("Serving metrics on http://{}:{}/metrics".format(*server.server_address))
+
+    if config.get("metrics_file"):
+        threading.Thread(
+            target=_write_loop,
+            args=(config["metrics_file"], config.get("metrics_interval", 15)),
+            name="metrics-file",
+            daemon=True,
+        ).start()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""
+Bytes sent by /video/<name>.mp4 for a seek heavy playback pattern: start
+playing, jump around the video a few times, then reload the page. Compares
+against the old route, which sent the whole file for every request.
+
+    ./bench_video.py --size 200 --seeks 20
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+
+import yaml
+
+
+def make_app(tmp_dir, video_size):
+    video_path = os.path.join(tmp_dir, "bench.mp4")
+    with open(video_path, "wb") as video_file:
+        video_file.truncate(video_size)
+
+    timelapse_config = os.path.join(tmp_dir, "timelapse.yml")
+    with open(timelapse_config, "w") as config_file:
+        yaml.dump({"device": "/dev/video0"}, config_file)
+
+    gen_config = os.path.join(tmp_dir, "timelapse_gen.yml")
+    with open(gen_config, "w") as config_file:
+        yaml.dump(
+            {
+                "timelapses": [
+                    {"name": "bench", "out_dir": tmp_dir, "resolution": "1920x1080"}
+                ]
+            },
+            config_file,
+        )
+
+    ui_config = os.path.join(tmp_dir, "ui_config")
+    with open(ui_config, "w") as config_file:
+        config_file.write(
+            'TIMELAPSE_CONFIG = "{}"\nTIMELAPSE_GEN_CONFIG = "{}"\n'
+            "VIDEO_ACCEL_REDIRECT = None\n".format(timelapse_config, gen_config)
+        )
+    os.environ["TIMELAPSE_UI_SETTINGS"] = ui_config
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from src import app
+
+    return app
+
+
+def playback(client, video_size, seeks, chunk_size):
+    """
+    Return [(status, bytes)] for each request a player makes.
+    """
+    requests = []
+
+    def get(headers):
+        response = client.get("/video/bench.mp4", headers=headers)
+        requests.append((response.status_code, len(response.data)))
+        return response
+
+    # Start playing, the player reads the first chunk then the moov box
+    response = get({"Range": "bytes=0-{}".format(chunk_size - 1)})
+    etag = response.headers["ETag"]
+
+    for _ in range(seeks):
+        start = random.randrange(video_size - chunk_size)
+        get(
+            {
+                "Range": "bytes={}-{}".format(start, start + chunk_size - 1),
+                "If-Range": etag,
+            }
+        )
+
+    # Reload the page: the browser revalidates what it has cached
+    get({"If-None-Match": etag})
+    return requests
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=200, help="Video size in MB")
+    parser.add_argument("--seeks", type=int, default=20)
+    parser.add_argument("--chunk", type=int, default=2, help="MB read after each seek")
+    args = parser.parse_args()
+
+    random.seed(0)
+    video_size = args.size * 1024 * 1024
+    chunk_size = args.chunk * 1024 * 1024
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        app = make_app(tmp_dir, video_size)
+        requests = playback(app.test_client(), video_size, args.seeks, chunk_size)
+
+    sent = sum(size for _, size in requests)
+    statuses = sorted({status for status, _ in requests})
+    print(
+        "{} requests ({}), {:.1f}MB sent".format(
+            len(requests), ", ".join(str(status) for status in statuses), sent / 1e6
+        )
+    )
+    print(
+        "Whole file per request: {:.1f}MB ({:.0f}x more)".format(
+            len(requests) * video_size / 1e6, len(requests) * video_size / max(sent, 1)
+        )
+    )
@@ -0,0 +1,6 @@
+def post_worker_init(worker):
+    # Metrics get their own loopback listener, so start it in the one worker
+    # rather than when the app is imported
+    from src import timelapse_ui
+
+    timelapse_ui.start_metrics()
@@ -1,18 +1,51 @@
+import json
 import os
-import time
+import shutil
 import tempfile
-import subprocess
+import threading
+import time
 import yaml
 from datetime import datetime, timedelta
-from flask import Flask, request, g, render_template, send_file, redirect
-from v4l2 import v4l2
-
+from urllib.parse import quote
+from flask import (
+    Flask,
+    Response,
+    abort,
+    request,
+    g,
+    render_template,
+    redirect,
+    send_from_directory,
+)
+from werkzeug.http import http_date, is_resource_modified
+from werkzeug.wsgi import wrap_file
+from timelapse_metrics import metrics
+from v4l2 import capabilities
+from v4l2 import preview as v4l2_preview
 
 app = Flask(__name__)
 app.config.from_pyfile("default_config")
 app.config.from_envvar("TIMELAPSE_UI_SETTINGS", silent=False)
 
 
+def start_metrics():
+    """
+    Serve /metrics and /profile on 127.0.0.1:METRICS_PORT, away from the
+    pages nginx makes public. Called by gunicorn in the worker, see
+    gunicorn.conf.py.
+    """
+    try:
+        metrics.start(
+            {
+                "metrics_port": app.config.get("METRICS_PORT"),
+                "metrics_profile": app.config.get("METRICS_PROFILE", False),
+                "metrics_profile_rate": app.config.get("METRICS_PROFILE_RATE", 50),
+            }
+        )
+    except OSError as e:
+        print("Unable to serve metrics: {}".format(e))
+
+
 def load_config(config_path):
     with open(config_path, "r") as config_file:
         config = yaml.safe_load(config_file)
@@ -24,56 +57,66 @@ def load_config(config_path):
 
 
 def save_config(config, config_path):
-    with open(config_path, "w") as config_file:
-        yaml.dump(config, config_file, default_flow_style=False)
+    # Replace the file in one rename, so timelapse.py never reads half of it
+    config_dir, config_name = os.path.split(os.path.abspath(config_path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".{}.".format(config_name), dir=config_dir)
+    try:
+        with os.fdopen(fd, "w") as config_file:
+            yaml.dump(config, config_file, default_flow_style=False)
+            metrics.bytes_written("config", config_file.tell())
+        if os.path.exists(config_path):
+            shutil.copymode(config_path, tmp_path)
+        os.replace(tmp_path, config_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
 
 
 gen_config = load_config(app.config["TIMELAPSE_GEN_CONFIG"])
 
 
-def take_photo(device="/dev/video0", resolution="1920x1080", filename=None):
-
-    if filename is None:
-        filename = tempfile.mktemp(".jpg")
-
-    result = subprocess.run(
-        [
-            "fswebcam",
-            "--no-banner",
-            "-sFocus, Auto=False",
-            "-sExposure, Auto=Manual Mode",
-            "-sWhite Balance Temperature, Auto=False",
-            "-S5",
-            "-d",
-            "v4l2:{}".format(device),
-            "-r",
-            resolution,
-            filename,
-        ],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
+preview_sessions = {}
+preview_sessions_lock = threading.Lock()
 
-    # fswebcam seems to use stderr instead of stdout
-    rval = result.stderr.decode("utf-8")
-    if "Error" in rval and "Error querying menu" not in rval:
-        print(rval)
-        return None
 
-    isodate = datetime.now().isoformat()
-
-    result = subprocess.run(
-        [
-            "exiftool",
-            "-overwrite_original",
-            "-DateTimeOriginal='{}'".format(isodate),
-            filename,
-        ],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
+def preview_session(device):
+    """
+    One shared preview session per device, so every viewer gets the same
+    frames.
+    """
+    with preview_sessions_lock:
+        if device not in preview_sessions:
+            preview_sessions[device] = v4l2_preview.PreviewSession(
+                device,
+                resolution=app.config.get("PREVIEW_RESOLUTION", "640x480"),
+                fps=app.config.get("PREVIEW_FPS", 5),
+            )
+        return preview_sessions[device]
 
-    return filename
+
+def no_cache(response):
+    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+    response.headers["Pragma"] = "no-cache"
+    response.headers["Expires"] = "0"
+    return response
+
+
+@app.before_request
+def start_timer():
+    g.request_start = time.monotonic()
+
+
+@app.after_request
+def record_request(response):
+    # Streamed responses (previews, videos) are timed until the first byte
+    endpoint = request.endpoint or "unknown"
+    metrics.histogram("request_seconds", "Time to handle UI requests").observe(
+        time.monotonic() - g.request_start, endpoint=endpoint
+    )
+    metrics.counter("requests_total", "UI requests, by response status").inc(
+        endpoint=endpoint, status=response.status_code
+    )
+    return response
 
 
 @app.route("/")
@@ -129,8 +172,9 @@ def timelapse():
             message = {"title": "", "text": "Settings saved."}
 
     timelapse_settings = load_config(app.config["TIMELAPSE_CONFIG"])
-    cam_ctrl = v4l2.V4L2(timelapse_settings["device"])
-    resolutions = cam_ctrl.get_resolutions()
+    resolutions = capabilities.resolutions(
+        timelapse_settings["device"], app.config.get("CAPABILITY_CACHE_DIR")
+    )
     resolutions_str = []
     for resolution in resolutions:
         resolutions_str.append("{}x{}".format(resolution[0], resolution[1]))
@@ -155,51 +199,50 @@ def timelapse():
 
 @app.route("/preview")
 def preview():
-    cam_control = v4l2.V4L2()
+    cam_control = capabilities.open_controls(0, app.config.get("CAPABILITY_CACHE_DIR"))
     return render_template("preview.html", controls=cam_control.controls)
 
 
+def save_camera_settings(camera_settings):
+    timelapse_settings = load_config(app.config["TIMELAPSE_CONFIG"])
+    timelapse_settings["z_camera_settings"] = camera_settings
+    save_config(timelapse_settings, app.config["TIMELAPSE_CONFIG"])
+
+
+def open_controls():
+    cam_control = capabilities.open_controls(0, app.config.get("CAPABILITY_CACHE_DIR"))
+    cam_control.get_flags()
+    return cam_control
+
+
+def inactive(control):
+    return "inactive" in str(control.limits.get("flags", "")).split(",")
+
+
 @app.route("/update_settings", methods=["POST"])
 def update_settings():
-    cam_control = v4l2.V4L2()
+    cam_control = open_controls()
+    new_settings = {}
     for item, value in request.form.items():
-        control = cam_control.controls[item]
-        print(item, value, control.limits.get("flags"), control.get(), int(value))
-        if control.limits.get("flags") != "inactive" and control.get() != int(value):
-            print("updating", item, value)
-            control.set(int(value))
+        if not inactive(cam_control.controls[item]):
+            new_settings[item] = int(value)
 
-    camera_settings = {}
-    for control_name, control in cam_control.controls.items():
-        camera_settings[control_name] = control.value
-
-    timelapse_settings = load_config(app.config["TIMELAPSE_CONFIG"])
-    timelapse_settings["z_camera_settings"] = camera_settings
-    save_config(timelapse_settings, app.config["TIMELAPSE_CONFIG"])
+    save_camera_settings(cam_control.set_values(new_settings))
+    cam_control.close()
 
     return "OK"
 
 
 @app.route("/default_settings", methods=["GET", "POST"])
 def default_settings():
-    cam_control = v4l2.V4L2()
+    cam_control = open_controls()
+    defaults = {}
     for name, control in cam_control.controls.items():
-        if control.limits.get("flags") != "inactive":
-            try:
-                control.set(control.limits["default"])
-            except ValueError:
-                pass
-            print("updating", name, control.limits["default"])
-
-    # Read settings in again before saving
-    cam_control = v4l2.V4L2()
-    camera_settings = {}
-    for control_name, control in cam_control.controls.items():
-        camera_settings[control_name] = control.value
+        if not inactive(control) and "default" in control.limits:
+            defaults[name] = control.limits["default"]
 
-    timelapse_settings = load_config(app.config["TIMELAPSE_CONFIG"])
-    timelapse_settings["z_camera_settings"] = camera_settings
-    save_config(timelapse_settings, app.config["TIMELAPSE_CONFIG"])
+    save_camera_settings(cam_control.set_values(defaults))
+    cam_control.close()
 
     return render_template(
         "main.html", message={"title": "", "text": "Settings reset."}
@@ -210,20 +253,53 @@ def default_settings():
 def preview_photo():
     timelapse_settings = load_config(app.config["TIMELAPSE_CONFIG"])
 
-    filename = take_photo(device=timelapse_settings["device"])
-    if filename is None:
-        return "Error"
+    frame = preview_session(timelapse_settings["device"]).snapshot()
+    if frame is None:
+        return "Error", 503
 
-    response = send_file(
-        filename, mimetype="image/jpeg", attachment_filename="preview.jpg"
-    )
+    response = Response(frame, mimetype="image/jpeg")
     response.headers["Content-Disposition"] = 'inline; filename="preview.jpg"'
-    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    response.headers["Pragma"] = "no-cache"
-    response.headers["Expires"] = "0"
-    response.headers["Cache-Control"] = "public, max-age=0"
+    return no_cache(response)
 
-    return response
+
+@app.route("/preview_stream")
+def preview_stream():
+    timelapse_settings = load_config(app.config["TIMELAPSE_CONFIG"])
+    session = preview_session(timelapse_settings["device"])
+
+    def parts():
+        for frame in session.frames():
+            yield (
+                b"--frame\r\nContent-Type: image/jpeg\r\n"
+                + "Content-Length: {}\r\n\r\n".format(len(frame)).encode()
+                + frame
+                + b"\r\n"
+            )
+
+    response = Response(parts(), mimetype="multipart/x-mixed-replace; boundary=frame")
+    # Otherwise nginx holds frames back until its buffer fills
+    response.headers["X-Accel-Buffering"] = "no"
+    return no_cache(response)
+
+
+def previews_dir(config):
+    # Same default as timelapse_gen's previews module
+    return config.get(
+        "previews_dir",
+        os.path.join(config["out_dir"], "{}.previews".format(config["name"])),
+    )
+
+
+def load_previews(config):
+    """
+    Manifest of the poster, sprite sheet and preview clip timelapse_gen keeps
+    for a video, or None if there isn't one yet.
+    """
+    try:
+        with open(os.path.join(previews_dir(config), "manifest.json"), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
 
 
 @app.route("/videos")
@@ -234,35 +310,126 @@ def videos():
 
         video_path = os.path.join(config["out_dir"], "{}.mp4".format(config["name"]))
         if os.path.exists(video_path):
-            videos.append({"name": config["name"], "resolution": config["resolution"]})
+            videos.append(
+                {
+                    "name": config["name"],
+                    "resolution": config["resolution"],
+                    "previews": load_previews(config),
+                }
+            )
 
     return render_template("videos.html", videos=videos)
 
 
+@app.route("/previews/<name>/<filename>")
+def previews(name, filename):
+    for config in gen_config["timelapses"]:
+        if name == config["name"]:
+            break
+    else:
+        abort(404)
+    if filename.split("-")[0] not in ("poster", "sprite", "clip"):
+        abort(404)
+
+    # Preview file names change with their content, so they never go stale
+    response = send_from_directory(previews_dir(config), filename, max_age=31536000)
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+
+def video_etag(stat):
+    return '"{:x}-{:x}"'.format(stat.st_size, stat.st_mtime_ns)
+
+
+def read_range(video_file, length, chunk_size=64 * 1024):
+    try:
+        while length > 0:
+            data = video_file.read(min(chunk_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        video_file.close()
+
+
+def file_body(video_file, start, length):
+    video_file.seek(start)
+    if request.environ.get("SERVER_SOFTWARE", "").startswith("gunicorn"):
+        # gunicorn sendfile()s Content-Length bytes from the current offset
+        return wrap_file(request.environ, video_file)
+    return read_range(video_file, length)
+
+
 @app.route("/video/<filename>")
 def video(filename):
     name = filename.replace(".mp4", "")
 
-    video = None
+    video_path = None
     for config in gen_config["timelapses"]:
         if name != config["name"]:
             continue
         video_path = os.path.join(config["out_dir"], "{}.mp4".format(config["name"]))
-        if os.path.exists:
-            video = video_path
-            break
+        break
+
+    if video_path is None or not os.path.exists(video_path):
+        abort(404)
 
     video_filename = os.path.split(video_path)[1]
 
-    response = send_file(
-        video_path, mimetype="video/mp4", attachment_filename=video_filename
+    if app.config.get("VIDEO_ACCEL_REDIRECT"):
+        # nginx serves the file itself, with ranges and ETags
+        response = Response(mimetype="video/mp4")
+        response.headers["X-Accel-Redirect"] = app.config[
+            "VIDEO_ACCEL_REDIRECT"
+        ] + quote(video_filename)
+        return response
+
+    video_file = open(video_path, "rb")
+    stat = os.fstat(video_file.fileno())
+    etag = video_etag(stat)
+    last_modified = http_date(stat.st_mtime)
+
+    headers = {
+        "ETag": etag,
+        "Last-Modified": last_modified,
+        "Accept-Ranges": "bytes",
+        # Videos grow as frames are added, so always revalidate
+        "Cache-Control": "no-cache",
+        "Content-Disposition": 'inline; filename="{}"'.format(video_filename),
+    }
+
+    if not is_resource_modified(
+        request.environ, etag=etag, last_modified=last_modified
+    ):
+        video_file.close()
+        return Response(status=304, headers=headers)
+
+    start, length, status = 0, stat.st_size, 200
+    byte_range = request.range
+    if_range = request.if_range
+    if_range_ok = (if_range.etag is None or if_range.etag == etag[1:-1]) and (
+        if_range.date is None or int(if_range.date.timestamp()) == int(stat.st_mtime)
     )
-    response.headers["Content-Disposition"] = 'inline; filename="{}"'.format(
-        video_filename
+    if byte_range is not None and if_range_ok:
+        bounds = byte_range.range_for_length(stat.st_size)
+        if bounds is not None:
+            start, stop = bounds
+            length = stop - start
+            status = 206
+            headers["Content-Range"] = "bytes {}-{}/{}".format(
+                start, stop - 1, stat.st_size
+            )
+        elif len(byte_range.ranges) == 1:
+            video_file.close()
+            headers["Content-Range"] = "bytes */{}".format(stat.st_size)
+            return Response(status=416, headers=headers)
+
+    headers["Content-Length"] = str(length)
+    return Response(
+        file_body(video_file, start, length),
+        status=status,
+        headers=headers,
+        mimetype="video/mp4",
+        direct_passthrough=True,
     )
-    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    response.headers["Pragma"] = "no-cache"
-    response.headers["Expires"] = "0"
-    response.headers["Cache-Control"] = "public, max-age=0"
-
-    return response
@@ -1,4 +1,4 @@
 #!/bin/bash
 
 export TIMELAPSE_UI_SETTINGS=./src/default_config;
-./venv/bin/gunicorn -b unix:./timelapse_ui.sock src:app
+./venv/bin/gunicorn -c gunicorn.conf.py --threads 8 -b unix:./timelapse_ui.sock src:app
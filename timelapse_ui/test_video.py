@@ -0,0 +1,71 @@
+"""
+Range requests and revalidation of /video/<name>.mp4.
+
+    python -m pytest test_video.py
+"""
+
+import os
+import random
+import tempfile
+import unittest
+
+from bench_video import make_app, playback
+
+VIDEO_SIZE = 4 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+
+class VideoTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        cls.client = make_app(cls.tmp_dir.name, VIDEO_SIZE).test_client()
+        cls.data = random.Random(0).randbytes(VIDEO_SIZE)
+        with open(os.path.join(cls.tmp_dir.name, "bench.mp4"), "wb") as video:
+            video.write(cls.data)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp_dir.cleanup()
+
+    def get(self, **headers):
+        return self.client.get("/video/bench.mp4", headers=headers)
+
+    def test_range_sends_only_that_range(self):
+        response = self.get(Range="bytes=1000-1999")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(
+            response.headers["Content-Range"], "bytes 1000-1999/{}".format(VIDEO_SIZE)
+        )
+        self.assertEqual(response.data, self.data[1000:2000])
+
+    def test_seek_heavy_playback_sends_only_what_is_played(self):
+        random.seed(0)
+        seeks = 20
+        requests = playback(self.client, VIDEO_SIZE, seeks, CHUNK_SIZE)
+
+        self.assertEqual(requests[:-1], [(206, CHUNK_SIZE)] * (seeks + 1))
+        # The reload revalidates without sending the video again
+        self.assertEqual(requests[-1], (304, 0))
+        sent = sum(size for _, size in requests)
+        self.assertEqual(sent, (seeks + 1) * CHUNK_SIZE)
+        self.assertLess(sent, VIDEO_SIZE / 2)
+
+    def test_stale_if_range_gets_the_whole_video(self):
+        response = self.get(Range="bytes=0-9", **{"If-Range": '"stale"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), VIDEO_SIZE)
+
+    def test_unsatisfiable_range(self):
+        response = self.get(Range="bytes={}-".format(VIDEO_SIZE))
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(
+            response.headers["Content-Range"], "bytes */{}".format(VIDEO_SIZE)
+        )
+
+    def test_unknown_video(self):
+        self.assertEqual(self.client.get("/video/other.mp4").status_code, 404)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""
+Time a full device enumeration against capability cache hits, both from
+this process' memory and from the cache file another process wrote.
+
+    ./bench_capabilities.py --device /dev/video0
+    ./bench_capabilities.py --fake   # no camera needed
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from v4l2 import capabilities
+from v4l2 import v4l2
+from v4l2.fake import FakeDevice
+
+
+def timed(function, rounds):
+    latencies = []
+    for _ in range(rounds):
+        start = time.monotonic()
+        function()
+        latencies.append(time.monotonic() - start)
+    latencies.sort()
+    return latencies[len(latencies) // 2]
+
+
+def file_hit(device, cache_dir, backend):
+    # Like a request served by another gunicorn worker
+    capabilities._memory.clear()
+    capabilities.load(device, cache_dir, backend)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="/dev/video0")
+    parser.add_argument("--rounds", type=int, default=50)
+    parser.add_argument(
+        "--fake", action="store_true", help="Use a fake device instead of a camera"
+    )
+    args = parser.parse_args()
+
+    cache_dir = tempfile.mkdtemp()
+    device = args.device
+    backend = None
+    if args.fake:
+        # The cache is keyed on the device node, so give it a file to stat
+        device = os.path.join(cache_dir, "video0")
+        open(device, "w").close()
+        backend = lambda path: v4l2.IoctlBackend(path, transport=FakeDevice)
+
+    results = [
+        (
+            "enumerate",
+            timed(lambda: capabilities.enumerate_capabilities(device, backend), 10),
+        ),
+        ("file hit", timed(lambda: file_hit(device, cache_dir, backend), args.rounds)),
+        (
+            "memory hit",
+            timed(lambda: capabilities.load(device, cache_dir, backend), args.rounds),
+        ),
+    ]
+    for name, latency in results:
+        print("{:12s} p50 {:8.3f}ms".format(name, latency * 1000))
+
+    caps = capabilities.load(device, cache_dir, backend)
+    print(
+        "{} formats, {} resolutions, {} controls".format(
+            len(caps["formats"]), len(caps["resolutions"]), len(caps["controls"])
+        )
+    )
+
+    # A replugged camera gets a new device node
+    if args.fake:
+        time.sleep(0.01)
+        os.utime(device)
+        key = capabilities.device_key(device)
+        stale = capabilities._read(capabilities.cache_path(device, cache_dir), key)
+        print("Cache {} after the node changed".format("kept" if stale else "dropped"))
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""
+Compare per-frame latency of the persistent v4l2 streaming capture against
+spawning fswebcam for every photo.
+
+    ./bench_capture.py --device /dev/video0 --resolution 1920x1080
+    ./bench_capture.py --fake   # no camera needed, streaming path only
+"""
+
+import argparse
+import os
+import shutil
+import statistics
+import tempfile
+import time
+
+from v4l2 import capture
+from v4l2.fake import FakeDevice
+
+
+def run(camera, frames, out_dir):
+    latencies = []
+    for index in range(frames):
+        filename = os.path.join(out_dir, "bench_{:06d}.jpg".format(index))
+        start = time.monotonic()
+        camera.take_photo(filename)
+        latencies.append(time.monotonic() - start)
+        os.remove(filename)
+    return latencies
+
+
+def summary(name, open_time, latencies):
+    latencies = sorted(latencies)
+    print(
+        "{:10s} open {:7.1f}ms  mean {:7.1f}ms  p50 {:7.1f}ms  p95 {:7.1f}ms  "
+        "stdev {:6.1f}ms".format(
+            name,
+            open_time * 1000,
+            statistics.mean(latencies) * 1000,
+            latencies[len(latencies) // 2] * 1000,
+            latencies[int(len(latencies) * 0.95)] * 1000,
+            statistics.pstdev(latencies) * 1000,
+        )
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="/dev/video0")
+    parser.add_argument("--resolution", default="1920x1080")
+    parser.add_argument("--frames", type=int, default=20)
+    parser.add_argument(
+        "--fake", action="store_true", help="Use a fake device instead of a camera"
+    )
+    args = parser.parse_args()
+
+    out_dir = tempfile.mkdtemp()
+    try:
+        transport = FakeDevice if args.fake else capture.DeviceTransport
+        start = time.monotonic()
+        camera = capture.StreamingCapture(
+            args.device, args.resolution, transport=transport
+        )
+        camera.open()
+        open_time = time.monotonic() - start
+        summary("v4l2", open_time, run(camera, args.frames, out_dir))
+        camera.close()
+
+        if args.fake or shutil.which("fswebcam") is None:
+            print("fswebcam   skipped (no camera or fswebcam not installed)")
+        else:
+            camera = capture.FswebcamCapture(args.device, args.resolution)
+            summary("fswebcam", 0, run(camera, args.frames, out_dir))
+    finally:
+        shutil.rmtree(out_dir)
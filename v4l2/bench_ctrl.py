@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+"""
+Calls per second for control get/set and enumeration with the ioctl and
+v4l2-ctl backends, and the time to apply every control the way the UI
+used to (one get/set per control, then enumerate again) against
+V4L2.set_values().
+
+    ./bench_ctrl.py --device /dev/video0 --control brightness
+    ./bench_ctrl.py --fake   # no camera needed, ioctl backend only
+"""
+
+import argparse
+import shutil
+import time
+
+from v4l2 import v4l2
+from v4l2.fake import FakeDevice
+
+
+def calls_per_second(function, duration):
+    calls = 0
+    start = time.monotonic()
+    while time.monotonic() - start < duration:
+        function()
+        calls += 1
+    return calls / (time.monotonic() - start)
+
+
+def bench(name, device, make_backend, control_name, duration):
+    cam_ctrl = v4l2.V4L2(device, backend=make_backend())
+    control = cam_ctrl.controls[control_name]
+    value = control.get()
+
+    results = [
+        ("get", calls_per_second(control.get, duration)),
+        ("set", calls_per_second(lambda: control.set(value), duration)),
+        (
+            "enumerate",
+            calls_per_second(
+                lambda: v4l2.V4L2(device, backend=make_backend()), duration
+            ),
+        ),
+        ("resolutions", calls_per_second(cam_ctrl.get_resolutions, duration)),
+    ]
+    for operation, rate in results:
+        print("{:10s} {:12s} {:12.1f} calls/s".format(name, operation, rate))
+
+
+def other_value(control):
+    """
+    A valid value for control that isn't its default.
+    """
+    default = control.limits["default"]
+    if control.type == "bool":
+        return 1 - default
+    if control.type in ("menu", "intmenu"):
+        others = [index for index in control.menu if index != default]
+        return others[0] if others else default
+    if default != control.limits.get("max", default):
+        return control.limits["max"]
+    return control.limits.get("min", default)
+
+
+def apply_per_control(device, make_backend, settings):
+    cam_ctrl = v4l2.V4L2(device, backend=make_backend())
+    for name, value in settings.items():
+        control = cam_ctrl.controls[name]
+        if control.get() != value:
+            control.set(value)
+    cam_ctrl.close()
+
+    cam_ctrl = v4l2.V4L2(device, backend=make_backend())
+    state = {name: control.value for name, control in cam_ctrl.controls.items()}
+    cam_ctrl.close()
+    return state
+
+
+def apply_bulk(device, make_backend, settings):
+    cam_ctrl = v4l2.V4L2(device, backend=make_backend())
+    state = cam_ctrl.set_values(settings)
+    cam_ctrl.close()
+    return state
+
+
+def bench_apply(name, device, make_backend, rounds):
+    cam_ctrl = v4l2.V4L2(device, backend=make_backend())
+    # Every control changes each round, alternating between two settings
+    controls = [
+        control
+        for control in cam_ctrl.controls.values()
+        if control.readable()
+        and "default" in control.limits
+        and "inactive" not in str(control.limits.get("flags", "")).split(",")
+    ]
+    settings = [
+        {control.name: control.limits["default"] for control in controls},
+        {control.name: other_value(control) for control in controls},
+    ]
+    cam_ctrl.close()
+
+    for operation, apply in (("per-control", apply_per_control), ("bulk", apply_bulk)):
+        latencies = []
+        for index in range(rounds):
+            start = time.monotonic()
+            apply(device, make_backend, settings[index % 2])
+            latencies.append(time.monotonic() - start)
+        latencies.sort()
+        print(
+            "{:10s} apply {:3d} controls {:12s} p50 {:8.2f}ms  max {:8.2f}ms".format(
+                name,
+                len(controls),
+                operation,
+                latencies[len(latencies) // 2] * 1000,
+                latencies[-1] * 1000,
+            )
+        )
+
+
+def shared_fake(path):
+    """
+    Transport factory that hands out the same fake device every time, so
+    control values persist between opens like they do on a camera.
+    """
+    if path not in _fakes:
+        _fakes[path] = FakeDevice(path)
+        _fakes[path].close = lambda: None
+    return _fakes[path]
+
+
+_fakes = {}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="/dev/video0")
+    parser.add_argument("--control", default="brightness")
+    parser.add_argument("--duration", type=float, default=2.0)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument(
+        "--fake", action="store_true", help="Use a fake device instead of a camera"
+    )
+    args = parser.parse_args()
+
+    transport = shared_fake if args.fake else v4l2.DeviceTransport
+    bench(
+        "ioctl",
+        args.device,
+        lambda: v4l2.IoctlBackend(args.device, transport=transport),
+        args.control,
+        args.duration,
+    )
+    bench_apply(
+        "ioctl",
+        args.device,
+        lambda: v4l2.IoctlBackend(args.device, transport=transport),
+        args.rounds,
+    )
+
+    if args.fake or shutil.which("v4l2-ctl") is None:
+        print("v4l2-ctl   skipped (no camera or v4l2-ctl not installed)")
+    else:
+        bench(
+            "v4l2-ctl",
+            args.device,
+            lambda: v4l2.CtlBackend(args.device),
+            args.control,
+            args.duration,
+        )
+        bench_apply(
+            "v4l2-ctl", args.device, lambda: v4l2.CtlBackend(args.device), args.rounds
+        )
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""
+Cost per frame of stamping DateTimeOriginal in process compared to
+running exiftool -overwrite_original.
+
+    ./bench_exif.py                    # synthetic 1920x1080 frames
+    ./bench_exif.py --photo sample.jpg
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+
+from v4l2 import exif
+from v4l2.fake import synthetic_jpeg
+from v4l2.files import write_atomic
+
+
+def bench(name, source, frames, out_dir, stamp):
+    total_time = 0
+    total_bytes = 0
+    for index in range(frames):
+        filename = os.path.join(out_dir, "bench_{:06d}.jpg".format(index))
+        with open(filename, "wb") as photo:
+            photo.write(source)
+
+        start = time.monotonic()
+        total_bytes += stamp(filename)
+        total_time += time.monotonic() - start
+
+    print(
+        "{:22s} {:8.2f}ms/frame {:10.0f} bytes written/frame".format(
+            name, total_time * 1000 / frames, total_bytes / frames
+        )
+    )
+
+
+def stamp_in_memory(filename):
+    # What StreamingCapture does: stamp the frame and write it once
+    with open(filename, "rb") as photo:
+        jpeg = photo.read()
+    jpeg = exif.add_datetime(jpeg, datetime.now())
+    write_atomic(filename, jpeg)
+    return len(jpeg)
+
+
+def stamp_exiftool(filename):
+    subprocess.run(
+        [
+            "exiftool",
+            "-overwrite_original",
+            "-DateTimeOriginal='{}'".format(datetime.now().isoformat()),
+            filename,
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    return os.path.getsize(filename)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--photo", help="JPEG to stamp (default: synthetic frame)")
+    parser.add_argument("--frames", type=int, default=50)
+    args = parser.parse_args()
+
+    if args.photo:
+        with open(args.photo, "rb") as photo:
+            source = photo.read()
+    else:
+        source = synthetic_jpeg(1920, 1080)
+
+    stamped = exif.add_datetime(source, datetime.now())
+
+    out_dir = tempfile.mkdtemp()
+    try:
+        bench("in memory + write", source, args.frames, out_dir, stamp_in_memory)
+        bench("stamp_file (splice)", source, args.frames, out_dir, exif.stamp_file)
+        bench("stamp_file (patch)", stamped, args.frames, out_dir, exif.stamp_file)
+        if shutil.which("exiftool") is None:
+            print("exiftool               skipped (not installed)")
+        else:
+            bench("exiftool", source, args.frames, out_dir, stamp_exiftool)
+    finally:
+        shutil.rmtree(out_dir)
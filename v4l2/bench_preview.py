@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+Run several preview viewers against one shared session and report how many
+frames were captured versus delivered, and how long a second process
+waits for the device while the preview is running.
+
+    ./bench_preview.py --device /dev/video0 --viewers 4
+    ./bench_preview.py --fake   # no camera needed
+"""
+
+import argparse
+import threading
+import time
+
+from v4l2 import capture
+from v4l2 import preview
+from v4l2.fake import FakeDevice
+
+
+def viewer(session, duration, counts, index):
+    end_time = time.monotonic() + duration
+    for _ in session.frames():
+        counts[index] += 1
+        if time.monotonic() >= end_time:
+            break
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="/dev/video0")
+    parser.add_argument("--resolution", default="640x480")
+    parser.add_argument("--fps", type=int, default=5)
+    parser.add_argument("--viewers", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument(
+        "--fake", action="store_true", help="Use a fake device instead of a camera"
+    )
+    args = parser.parse_args()
+
+    options = {"transport": FakeDevice} if args.fake else {}
+    session = preview.PreviewSession(args.device, args.resolution, args.fps, **options)
+
+    counts = [0] * args.viewers
+    threads = [
+        threading.Thread(target=viewer, args=(session, args.duration, counts, index))
+        for index in range(args.viewers)
+    ]
+    for thread in threads:
+        thread.start()
+
+    # Stand in for the timelapse daemon wanting the camera half way through
+    time.sleep(args.duration / 2)
+    lock = capture.DeviceLock(args.device)
+    start = time.monotonic()
+    lock.acquire()
+    wait_time = time.monotonic() - start
+    lock.release()
+
+    for thread in threads:
+        thread.join()
+
+    print(
+        "{} viewers at {} fps for {:.0f}s: {} frames captured, {} delivered "
+        "({} per viewer)".format(
+            args.viewers,
+            args.fps,
+            args.duration,
+            session.captured,
+            sum(counts),
+            counts,
+        )
+    )
+    print(
+        "Device handed over in {:.0f}ms, preview yielded {} times".format(
+            wait_time * 1000, session.yields
+        )
+    )
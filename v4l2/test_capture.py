@@ -0,0 +1,44 @@
+"""
+StreamingCapture against the fake device.
+
+    python -m pytest test_capture.py
+"""
+
+import unittest
+
+from v4l2 import capture
+from v4l2 import videodev2 as vd
+from v4l2.fake import FakeDevice
+
+
+class StreamingCaptureTest(unittest.TestCase):
+    def open(self, **kwargs):
+        camera = capture.StreamingCapture(
+            "/dev/video0", "640x480", transport=FakeDevice, warmup=0, **kwargs
+        )
+        camera.open()
+        self.addCleanup(camera.close)
+        return camera
+
+    def test_open_sets_manual_controls(self):
+        camera = self.open()
+        device = camera.transport
+        self.assertEqual(device._control(vd.V4L2_CID_FOCUS_AUTO)["value"], 0)
+        self.assertEqual(
+            device._control(vd.V4L2_CID_EXPOSURE_AUTO)["value"],
+            vd.V4L2_EXPOSURE_MANUAL,
+        )
+        self.assertEqual(device._control(vd.V4L2_CID_AUTO_WHITE_BALANCE)["value"], 0)
+        self.assertTrue(camera.capture().startswith(b"\xff\xd8"))
+
+    def test_controls_can_be_left_alone(self):
+        camera = self.open(controls=())
+        self.assertEqual(camera.transport._control(vd.V4L2_CID_FOCUS_AUTO)["value"], 1)
+
+    def test_missing_controls_are_skipped(self):
+        camera = self.open(controls=((0x00980999, 1),) + capture.MANUAL_CONTROLS)
+        self.assertEqual(camera.transport._control(vd.V4L2_CID_FOCUS_AUTO)["value"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+"""
+Controls built from cached metadata against the fake device, and the
+v4l2-ctl backend's parsing.
+
+    python -m pytest test_controls.py
+"""
+
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+
+from v4l2 import capabilities
+from v4l2 import v4l2
+from v4l2.fake import FakeDevice
+
+
+def inactive(control):
+    return "inactive" in str(control.limits.get("flags", "")).split(",")
+
+
+class GetFlagsTest(unittest.TestCase):
+    def open(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        cam_ctrl = capabilities.open_controls(
+            "/dev/video0",
+            cache_dir.name,
+            lambda device: v4l2.IoctlBackend(device, transport=FakeDevice),
+        )
+        self.addCleanup(cam_ctrl.close)
+        return cam_ctrl
+
+    def test_inactive_follows_auto_controls(self):
+        cam_ctrl = self.open()
+        exposure = cam_ctrl.controls["exposure_absolute"]
+        # Left out of the cached metadata, as it depends on exposure_auto
+        self.assertFalse(inactive(exposure))
+
+        cam_ctrl.get_flags()
+        self.assertTrue(inactive(exposure))
+        self.assertEqual(exposure.limits["flags"], "inactive")
+
+        cam_ctrl.set_values({"exposure_auto": 1})
+        cam_ctrl.get_flags()
+        self.assertFalse(inactive(exposure))
+        self.assertNotIn("flags", exposure.limits)
+
+    def test_flags_match_a_full_enumeration(self):
+        cam_ctrl = self.open()
+        cam_ctrl.set_values({"white_balance_temperature_auto": 0})
+        cam_ctrl.get_flags()
+        enumerated = v4l2.V4L2("/dev/video0", cam_ctrl.backend).controls
+        self.assertEqual(
+            {name: control.limits.get("flags") for name, control in enumerated.items()},
+            {
+                name: control.limits.get("flags")
+                for name, control in cam_ctrl.controls.items()
+            },
+        )
+
+
+# v4l2-ctl -L for part of the fake device
+CTL_LIST = b"""
+                     brightness 0x00980900 (int)    : min=0 max=255 step=1 default=128 value=128
+           power_line_frequency 0x00980918 (menu)   : min=0 max=2 default=2 value=2
+\t\t\t\t0: Disabled
+\t\t\t\t1: 50 Hz
+\t\t\t\t2: 60 Hz
+                  exposure_auto 0x009a0901 (menu)   : min=0 max=3 default=3 value=3
+\t\t\t\t1: Manual Mode
+\t\t\t\t3: Aperture Priority Mode
+                      link_freq 0x009f0901 (intmenu): min=0 max=1 default=0 value=0
+\t\t\t\t0: 24000000 (0x016e3600)
+\t\t\t\t1: 48000000 (0x02dc6c00)
+"""
+
+
+class CtlBackendTest(unittest.TestCase):
+    def test_menus_match_the_ioctl_backend(self):
+        result = subprocess.CompletedProcess([], 0, stdout=CTL_LIST)
+        with mock.patch("v4l2.v4l2.metrics.run", return_value=result):
+            controls = {
+                control.name: control
+                for control in v4l2.CtlBackend("/dev/video0").list_ctrls()
+            }
+        self.assertEqual(
+            list(controls),
+            ["brightness", "power_line_frequency", "exposure_auto", "link_freq"],
+        )
+        self.assertEqual(controls["brightness"].menu, {})
+        self.assertEqual(controls["power_line_frequency"].value, 2)
+        self.assertEqual(controls["link_freq"].menu, {0: 24000000, 1: 48000000})
+
+        ioctl = v4l2.V4L2(
+            "/dev/video0", v4l2.IoctlBackend("/dev/video0", transport=FakeDevice)
+        )
+        self.addCleanup(ioctl.close)
+        for name in ("power_line_frequency", "exposure_auto"):
+            self.assertEqual(controls[name].menu, ioctl.controls[name].menu)
+
+
+if __name__ == "__main__":
+    unittest.main()
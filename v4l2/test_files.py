@@ -0,0 +1,38 @@
+"""
+Atomic writes.
+
+    python -m pytest test_files.py
+"""
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from v4l2 import files
+
+
+class WriteAtomicTest(unittest.TestCase):
+    def test_data_and_rename_are_synced(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "photo.jpg")
+            events = []
+            replace = os.replace
+
+            def record_replace(src, dst):
+                events.append("replace")
+                replace(src, dst)
+
+            with mock.patch.object(
+                files.os, "fsync", side_effect=lambda fd: events.append("fsync")
+            ), mock.patch.object(files.os, "replace", side_effect=record_replace):
+                files.write_atomic(path, b"photo")
+
+            self.assertEqual(events, ["fsync", "replace", "fsync"])
+            with open(path, "rb") as photo:
+                self.assertEqual(photo.read(), b"photo")
+            self.assertEqual(os.listdir(tmp_dir), ["photo.jpg"])
+
+
+if __name__ == "__main__":
+    unittest.main()
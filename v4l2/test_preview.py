@@ -0,0 +1,44 @@
+"""
+PreviewSession against the fake device and a missing one.
+
+    python -m pytest test_preview.py
+"""
+
+import time
+import unittest
+
+from v4l2 import preview
+from v4l2.fake import FakeDevice
+
+
+class PreviewSessionTest(unittest.TestCase):
+    def session(self, device, keepalive, **kwargs):
+        return preview.PreviewSession(
+            device, fps=20, keepalive=keepalive, warmup=0, **kwargs
+        )
+
+    def test_snapshot(self):
+        session = self.session("/dev/video0", 5.0, transport=FakeDevice)
+        frame = session.snapshot()
+        self.assertTrue(frame.startswith(b"\xff\xd8"))
+        self.assertEqual(session.viewers, 0)
+
+    def test_snapshot_of_a_missing_camera_times_out(self):
+        session = self.session("/dev/video9", 0.2)
+        start_time = time.monotonic()
+        self.assertIsNone(session.snapshot())
+        self.assertLess(time.monotonic() - start_time, 1.0)
+        self.assertEqual(session.viewers, 0)
+
+    def test_frames_of_a_missing_camera_stop(self):
+        session = self.session("/dev/video9", 0.2)
+        start_time = time.monotonic()
+        self.assertEqual(list(session.frames()), [])
+        self.assertLess(
+            time.monotonic() - start_time, (session.MAX_WAIT + 1) * session.keepalive
+        )
+        self.assertEqual(session.viewers, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+"""
+Per device cache of everything that only changes when the camera does:
+capture formats, frame sizes, frame rates, control metadata and menu
+entries.
+
+The cache is a small JSON file per device, so every process (e.g. all the
+gunicorn workers of timelapse_ui) shares one enumeration. It is keyed on
+the device node's inode and timestamps. udev creates a new node when the
+camera is unplugged and plugged back in, and that invalidates the entry.
+"""
+
+import json
+import os
+import tempfile
+import threading
+
+from v4l2 import v4l2
+from v4l2.device import device_path
+from v4l2.files import write_atomic
+
+CACHE_VERSION = 1
+
+_memory = {}
+_memory_lock = threading.Lock()
+
+
+def device_key(device):
+    """
+    Identity of the device node, or None if it doesn't exist.
+    """
+    try:
+        st = os.stat(device_path(device))
+    except OSError:
+        return None
+    return [CACHE_VERSION, st.st_rdev, st.st_ino, st.st_mtime_ns, st.st_ctime_ns]
+
+
+def cache_path(device, cache_dir=None):
+    if cache_dir is None:
+        cache_dir = tempfile.gettempdir()
+    name = os.path.basename(device_path(device))
+    return os.path.join(cache_dir, "{}.capabilities.json".format(name))
+
+
+def enumerate_capabilities(device, backend=None):
+    cam_ctrl = v4l2.V4L2(device, backend)
+    try:
+        formats = cam_ctrl.get_formats()
+        resolutions = cam_ctrl.get_resolutions()
+        controls = [control.metadata() for control in cam_ctrl.controls.values()]
+    finally:
+        cam_ctrl.close()
+
+    return {
+        "formats": formats,
+        "resolutions": [list(resolution) for resolution in resolutions],
+        "controls": controls,
+    }
+
+
+def _read(path, key):
+    try:
+        with open(path, "r") as cache_file:
+            cached = json.load(cache_file)
+    except (OSError, ValueError):
+        return None
+    if cached.get("key") != key:
+        return None
+    return cached["capabilities"]
+
+
+def load(device, cache_dir=None, backend=None):
+    """
+    Return the capabilities of device, enumerating it only if neither this
+    process nor the cache file has an up to date copy.
+    """
+    key = device_key(device)
+    if key is None:
+        # Nothing to key the cache on, e.g. when only v4l2-ctl works
+        return enumerate_capabilities(device, backend)
+
+    path = cache_path(device, cache_dir)
+    with _memory_lock:
+        if path in _memory and _memory[path][0] == key:
+            return _memory[path][1]
+
+    capabilities = _read(path, key)
+    if capabilities is None:
+        capabilities = enumerate_capabilities(device, backend)
+        write_atomic(
+            path,
+            json.dumps({"key": key, "capabilities": capabilities}).encode("utf-8"),
+        )
+
+    with _memory_lock:
+        _memory[path] = (key, capabilities)
+    return capabilities
+
+
+def resolutions(device, cache_dir=None):
+    return [tuple(resolution) for resolution in load(device, cache_dir)["resolutions"]]
+
+
+def open_controls(device, cache_dir=None, backend=None):
+    """
+    V4L2 instance built from the cached control metadata. Only the current
+    control values are read from the device.
+    """
+    return v4l2.V4L2(device, backend, load(device, cache_dir, backend)["controls"])
+
+
+def invalidate(device, cache_dir=None):
+    path = cache_path(device, cache_dir)
+    with _memory_lock:
+        _memory.pop(path, None)
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
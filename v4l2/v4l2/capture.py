@@ -0,0 +1,465 @@
+import ctypes
+import errno
+import fcntl
+import os
+import struct
+import subprocess
+import tempfile
+import time
+
+from timelapse_metrics import metrics
+from v4l2 import exif
+from v4l2 import videodev2 as vd
+from v4l2.device import DeviceTransport, device_path
+from v4l2.files import write_atomic
+
+V4L2_BUF_FLAG_ERROR = 0x40
+
+# Standard Huffman tables (JPEG spec K.3). UVC cameras stream MJPEG without
+# DHT segments, which most decoders other than ffmpeg refuse to read.
+_HUFFMAN_TABLES = [
+    (0x00, [0, 1, 5, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0], bytes(range(12))),
+    (
+        0x10,
+        [0, 2, 1, 3, 3, 2, 4, 3, 5, 5, 4, 4, 0, 0, 1, 0x7D],
+        bytes.fromhex(
+            "01020300041105122131410613516107227114328191a1082342b1c11552d1f0"
+            "2433627282090a161718191a25262728292a3435363738393a43444546474849"
+            "4a535455565758595a636465666768696a737475767778797a83848586878889"
+            "8a92939495969798999aa2a3a4a5a6a7a8a9aab2b3b4b5b6b7b8b9bac2c3c4c5"
+            "c6c7c8c9cad2d3d4d5d6d7d8d9dae1e2e3e4e5e6e7e8e9eaf1f2f3f4f5f6f7f8"
+            "f9fa"
+        ),
+    ),
+    (0x01, [0, 3, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0], bytes(range(12))),
+    (
+        0x11,
+        [0, 2, 1, 2, 4, 4, 3, 4, 7, 5, 4, 4, 0, 1, 2, 0x77],
+        bytes.fromhex(
+            "000102031104052131061241510761711322328108144291a1b1c109233352f0"
+            "156272d10a162434e125f11718191a262728292a35363738393a434445464748"
+            "494a535455565758595a636465666768696a737475767778797a828384858687"
+            "88898a92939495969798999aa2a3a4a5a6a7a8a9aab2b3b4b5b6b7b8b9bac2c3"
+            "c4c5c6c7c8c9cad2d3d4d5d6d7d8d9dae2e3e4e5e6e7e8e9eaf2f3f4f5f6f7f8"
+            "f9fa"
+        ),
+    ),
+]
+
+
+def _dht_segment():
+    payload = b""
+    for table_class, bits, values in _HUFFMAN_TABLES:
+        payload += bytes([table_class]) + bytes(bits) + values
+    return b"\xff\xc4" + struct.pack(">H", len(payload) + 2) + payload
+
+
+DHT_SEGMENT = _dht_segment()
+
+
+class CaptureError(Exception):
+    pass
+
+
+class DeviceLock:
+    """
+    Advisory lock shared by every process that captures from a device (the
+    timelapse daemon and the UI preview). A process waiting for the lock
+    touches a request file, so whoever holds the device knows to let go.
+    """
+
+    # A request older than this is from a waiter that has given up
+    REQUEST_TIMEOUT = 2.0
+
+    def __init__(self, device="/dev/video0", lock_dir=None):
+        if lock_dir is None:
+            lock_dir = tempfile.gettempdir()
+        name = os.path.basename(device_path(device))
+        self.path = os.path.join(lock_dir, "{}.lock".format(name))
+        self.request_path = "{}.request".format(self.path)
+        self.fd = None
+
+    def is_held(self):
+        return self.fd is not None
+
+    def acquire(self, timeout=None):
+        """
+        Wait for the lock. Returns False if timeout (seconds) ran out first.
+        """
+        if self.fd is not None:
+            return True
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self.fd = fd
+                # Our own request shouldn't make us give the device up. Any
+                # other waiter renews theirs within 0.1s.
+                try:
+                    os.remove(self.request_path)
+                except FileNotFoundError:
+                    pass
+                return True
+            except BlockingIOError:
+                pass
+
+            self.request()
+            if deadline is not None and time.monotonic() >= deadline:
+                os.close(fd)
+                return False
+            time.sleep(0.1)
+
+    def release(self):
+        if self.fd is None:
+            return
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+    def request(self):
+        with open(self.request_path, "a"):
+            os.utime(self.request_path)
+
+    def requested(self):
+        """
+        True if another process is waiting for the device.
+        """
+        try:
+            mtime = os.stat(self.request_path).st_mtime
+        except FileNotFoundError:
+            return False
+        return time.time() - mtime < self.REQUEST_TIMEOUT
+
+
+def parse_resolution(resolution):
+    width, height = str(resolution).lower().split("x")
+    return int(width), int(height)
+
+
+def add_huffman_tables(frame):
+    """
+    Insert the standard DHT segment into an MJPEG frame that lacks one.
+    Frames that already carry Huffman tables are returned unchanged.
+    """
+    if frame[:2] != b"\xff\xd8":
+        raise CaptureError("Frame is not a JPEG")
+
+    offset = 2
+    while offset + 4 <= len(frame):
+        if frame[offset] != 0xFF:
+            raise CaptureError("Corrupt JPEG segment at {}".format(offset))
+        marker = frame[offset + 1]
+        if marker == 0xC4:
+            return frame
+        if marker == 0xDA:
+            return frame[:offset] + DHT_SEGMENT + frame[offset:]
+        (length,) = struct.unpack(">H", frame[offset + 2 : offset + 4])
+        offset += 2 + length
+
+    raise CaptureError("JPEG has no scan data")
+
+
+# What the fswebcam fallback sets with -s: auto focus, exposure and white
+# balance would hunt between photos and make the timelapse flicker.
+# z_camera_settings are applied afterwards, so a config can turn them back on
+MANUAL_CONTROLS = (
+    (vd.V4L2_CID_FOCUS_AUTO, 0),
+    (vd.V4L2_CID_EXPOSURE_AUTO, vd.V4L2_EXPOSURE_MANUAL),
+    (vd.V4L2_CID_AUTO_WHITE_BALANCE, 0),
+)
+
+
+class StreamingCapture:
+    """
+    Keeps the device open and streaming into mmap'd buffers so each photo
+    only costs a dequeue instead of a full open/negotiate/warm-up cycle.
+    """
+
+    name = "v4l2"
+
+    def __init__(
+        self,
+        device="/dev/video0",
+        resolution="1920x1080",
+        transport=DeviceTransport,
+        buffer_count=4,
+        warmup=5,
+        timeout=5.0,
+        controls=MANUAL_CONTROLS,
+    ):
+        self.device = device_path(device)
+        self.resolution = resolution
+        self.width, self.height = parse_resolution(resolution)
+        self.transport_factory = transport
+        self.buffer_count = buffer_count
+        self.warmup = warmup
+        self.timeout = timeout
+        self.controls = controls
+
+        self.transport = None
+        self.buffers = []
+        self.streaming = False
+
+    def is_open(self):
+        return self.streaming
+
+    def open(self):
+        if self.streaming:
+            return
+
+        self.transport = self.transport_factory(self.device)
+        try:
+            self._check_capabilities()
+            self._set_controls()
+            self._set_format()
+            self._map_buffers()
+
+            for index in range(len(self.buffers)):
+                self._queue(index)
+
+            self.transport.ioctl(
+                vd.VIDIOC_STREAMON, ctypes.c_int(vd.V4L2_BUF_TYPE_VIDEO_CAPTURE)
+            )
+            self.streaming = True
+
+            # Same as fswebcam -S, but only paid once per session
+            for _ in range(self.warmup):
+                self._next_frame()
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        if self.transport is None:
+            return
+
+        if self.streaming:
+            try:
+                self.transport.ioctl(
+                    vd.VIDIOC_STREAMOFF,
+                    ctypes.c_int(vd.V4L2_BUF_TYPE_VIDEO_CAPTURE),
+                )
+            except OSError:
+                pass
+            self.streaming = False
+
+        for buffer in self.buffers:
+            buffer.close()
+        self.buffers = []
+
+        self.transport.close()
+        self.transport = None
+
+    def _check_capabilities(self):
+        cap = vd.v4l2_capability()
+        self.transport.ioctl(vd.VIDIOC_QUERYCAP, cap)
+
+        caps = cap.capabilities
+        if caps & vd.V4L2_CAP_DEVICE_CAPS:
+            caps = cap.device_caps
+
+        if not caps & vd.V4L2_CAP_VIDEO_CAPTURE:
+            raise CaptureError("{} is not a capture device".format(self.device))
+        if not caps & vd.V4L2_CAP_STREAMING:
+            raise CaptureError("{} does not support streaming".format(self.device))
+
+    def _set_controls(self):
+        for control_id, value in self.controls:
+            ctrl = vd.v4l2_control()
+            ctrl.id = control_id
+            ctrl.value = value
+            try:
+                self.transport.ioctl(vd.VIDIOC_S_CTRL, ctrl)
+            except OSError as e:
+                # Like fswebcam, carry on when the camera lacks the control
+                if e.errno != errno.EINVAL:
+                    print(
+                        "Unable to set control {:#x} on {}: {}".format(
+                            control_id, self.device, e.strerror
+                        )
+                    )
+
+    def _set_format(self):
+        fmt = vd.v4l2_format()
+        fmt.type = vd.V4L2_BUF_TYPE_VIDEO_CAPTURE
+        fmt.fmt.pix.width = self.width
+        fmt.fmt.pix.height = self.height
+        fmt.fmt.pix.pixelformat = vd.V4L2_PIX_FMT_MJPEG
+        fmt.fmt.pix.field = vd.V4L2_FIELD_ANY
+        self.transport.ioctl(vd.VIDIOC_S_FMT, fmt)
+
+        if fmt.fmt.pix.pixelformat not in (vd.V4L2_PIX_FMT_MJPEG, vd.V4L2_PIX_FMT_JPEG):
+            raise CaptureError("{} does not support MJPEG".format(self.device))
+
+        if (fmt.fmt.pix.width, fmt.fmt.pix.height) != (self.width, self.height):
+            print(
+                "WARNING {} adjusted resolution to {}x{}".format(
+                    self.device, fmt.fmt.pix.width, fmt.fmt.pix.height
+                )
+            )
+            self.width = fmt.fmt.pix.width
+            self.height = fmt.fmt.pix.height
+
+    def _map_buffers(self):
+        req = vd.v4l2_requestbuffers()
+        req.count = self.buffer_count
+        req.type = vd.V4L2_BUF_TYPE_VIDEO_CAPTURE
+        req.memory = vd.V4L2_MEMORY_MMAP
+        self.transport.ioctl(vd.VIDIOC_REQBUFS, req)
+
+        if req.count < 1:
+            raise CaptureError("No capture buffers available")
+
+        for index in range(req.count):
+            buf = self._buffer(index)
+            self.transport.ioctl(vd.VIDIOC_QUERYBUF, buf)
+            self.buffers.append(self.transport.mmap(buf.m.offset, buf.length))
+
+    def _buffer(self, index=0):
+        buf = vd.v4l2_buffer()
+        buf.index = index
+        buf.type = vd.V4L2_BUF_TYPE_VIDEO_CAPTURE
+        buf.memory = vd.V4L2_MEMORY_MMAP
+        return buf
+
+    def _queue(self, index):
+        self.transport.ioctl(vd.VIDIOC_QBUF, self._buffer(index))
+
+    def _dequeue(self):
+        buf = self._buffer()
+        try:
+            self.transport.ioctl(vd.VIDIOC_DQBUF, buf)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return None
+            raise
+        return buf
+
+    def _next_frame(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            buf = self._dequeue()
+            if buf is not None:
+                if buf.flags & V4L2_BUF_FLAG_ERROR:
+                    self._queue(buf.index)
+                    continue
+                try:
+                    return bytes(self.buffers[buf.index][: buf.bytesused])
+                finally:
+                    self._queue(buf.index)
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise CaptureError("Timed out waiting for frame")
+            self.transport.wait(remaining)
+
+    def capture(self):
+        """
+        Return the JPEG data for a frame exposed after this call was made.
+        """
+        if not self.streaming:
+            self.open()
+
+        # Frames sitting in the queue were exposed while we were idle
+        for _ in range(len(self.buffers)):
+            buf = self._dequeue()
+            if buf is None:
+                break
+            self._queue(buf.index)
+
+        return add_huffman_tables(self._next_frame())
+
+    def take_photo(self, filename, timestamp=None):
+        data = self.capture()
+        if timestamp is not None:
+            # Stamp in memory so the photo is only written once
+            data = exif.add_datetime(data, timestamp)
+        return write_atomic(filename, data)
+
+
+class FswebcamCapture:
+    """
+    Fallback that spawns fswebcam for every photo.
+    """
+
+    name = "fswebcam"
+
+    def __init__(self, device="/dev/video0", resolution="1920x1080", options=None):
+        self.device = device_path(device)
+        self.resolution = resolution
+        if options is None:
+            options = [
+                "-sFocus, Auto=False",
+                "-sExposure, Auto=Manual Mode",
+                "-sWhite Balance Temperature, Auto=False",
+                "-S5",
+            ]
+        self.options = options
+
+    def is_open(self):
+        return True
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def take_photo(self, filename, timestamp=None):
+        result = metrics.run(
+            ["fswebcam", "--no-banner"]
+            + self.options
+            + ["-d", "v4l2:{}".format(self.device), "-r", self.resolution, filename],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+
+        # fswebcam seems to use stderr instead of stdout
+        rval = result.stderr.decode("utf-8")
+        if "Error" in rval and "Error querying menu" not in rval:
+            print(rval)
+            return None
+
+        if timestamp is not None:
+            exif.stamp_file(filename, timestamp)
+
+        return filename
+
+    def capture(self):
+        fd, filename = tempfile.mkstemp(".jpg")
+        os.close(fd)
+        try:
+            if self.take_photo(filename) is None:
+                raise CaptureError("fswebcam failed")
+            with open(filename, "rb") as photo:
+                return photo.read()
+        finally:
+            os.remove(filename)
+
+
+def open_capture(
+    device="/dev/video0", resolution="1920x1080", backend="v4l2", **kwargs
+):
+    """
+    Open a capture session on device. The v4l2 streaming backend is tried
+    first (unless backend is "fswebcam") and fswebcam is used if it fails.
+    """
+    if backend == "v4l2":
+        camera = StreamingCapture(device, resolution, **kwargs)
+        try:
+            camera.open()
+            return camera
+        except (OSError, CaptureError) as e:
+            print(
+                "Unable to stream from {} ({}). Falling back to fswebcam.".format(
+                    device, e
+                )
+            )
+    elif backend != "fswebcam":
+        raise ValueError("Unknown capture backend {}".format(backend))
+
+    camera = FswebcamCapture(device, resolution)
+    camera.open()
+    return camera
@@ -0,0 +1,52 @@
+import fcntl
+import mmap
+import os
+import select
+
+
+def device_path(device):
+    """
+    Accept a device index (0), index string ("0") or path ("/dev/video0")
+    and return the device node path.
+    """
+    device = str(device)
+    if device.isdigit():
+        return "/dev/video{}".format(device)
+    return device
+
+
+class DeviceTransport:
+    """
+    Thin wrapper around an open V4L2 device node. Everything that talks to
+    a device goes through ioctl(), mmap() and wait() so a FakeDevice can be
+    swapped in when there is no camera attached.
+    """
+
+    def __init__(self, path):
+        self.path = device_path(path)
+        self.fd = None
+        self.fd = os.open(self.path, os.O_RDWR | os.O_NONBLOCK)
+
+    def ioctl(self, request, arg):
+        return fcntl.ioctl(self.fd, request, arg, True)
+
+    def mmap(self, offset, length):
+        return mmap.mmap(
+            self.fd,
+            length,
+            mmap.MAP_SHARED,
+            mmap.PROT_READ | mmap.PROT_WRITE,
+            offset=offset,
+        )
+
+    def wait(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        return len(readable) > 0
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __del__(self):
+        self.close()
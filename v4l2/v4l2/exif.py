@@ -0,0 +1,197 @@
+"""
+Minimal in-process EXIF writer. Only stamps DateTimeOriginal (and
+SubSecTimeOriginal), which is all the timelapse tools need, without
+running exiftool.
+"""
+
+import os
+import struct
+from datetime import datetime
+
+from v4l2.files import write_atomic
+
+TAG_EXIF_IFD = 0x8769
+TAG_DATETIME_ORIGINAL = 0x9003
+TAG_SUBSEC_TIME_ORIGINAL = 0x9291
+
+TYPE_ASCII = 2
+TYPE_LONG = 4
+
+EXIF_HEADER = b"Exif\x00\x00"
+
+# Only the start of the file is read when looking for an existing segment
+HEADER_READ_SIZE = 65536
+
+
+class ExifError(Exception):
+    pass
+
+
+def _datetime_values(when):
+    return (
+        when.strftime("%Y:%m:%d %H:%M:%S").encode("ascii") + b"\x00",
+        "{:06d}".format(when.microsecond).encode("ascii") + b"\x00",
+    )
+
+
+def exif_segment(when):
+    """
+    Build a complete APP1 segment holding DateTimeOriginal for when.
+    """
+    datetime_original, subsec = _datetime_values(when)
+
+    exif_ifd_offset = 8 + 2 + 12 + 4
+    data_offset = exif_ifd_offset + 2 + 2 * 12 + 4
+
+    tiff = b"MM\x00\x2a" + struct.pack(">I", 8)
+    tiff += struct.pack(">H", 1)
+    tiff += struct.pack(">HHII", TAG_EXIF_IFD, TYPE_LONG, 1, exif_ifd_offset)
+    tiff += struct.pack(">I", 0)
+
+    tiff += struct.pack(">H", 2)
+    tiff += struct.pack(
+        ">HHII",
+        TAG_DATETIME_ORIGINAL,
+        TYPE_ASCII,
+        len(datetime_original),
+        data_offset,
+    )
+    tiff += struct.pack(
+        ">HHII",
+        TAG_SUBSEC_TIME_ORIGINAL,
+        TYPE_ASCII,
+        len(subsec),
+        data_offset + len(datetime_original),
+    )
+    tiff += struct.pack(">I", 0)
+    tiff += datetime_original + subsec
+
+    payload = EXIF_HEADER + tiff
+    return b"\xff\xe1" + struct.pack(">H", len(payload) + 2) + payload
+
+
+def _segments(data):
+    """
+    Yield (marker, offset, length) for each header segment before the scan.
+    length includes the marker and length bytes.
+    """
+    if data[:2] != b"\xff\xd8":
+        raise ExifError("Not a JPEG")
+
+    offset = 2
+    while offset + 4 <= len(data):
+        if data[offset] != 0xFF:
+            raise ExifError("Corrupt JPEG segment at {}".format(offset))
+        marker = data[offset + 1]
+        if marker == 0xDA:
+            return
+        (length,) = struct.unpack(">H", data[offset + 2 : offset + 4])
+        yield marker, offset, length + 2
+        offset += length + 2
+
+
+def _find_exif(data):
+    for marker, offset, length in _segments(data):
+        if marker == 0xE1 and data[offset + 4 : offset + 10] == EXIF_HEADER:
+            return offset, length
+    return None
+
+
+def _insert_offset(data):
+    # EXIF goes straight after SOI, or after APP0 when the file is JFIF
+    for marker, offset, length in _segments(data):
+        if marker == 0xE0:
+            return offset + length
+        break
+    return 2
+
+
+def _datetime_fields(data, segment_offset):
+    """
+    Return {tag: (file offset, count)} for the datetime tags in the EXIF
+    segment at segment_offset.
+    """
+    tiff_offset = segment_offset + 4 + len(EXIF_HEADER)
+    byte_order = data[tiff_offset : tiff_offset + 2]
+    if byte_order == b"MM":
+        endian = ">"
+    elif byte_order == b"II":
+        endian = "<"
+    else:
+        raise ExifError("Invalid TIFF header")
+
+    def read(fmt, offset):
+        return struct.unpack_from(endian + fmt, data, tiff_offset + offset)
+
+    def entries(ifd_offset):
+        (count,) = read("H", ifd_offset)
+        for index in range(count):
+            yield read("HHII", ifd_offset + 2 + index * 12)
+
+    fields = {}
+    (ifd0,) = read("I", 4)
+    for tag, type_, count, value in entries(ifd0):
+        if tag != TAG_EXIF_IFD:
+            continue
+        for tag, type_, count, value in entries(value):
+            if tag in (TAG_DATETIME_ORIGINAL, TAG_SUBSEC_TIME_ORIGINAL):
+                if type_ == TYPE_ASCII and count > 4:
+                    fields[tag] = (tiff_offset + value, count)
+    return fields
+
+
+def add_datetime(jpeg, when=None):
+    """
+    Return jpeg (bytes) with an EXIF segment stamped with when. Any existing
+    EXIF segment is replaced. Meant to be used on frames before they are
+    written to disk.
+    """
+    if when is None:
+        when = datetime.now()
+
+    existing = _find_exif(jpeg)
+    if existing is not None:
+        offset, length = existing
+        return jpeg[:offset] + exif_segment(when) + jpeg[offset + length :]
+
+    offset = _insert_offset(jpeg)
+    return jpeg[:offset] + exif_segment(when) + jpeg[offset:]
+
+
+def stamp_file(filename, when=None):
+    """
+    Stamp DateTimeOriginal on a JPEG file. If the file already has the tag
+    the value is overwritten in place, otherwise the segment is spliced in
+    and the file replaced with a rename. Returns the number of bytes written.
+    """
+    if when is None:
+        when = datetime.now()
+
+    with open(filename, "rb") as photo:
+        header = photo.read(HEADER_READ_SIZE)
+
+    try:
+        existing = _find_exif(header)
+        fields = {} if existing is None else _datetime_fields(header, existing[0])
+    except (ExifError, struct.error):
+        raise ExifError("Unable to parse {}".format(filename))
+
+    if TAG_DATETIME_ORIGINAL in fields and fields[TAG_DATETIME_ORIGINAL][1] == 20:
+        written = 0
+        fd = os.open(filename, os.O_WRONLY)
+        try:
+            for tag, value in zip(
+                (TAG_DATETIME_ORIGINAL, TAG_SUBSEC_TIME_ORIGINAL),
+                _datetime_values(when),
+            ):
+                if tag in fields and fields[tag][1] == len(value):
+                    written += os.pwrite(fd, value, fields[tag][0])
+        finally:
+            os.close(fd)
+        return written
+
+    with open(filename, "rb") as photo:
+        jpeg = photo.read()
+    jpeg = add_datetime(jpeg, when)
+    write_atomic(filename, jpeg)
+    return len(jpeg)
@@ -0,0 +1,432 @@
+"""
+In-memory stand-in for a V4L2 device so capture and control code can be
+exercised without a camera. FakeDevice can be passed anywhere a
+DeviceTransport factory is accepted, e.g. StreamingCapture(transport=FakeDevice)
+or IoctlBackend(0, transport=FakeDevice).
+"""
+
+import collections
+import errno
+import functools
+import math
+import struct
+import time
+
+from v4l2 import videodev2 as vd
+from v4l2.device import device_path
+
+
+def _segment(marker, payload):
+    return bytes([0xFF, marker]) + struct.pack(">H", len(payload) + 2) + payload
+
+
+@functools.lru_cache(maxsize=16)
+def _flat_scan(width, height, level):
+    # Grayscale image where every 8x8 block has the same DC value and no AC
+    # energy. The first block codes the DC difference, every other block is
+    # a zero difference followed by end-of-block.
+    dc = 8 * (int(level) - 128)
+    category = abs(dc).bit_length()
+
+    if category == 0:
+        dc_table = bytes([0x00, 1] + [0] * 15) + bytes([0])
+        first = "0"
+    else:
+        dc_table = bytes([0x00, 1, 1] + [0] * 14) + bytes([0, category])
+        if dc < 0:
+            dc += (1 << category) - 1
+        first = "10" + format(dc, "0{}b".format(category))
+    ac_table = bytes([0x10, 1] + [0] * 15) + bytes([0x00])
+
+    blocks = math.ceil(width / 8) * math.ceil(height / 8)
+    bits = first + "0" + "00" * (blocks - 1)
+    bits += "1" * (-len(bits) % 8)
+    scan = int(bits, 2).to_bytes(len(bits) // 8, "big").replace(b"\xff", b"\xff\x00")
+
+    return (
+        _segment(0xDB, bytes([0x00]) + bytes([1] * 64))
+        + _segment(0xC0, struct.pack(">BHHBBBB", 8, height, width, 1, 1, 0x11, 0))
+        + _segment(0xC4, dc_table + ac_table)
+        + _segment(0xDA, bytes([1, 1, 0x00, 0, 63, 0]))
+        + scan
+    )
+
+
+def synthetic_jpeg(width, height, level=128, comment=None):
+    """
+    Build a valid baseline JPEG of a flat gray image without needing an
+    encoder. comment (str) is stored in a COM segment so frames differ.
+    """
+    header = b"\xff\xd8"
+    if comment is not None:
+        header += _segment(0xFE, comment.encode("utf-8"))
+    return header + _flat_scan(width, height, level) + b"\xff\xd9"
+
+
+# Roughly what a Logitech C920 reports
+DEFAULT_CONTROLS = [
+    {"id": 0x00980001, "name": "User Controls", "type": vd.V4L2_CTRL_TYPE_CTRL_CLASS},
+    {"id": 0x00980900, "name": "Brightness", "max": 255, "default": 128},
+    {"id": 0x00980901, "name": "Contrast", "max": 255, "default": 128},
+    {"id": 0x00980902, "name": "Saturation", "max": 255, "default": 128},
+    {
+        "id": 0x0098090C,
+        "name": "White Balance Temperature, Auto",
+        "type": vd.V4L2_CTRL_TYPE_BOOLEAN,
+        "max": 1,
+        "default": 1,
+    },
+    {"id": 0x00980913, "name": "Gain", "max": 255, "default": 0},
+    {
+        "id": 0x00980918,
+        "name": "Power Line Frequency",
+        "type": vd.V4L2_CTRL_TYPE_MENU,
+        "max": 2,
+        "default": 2,
+        "menu": {0: "Disabled", 1: "50 Hz", 2: "60 Hz"},
+    },
+    {
+        "id": 0x0098091A,
+        "name": "White Balance Temperature",
+        "min": 2000,
+        "max": 6500,
+        "default": 4000,
+        "auto": (0x0098090C, 0),
+    },
+    {"id": 0x0098091B, "name": "Sharpness", "max": 255, "default": 128},
+    {"id": 0x0098091C, "name": "Backlight Compensation", "max": 1, "default": 0},
+    {"id": 0x009A0001, "name": "Camera Controls", "type": vd.V4L2_CTRL_TYPE_CTRL_CLASS},
+    {
+        "id": 0x009A0901,
+        "name": "Exposure, Auto",
+        "type": vd.V4L2_CTRL_TYPE_MENU,
+        "max": 3,
+        "default": 3,
+        "menu": {1: "Manual Mode", 3: "Aperture Priority Mode"},
+    },
+    {
+        "id": 0x009A0902,
+        "name": "Exposure (Absolute)",
+        "min": 3,
+        "max": 2047,
+        "default": 250,
+        "auto": (0x009A0901, 1),
+    },
+    {
+        "id": 0x009A0903,
+        "name": "Exposure, Auto Priority",
+        "type": vd.V4L2_CTRL_TYPE_BOOLEAN,
+        "max": 1,
+        "default": 0,
+    },
+    {
+        "id": 0x009A090A,
+        "name": "Focus (absolute)",
+        "max": 250,
+        "step": 5,
+        "default": 0,
+        "auto": (0x009A090C, 0),
+    },
+    {
+        "id": 0x009A090C,
+        "name": "Focus, Auto",
+        "type": vd.V4L2_CTRL_TYPE_BOOLEAN,
+        "max": 1,
+        "default": 1,
+    },
+    {
+        "id": 0x009A090D,
+        "name": "Zoom, Absolute",
+        "min": 100,
+        "max": 500,
+        "default": 100,
+    },
+]
+
+DEFAULT_RESOLUTIONS = [(640, 480), (800, 600), (1280, 720), (1920, 1080)]
+
+
+class _FakeMapping:
+    # Just enough of the mmap interface for StreamingCapture
+    def __init__(self, buffer, length):
+        self.view = memoryview(buffer)[:length]
+
+    def __getitem__(self, key):
+        return self.view[key]
+
+    def close(self):
+        self.view.release()
+
+
+class FakeDevice:
+    """
+    Emulates the capture and control ioctls of a UVC camera. Frames are
+    produced at frame_rate into whichever buffers are queued, and dropped
+    when none are, just like a real sensor.
+    """
+
+    PAGE_SIZE = 4096
+
+    def __init__(
+        self,
+        path="/dev/video0",
+        frame_rate=30,
+        level=128,
+        clock=time.monotonic,
+        controls=DEFAULT_CONTROLS,
+        resolutions=DEFAULT_RESOLUTIONS,
+    ):
+        self.path = device_path(path)
+        self.frame_period = 1.0 / frame_rate
+        self.level = level
+        self.clock = clock
+        self.closed = False
+
+        self.width = 640
+        self.height = 480
+        self.sizeimage = 0
+        self.buffers = []
+        self.queued = collections.deque()
+        self.done = collections.deque()
+        self.streaming = False
+        self.sequence = 0
+        self.next_frame_time = 0
+
+        self.controls = {}
+        for control in controls:
+            control = dict(control)
+            control.setdefault("type", vd.V4L2_CTRL_TYPE_INTEGER)
+            control.setdefault("min", 0)
+            control.setdefault("max", 0)
+            control.setdefault("step", 1)
+            control.setdefault("default", 0)
+            control.setdefault("flags", 0)
+            control["value"] = control["default"]
+            self.controls[control["id"]] = control
+        self.resolutions = resolutions
+        self.formats = [
+            (vd.V4L2_PIX_FMT_YUYV, b"YUYV 4:2:2"),
+            (vd.V4L2_PIX_FMT_MJPEG, b"Motion-JPEG"),
+        ]
+
+        self.ioctl_count = collections.Counter()
+        self._handlers = {
+            vd.VIDIOC_QUERYCAP: self._querycap,
+            vd.VIDIOC_QUERYCTRL: self._queryctrl,
+            vd.VIDIOC_QUERYMENU: self._querymenu,
+            vd.VIDIOC_G_CTRL: self._g_ctrl,
+            vd.VIDIOC_S_CTRL: self._s_ctrl,
+            vd.VIDIOC_G_EXT_CTRLS: self._g_ext_ctrls,
+            vd.VIDIOC_S_EXT_CTRLS: self._s_ext_ctrls,
+            vd.VIDIOC_ENUM_FMT: self._enum_fmt,
+            vd.VIDIOC_ENUM_FRAMESIZES: self._enum_framesizes,
+            vd.VIDIOC_ENUM_FRAMEINTERVALS: self._enum_frameintervals,
+            vd.VIDIOC_S_FMT: self._s_fmt,
+            vd.VIDIOC_REQBUFS: self._reqbufs,
+            vd.VIDIOC_QUERYBUF: self._querybuf,
+            vd.VIDIOC_QBUF: self._qbuf,
+            vd.VIDIOC_DQBUF: self._dqbuf,
+            vd.VIDIOC_STREAMON: self._streamon,
+            vd.VIDIOC_STREAMOFF: self._streamoff,
+        }
+
+    def ioctl(self, request, arg):
+        if self.closed:
+            raise OSError(errno.EBADF, "Device closed")
+        if request not in self._handlers:
+            raise OSError(errno.ENOTTY, "Inappropriate ioctl for device")
+        self.ioctl_count[request] += 1
+        return self._handlers[request](arg)
+
+    def mmap(self, offset, length):
+        return _FakeMapping(self.buffers[offset // self.PAGE_SIZE], length)
+
+    def wait(self, timeout):
+        self._advance()
+        if self.done:
+            return True
+        delay = min(timeout, max(0, self.next_frame_time - self.clock()))
+        time.sleep(delay)
+        self._advance()
+        return len(self.done) > 0
+
+    def close(self):
+        self.closed = True
+
+    def _advance(self):
+        if not self.streaming:
+            return
+
+        now = self.clock()
+        while now >= self.next_frame_time:
+            if self.queued:
+                index = self.queued.popleft()
+                frame = synthetic_jpeg(
+                    self.width,
+                    self.height,
+                    self.level,
+                    "fake frame {}".format(self.sequence),
+                )
+                self.buffers[index][: len(frame)] = frame
+                self.done.append((index, len(frame), self.sequence))
+                self.next_frame_time += self.frame_period
+            else:
+                # No buffers queued: the sensor keeps running and drops frames
+                missed = math.floor((now - self.next_frame_time) / self.frame_period)
+                self.next_frame_time += (missed + 1) * self.frame_period
+            self.sequence += 1
+
+    def _querycap(self, cap):
+        cap.driver = b"fake"
+        cap.card = b"Fake Camera"
+        cap.bus_info = self.path.encode("utf-8")
+        cap.capabilities = (
+            vd.V4L2_CAP_VIDEO_CAPTURE | vd.V4L2_CAP_STREAMING | vd.V4L2_CAP_DEVICE_CAPS
+        )
+        cap.device_caps = vd.V4L2_CAP_VIDEO_CAPTURE | vd.V4L2_CAP_STREAMING
+
+    def _control(self, ctrl_id):
+        if ctrl_id not in self.controls:
+            raise OSError(errno.EINVAL, "Invalid argument")
+        return self.controls[ctrl_id]
+
+    def _flags(self, control):
+        flags = control["flags"]
+        if "auto" in control:
+            auto_id, manual_value = control["auto"]
+            if self.controls[auto_id]["value"] != manual_value:
+                flags |= vd.V4L2_CTRL_FLAG_INACTIVE
+        return flags
+
+    def _queryctrl(self, qctrl):
+        if qctrl.id & vd.V4L2_CTRL_FLAG_NEXT_CTRL:
+            after = qctrl.id & ~vd.V4L2_CTRL_FLAG_NEXT_CTRL
+            following = [ctrl_id for ctrl_id in self.controls if ctrl_id > after]
+            if not following:
+                raise OSError(errno.EINVAL, "Invalid argument")
+            control = self.controls[min(following)]
+        else:
+            control = self._control(qctrl.id)
+
+        qctrl.id = control["id"]
+        qctrl.type = control["type"]
+        qctrl.name = control["name"].encode("utf-8")
+        qctrl.minimum = control["min"]
+        qctrl.maximum = control["max"]
+        qctrl.step = control["step"]
+        qctrl.default_value = control["default"]
+        qctrl.flags = self._flags(control)
+
+    def _querymenu(self, querymenu):
+        menu = self._control(querymenu.id).get("menu", {})
+        if querymenu.index not in menu:
+            raise OSError(errno.EINVAL, "Invalid argument")
+        querymenu.name = menu[querymenu.index].encode("utf-8")
+
+    def _g_ctrl(self, ctrl):
+        control = self._control(ctrl.id)
+        if control["type"] == vd.V4L2_CTRL_TYPE_CTRL_CLASS:
+            raise OSError(errno.EACCES, "Permission denied")
+        ctrl.value = control["value"]
+
+    def _s_ctrl(self, ctrl):
+        control = self._control(ctrl.id)
+        if control["type"] == vd.V4L2_CTRL_TYPE_CTRL_CLASS:
+            raise OSError(errno.EACCES, "Permission denied")
+        if not control["min"] <= ctrl.value <= control["max"]:
+            raise OSError(errno.ERANGE, "Numerical result out of range")
+        if "menu" in control and ctrl.value not in control["menu"]:
+            raise OSError(errno.EINVAL, "Invalid argument")
+
+        # Round to the nearest step like the control framework does
+        step = control["step"]
+        value = control["min"] + round((ctrl.value - control["min"]) / step) * step
+        control["value"] = min(value, control["max"])
+        ctrl.value = control["value"]
+
+    def _ext_ctrls(self, ext_ctrls, handler):
+        # Like the control framework: every control is checked against a
+        # copy first, so a bad one fails the call before anything changes
+        saved = {ctrl_id: dict(control) for ctrl_id, control in self.controls.items()}
+        for index in range(ext_ctrls.count):
+            ext_ctrl = ext_ctrls.controls[index]
+            ctrl = vd.v4l2_control(ext_ctrl.id, ext_ctrl.value)
+            try:
+                handler(ctrl)
+            except OSError:
+                ext_ctrls.error_idx = index
+                self.controls = saved
+                raise
+            ext_ctrl.value = ctrl.value
+
+    def _g_ext_ctrls(self, ext_ctrls):
+        self._ext_ctrls(ext_ctrls, self._g_ctrl)
+
+    def _s_ext_ctrls(self, ext_ctrls):
+        self._ext_ctrls(ext_ctrls, self._s_ctrl)
+
+    def _enum_fmt(self, fmtdesc):
+        if fmtdesc.index >= len(self.formats):
+            raise OSError(errno.EINVAL, "Invalid argument")
+        fmtdesc.pixelformat, fmtdesc.description = self.formats[fmtdesc.index]
+
+    def _enum_framesizes(self, frmsize):
+        if frmsize.index >= len(self.resolutions):
+            raise OSError(errno.EINVAL, "Invalid argument")
+        frmsize.type = vd.V4L2_FRMSIZE_TYPE_DISCRETE
+        frmsize.discrete.width, frmsize.discrete.height = self.resolutions[
+            frmsize.index
+        ]
+
+    def _enum_frameintervals(self, frmival):
+        if (frmival.width, frmival.height) not in self.resolutions:
+            raise OSError(errno.EINVAL, "Invalid argument")
+        rates = [rate for rate in (30, 15, 5) if rate <= 1 / self.frame_period]
+        if frmival.index >= len(rates):
+            raise OSError(errno.EINVAL, "Invalid argument")
+        frmival.type = vd.V4L2_FRMIVAL_TYPE_DISCRETE
+        frmival.discrete.numerator = 1
+        frmival.discrete.denominator = rates[frmival.index]
+
+    def _s_fmt(self, fmt):
+        if self.streaming:
+            raise OSError(errno.EBUSY, "Device or resource busy")
+        self.width = fmt.fmt.pix.width
+        self.height = fmt.fmt.pix.height
+        fmt.fmt.pix.pixelformat = vd.V4L2_PIX_FMT_MJPEG
+        fmt.fmt.pix.sizeimage = self.width * self.height * 2
+        self.sizeimage = fmt.fmt.pix.sizeimage
+
+    def _reqbufs(self, req):
+        if self.streaming:
+            raise OSError(errno.EBUSY, "Device or resource busy")
+        self.buffers = [bytearray(self.sizeimage) for _ in range(req.count)]
+        self.queued.clear()
+        self.done.clear()
+
+    def _querybuf(self, buf):
+        if buf.index >= len(self.buffers):
+            raise OSError(errno.EINVAL, "Invalid argument")
+        buf.length = self.sizeimage
+        buf.m.offset = buf.index * self.PAGE_SIZE
+
+    def _qbuf(self, buf):
+        if buf.index >= len(self.buffers):
+            raise OSError(errno.EINVAL, "Invalid argument")
+        self.queued.append(buf.index)
+
+    def _dqbuf(self, buf):
+        self._advance()
+        if not self.done:
+            raise OSError(errno.EAGAIN, "Resource temporarily unavailable")
+        buf.index, buf.bytesused, buf.sequence = self.done.popleft()
+        buf.flags = 0
+
+    def _streamon(self, buf_type):
+        self.streaming = True
+        self.next_frame_time = self.clock() + self.frame_period
+
+    def _streamoff(self, buf_type):
+        self.streaming = False
+        self.queued.clear()
+        self.done.clear()
@@ -0,0 +1,189 @@
+"""
+Shared live preview. While anyone is watching, one thread captures frames
+at a fixed rate and every viewer is handed the same JPEG, so several
+browser tabs cost a single capture session instead of one each.
+
+The device is held with a DeviceLock and given up as soon as another
+process (the timelapse daemon) asks for it.
+"""
+
+import threading
+import time
+
+from v4l2 import capture
+
+
+class PreviewSession:
+    # Seconds to keep the camera open after the last viewer leaves, so a
+    # page reload doesn't pay for a new open/warm-up
+    LINGER = 2.0
+
+    # Seconds to stay off the device after handing it over
+    YIELD_TIME = 1.0
+
+    # Keepalive periods without any frame before a viewer gives up
+    MAX_WAIT = 3
+
+    def __init__(
+        self,
+        device="/dev/video0",
+        resolution="640x480",
+        fps=5,
+        backend="v4l2",
+        keepalive=5.0,
+        **kwargs
+    ):
+        self.device = device
+        self.resolution = resolution
+        self.interval = 1.0 / fps
+        self.backend = backend
+        self.keepalive = keepalive
+        self.capture_options = kwargs
+        self.lock = capture.DeviceLock(device)
+
+        self.condition = threading.Condition()
+        self.thread = None
+        self.viewers = 0
+        self.frame = None
+        self.frame_number = 0
+
+        self.captured = 0
+        self.yields = 0
+
+    def _join(self):
+        with self.condition:
+            self.viewers += 1
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._run, name="preview", daemon=True
+                )
+                self.thread.start()
+
+    def _leave(self):
+        with self.condition:
+            self.viewers -= 1
+
+    def frames(self):
+        """
+        Yield JPEG frames as they are captured. When no new frame arrives
+        for keepalive seconds (the daemon has the camera) the last one is
+        sent again so dead connections are noticed. Stops after MAX_WAIT
+        keepalive periods without any frame (the camera can't be opened).
+        """
+        self._join()
+        try:
+            last = None
+            waited = 0
+            while True:
+                with self.condition:
+                    arrived = self.condition.wait_for(
+                        lambda: self.frame_number != last, self.keepalive
+                    )
+                    last = self.frame_number
+                    frame = self.frame
+                if frame is not None:
+                    waited = 0
+                    yield frame
+                elif not arrived:
+                    waited += 1
+                    if waited >= self.MAX_WAIT:
+                        print("No preview frames from {}".format(self.device))
+                        return
+        finally:
+            self._leave()
+
+    def snapshot(self, timeout=None):
+        """
+        Return the latest frame, or None if there is none within timeout
+        seconds (default: keepalive).
+        """
+        self._join()
+        try:
+            with self.condition:
+                if not self.condition.wait_for(
+                    lambda: self.frame is not None,
+                    self.keepalive if timeout is None else timeout,
+                ):
+                    return None
+                return self.frame
+        finally:
+            self._leave()
+
+    def _stop(self):
+        """
+        Stop the thread unless a viewer arrived while the camera was closed.
+        """
+        with self.condition:
+            if self.viewers:
+                return False
+            self.thread = None
+            self.frame = None
+            return True
+
+    def _open(self):
+        if not self.lock.acquire(timeout=self.interval):
+            return None
+        try:
+            return capture.open_capture(
+                self.device, self.resolution, self.backend, **self.capture_options
+            )
+        except (OSError, capture.CaptureError) as e:
+            print("Unable to open {} for preview ({})".format(self.device, e))
+            self.lock.release()
+            time.sleep(self.YIELD_TIME)
+            return None
+
+    def _close(self, camera):
+        if camera is not None:
+            camera.close()
+        self.lock.release()
+
+    def _run(self):
+        camera = None
+        idle_since = time.monotonic()
+        next_time = time.monotonic()
+        try:
+            while True:
+                with self.condition:
+                    if self.viewers:
+                        idle_since = time.monotonic()
+                if time.monotonic() - idle_since >= self.LINGER:
+                    self._close(camera)
+                    camera = None
+                    if self._stop():
+                        return
+
+                if camera is None:
+                    camera = self._open()
+                    if camera is None:
+                        continue
+
+                try:
+                    frame = camera.capture()
+                except (OSError, capture.CaptureError) as e:
+                    print("Preview capture failed: {}".format(e))
+                    self._close(camera)
+                    camera = None
+                    time.sleep(self.YIELD_TIME)
+                    continue
+
+                with self.condition:
+                    self.frame = frame
+                    self.frame_number += 1
+                    self.condition.notify_all()
+                self.captured += 1
+
+                if self.lock.requested():
+                    self._close(camera)
+                    camera = None
+                    self.yields += 1
+                    time.sleep(self.YIELD_TIME)
+                    continue
+
+                next_time = max(next_time + self.interval, time.monotonic())
+                time.sleep(max(0, next_time - time.monotonic()))
+        except BaseException:
+            self._close(camera)
+            with self.condition:
+                self.thread = None
+            raise
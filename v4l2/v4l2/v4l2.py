@@ -1,23 +1,73 @@
+import errno
 import re
 import subprocess
 
+from timelapse_metrics import metrics
+from v4l2 import videodev2 as vd
+from v4l2.device import DeviceTransport, device_path
+
+CTRL_TYPES = {
+    vd.V4L2_CTRL_TYPE_INTEGER: "int",
+    vd.V4L2_CTRL_TYPE_BOOLEAN: "bool",
+    vd.V4L2_CTRL_TYPE_MENU: "menu",
+    vd.V4L2_CTRL_TYPE_BUTTON: "button",
+    vd.V4L2_CTRL_TYPE_INTEGER64: "int64",
+    vd.V4L2_CTRL_TYPE_STRING: "str",
+    vd.V4L2_CTRL_TYPE_BITMASK: "bitmask",
+    vd.V4L2_CTRL_TYPE_INTEGER_MENU: "intmenu",
+}
+
+# Same names and order v4l2-ctl uses when printing flags=
+CTRL_FLAGS = [
+    (vd.V4L2_CTRL_FLAG_DISABLED, "disabled"),
+    (vd.V4L2_CTRL_FLAG_GRABBED, "grabbed"),
+    (vd.V4L2_CTRL_FLAG_READ_ONLY, "read-only"),
+    (vd.V4L2_CTRL_FLAG_UPDATE, "update"),
+    (vd.V4L2_CTRL_FLAG_INACTIVE, "inactive"),
+    (vd.V4L2_CTRL_FLAG_SLIDER, "slider"),
+    (vd.V4L2_CTRL_FLAG_WRITE_ONLY, "write-only"),
+    (vd.V4L2_CTRL_FLAG_VOLATILE, "volatile"),
+]
+
+# A menu entry under its control in v4l2-ctl -L ("1: 50 Hz")
+MENU_ENTRY = re.compile(r"([0-9]+): (.*)")
+
+
+def control_name(name):
+    """
+    Convert a driver control name ("White Balance Temperature, Auto") into
+    the identifier v4l2-ctl uses ("white_balance_temperature_auto").
+    """
+    if isinstance(name, bytes):
+        name = name.decode("utf-8", "replace")
+    words = re.findall(r"[0-9A-Za-z]+", name)
+    return "_".join(words).lower()
+
 
 class V4L2_Ctrl:
-    def __init__(self, control_string, device):
+    def __init__(self, control_string, device, backend=None):
         self.limits = {}
+        self.menu = {}
+        self.id = None
         self.name = None
         self.type = None
         self.value = None
         self.device = device
 
+        if backend is None:
+            backend = CtlBackend(device)
+        self.backend = backend
+
+        if control_string is None:
+            return
+
         description, limits = control_string.split(":")
         description = description.strip()
 
         self.name, address, data_type = description.split(" ")
+        self.id = int(address, 16)
         self.type = data_type.strip("()")
 
-        # TODO - list control menu options
-
         for limit_str in limits.strip().split(" "):
             name, value = limit_str.split("=")
             if name == "value":
@@ -28,39 +78,127 @@ class V4L2_Ctrl:
                 except ValueError:
                     self.limits[name] = value
 
+    def readable(self):
+        return self.type in ("int", "bool", "menu", "intmenu", "bitmask") and (
+            "write-only" not in str(self.limits.get("flags", ""))
+        )
+
+    def check(self, value):
+        """
+        Make sure value is within limits (if any)
+        """
+        if "min" in self.limits and value < self.limits["min"]:
+            raise ValueError("Invalid value (min)")
+
+        if "max" in self.limits and value > self.limits["max"]:
+            raise ValueError("Invalid value (max)")
+
     def get(self):
-        result = subprocess.run(
-            ["v4l2-ctl", "-d", str(self.device), "-C", self.name],
+        self.value = self.backend.get(self)
+        return self.value
+
+    def set(self, value):
+        self.check(value)
+
+        # Verify the new value matches the setting
+        if self.backend.set(self, value) != value:
+            print("WARNING Value does not match. {} {}".format(value, self.value))
+
+        return self.value
+
+    def metadata(self):
+        """
+        Everything about the control except its state. Whether a control
+        is inactive depends on the value of others, so that flag is left
+        out.
+        """
+        limits = dict(self.limits)
+        if "flags" in limits:
+            flags = [
+                flag for flag in str(limits["flags"]).split(",") if flag != "inactive"
+            ]
+            if flags:
+                limits["flags"] = ",".join(flags)
+            else:
+                del limits["flags"]
+        return {
+            "id": self.id,
+            "name": self.name,
+            "type": self.type,
+            "limits": limits,
+            "menu": dict(self.menu),
+        }
+
+    def __repr__(self):
+        string = "V4L2_Ctrl({} ({}) value={})[{}]".format(
+            self.name, self.type, self.value, self.limits
+        )
+        return string
+
+
+class CtlBackend:
+    """
+    Runs v4l2-ctl for every operation.
+    """
+
+    name = "v4l2-ctl"
+
+    def __init__(self, device):
+        self.device = device
+
+    def close(self):
+        pass
+
+    def list_ctrls(self):
+        result = metrics.run(
+            ["v4l2-ctl", "-d", str(self.device), "-L"], stdout=subprocess.PIPE
+        )
+        controls = []
+        for line in result.stdout.decode("utf-8").split("\n"):
+            control_string = line.strip()
+            if len(control_string) == 0:
+                continue
+            entry = MENU_ENTRY.fullmatch(control_string)
+            if entry is not None and controls:
+                control = controls[-1]
+                index, name = int(entry.group(1)), entry.group(2)
+                if control.type == "intmenu":
+                    # "0: 24000000 (0x016e3600)"
+                    name = int(name.split(" ")[0])
+                control.menu[index] = name
+            else:
+                controls.append(V4L2_Ctrl(control_string, self.device, self))
+        return controls
+
+    def get_flags(self, controls):
+        flags = {
+            control.name: control.limits.get("flags", "")
+            for control in self.list_ctrls()
+        }
+        return [str(flags.get(control.name, "")) for control in controls]
+
+    def get(self, control):
+        result = metrics.run(
+            ["v4l2-ctl", "-d", str(self.device), "-C", control.name],
             stdout=subprocess.PIPE,
         )
         name, value = result.stdout.decode("utf-8").strip().split(": ")
-        if name != self.name:
+        if name != control.name:
             raise ValueError("Invalid control name")
 
         if value is None:
             raise ValueError("Invalid value")
-        else:
-            self.value = int(value)
 
-        return self.value
-
-    def set(self, value):
-
-        # Make sure value is within limits (if any)
-        if "min" in self.limits and value < self.limits["min"]:
-            raise ValueError("Invalid value (min)")
+        return int(value)
 
-        if "max" in self.limits and value > self.limits["max"]:
-            raise ValueError("Invalid value (max)")
-
-        # Set limit
-        result = subprocess.run(
+    def set(self, control, value):
+        result = metrics.run(
             [
                 "v4l2-ctl",
                 "-d",
                 str(self.device),
                 "-c",
-                "{}={}".format(self.name, value),
+                "{}={}".format(control.name, value),
             ],
             stdout=subprocess.PIPE,
         )
@@ -71,37 +209,54 @@ class V4L2_Ctrl:
             print(output)
             raise ValueError("Unable to set value")
 
-        # Verify the new value matches the setting
-        if self.get() != value:
-            print("WARNING Value does not match. {} {}".format(value, self.value))
+        return control.get()
 
-        return self.value
-
-    def __repr__(self):
-        string = "V4L2_Ctrl({} ({}) value={})[{}]".format(
-            self.name, self.type, self.value, self.limits
+    def get_many(self, controls):
+        if not controls:
+            return []
+        result = metrics.run(
+            [
+                "v4l2-ctl",
+                "-d",
+                str(self.device),
+                "-C",
+                ",".join(control.name for control in controls),
+            ],
+            stdout=subprocess.PIPE,
         )
-        return string
-
+        values = {}
+        for line in result.stdout.decode("utf-8").split("\n"):
+            if ": " in line:
+                name, value = line.strip().split(": ")
+                values[name] = int(value)
 
-class V4L2:
-    def __init__(self, device=0):
-        self.device = device
-        self.controls = {}
-        self.get_ctrls()
+        if len(values) != len(controls):
+            raise ValueError("Unable to read values")
+        return [values[control.name] for control in controls]
 
-    def get_ctrls(self):
-        result = subprocess.run(
-            ["v4l2-ctl", "-d", str(self.device), "-l"], stdout=subprocess.PIPE
+    def set_many(self, values):
+        if not values:
+            return
+        result = metrics.run(
+            [
+                "v4l2-ctl",
+                "-d",
+                str(self.device),
+                "-c",
+                ",".join(
+                    "{}={}".format(control.name, value) for control, value in values
+                ),
+            ],
+            stdout=subprocess.PIPE,
         )
-        for line in result.stdout.decode("utf-8").split("\n"):
-            control_string = line.strip()
-            if len(control_string) > 0:
-                control = V4L2_Ctrl(control_string, self.device)
-                self.controls[control.name] = control
+        output = result.stdout.decode("utf-8").strip()
+
+        # v4l2-ctl carries on with the other controls when one fails
+        if len(output) > 0:
+            print(output)
 
     def get_resolutions(self):
-        result = subprocess.run(
+        result = metrics.run(
             ["v4l2-ctl", "-d", str(self.device), "--list-formats-ext"],
             stdout=subprocess.PIPE,
         )
@@ -117,6 +272,466 @@ class V4L2:
 
         return sorted(resolutions)
 
+    def get_formats(self):
+        result = metrics.run(
+            ["v4l2-ctl", "-d", str(self.device), "--list-formats-ext"],
+            stdout=subprocess.PIPE,
+        )
+        format_re = re.compile(r"'(?P<fourcc>[^']{1,4})'(?: \((?P<description>.*)\))?")
+        size_re = re.compile(r"Size: \w+ (?P<width>[0-9]+)x(?P<height>[0-9]+)")
+        fps_re = re.compile(r"\((?P<fps>[0-9.]+) fps\)")
+
+        formats = []
+        for line in result.stdout.decode("utf-8").split("\n"):
+            match = format_re.search(line)
+            if match and ("]:" in line or "Pixel Format" in line):
+                formats.append(
+                    {
+                        "fourcc": match["fourcc"].ljust(4),
+                        "description": match["description"] or "",
+                        "sizes": [],
+                    }
+                )
+                continue
+            if re.match(r"\s*Name\s*:", line) and formats:
+                formats[-1]["description"] = line.split(":", 1)[1].strip()
+                continue
+
+            match = size_re.search(line)
+            if match and formats:
+                formats[-1]["sizes"].append(
+                    {
+                        "width": int(match["width"]),
+                        "height": int(match["height"]),
+                        "fps": [],
+                    }
+                )
+                continue
+
+            match = fps_re.search(line)
+            if match and formats and formats[-1]["sizes"]:
+                formats[-1]["sizes"][-1]["fps"].append(float(match["fps"]))
+
+        return formats
+
+
+class IoctlBackend:
+    """
+    Talks to the device directly with VIDIOC_* ioctls on a single open file
+    descriptor. transport can be swapped for v4l2.fake.FakeDevice.
+    """
+
+    name = "ioctl"
+
+    def __init__(self, device, transport=DeviceTransport):
+        self.device = device
+        self.transport = transport(device_path(device))
+
+    def close(self):
+        self.transport.close()
+
+    def _ioctl(self, request, arg):
+        try:
+            self.transport.ioctl(request, arg)
+        except OSError as e:
+            if e.errno == errno.EINVAL:
+                return False
+            raise
+        return True
+
+    def list_ctrls(self):
+        controls = []
+        qctrl = vd.v4l2_queryctrl()
+        qctrl.id = vd.V4L2_CTRL_FLAG_NEXT_CTRL
+        while self._ioctl(vd.VIDIOC_QUERYCTRL, qctrl):
+            if (
+                not qctrl.flags & vd.V4L2_CTRL_FLAG_DISABLED
+                and qctrl.type in CTRL_TYPES
+            ):
+                controls.append(self._make_ctrl(qctrl))
+            qctrl.id |= vd.V4L2_CTRL_FLAG_NEXT_CTRL
+
+        # Read all the current values with a single ioctl
+        readable = [control for control in controls if control.readable()]
+        for control, value in zip(readable, self.get_many(readable)):
+            control.value = value
+
+        return controls
+
+    def _make_ctrl(self, qctrl):
+        control = V4L2_Ctrl(None, self.device, self)
+        control.id = qctrl.id
+        control.name = control_name(qctrl.name)
+        control.type = CTRL_TYPES[qctrl.type]
+
+        # Mirror the limits v4l2-ctl -L reports for each type
+        if control.type in ("int", "int64", "menu", "intmenu"):
+            control.limits["min"] = qctrl.minimum
+        if control.type in ("int", "int64", "menu", "intmenu", "bitmask"):
+            control.limits["max"] = qctrl.maximum
+        if control.type in ("int", "int64"):
+            control.limits["step"] = qctrl.step
+        if control.type != "button":
+            control.limits["default"] = qctrl.default_value
+
+        flags = [name for flag, name in CTRL_FLAGS if qctrl.flags & flag]
+        if flags:
+            control.limits["flags"] = ",".join(flags)
+
+        if control.type in ("menu", "intmenu"):
+            querymenu = vd.v4l2_querymenu()
+            querymenu.id = qctrl.id
+            for index in range(qctrl.minimum, qctrl.maximum + 1):
+                querymenu.index = index
+                if self._ioctl(vd.VIDIOC_QUERYMENU, querymenu):
+                    if control.type == "menu":
+                        control.menu[index] = querymenu.name.decode("utf-8")
+                    else:
+                        control.menu[index] = querymenu.value
+
+        return control
+
+    def get_flags(self, controls):
+        flags = []
+        qctrl = vd.v4l2_queryctrl()
+        for control in controls:
+            qctrl.id = control.id
+            if self._ioctl(vd.VIDIOC_QUERYCTRL, qctrl):
+                flags.append(
+                    ",".join(name for flag, name in CTRL_FLAGS if qctrl.flags & flag)
+                )
+            else:
+                flags.append("")
+        return flags
+
+    def get(self, control):
+        ctrl = vd.v4l2_control()
+        ctrl.id = control.id
+        if not self._ioctl(vd.VIDIOC_G_CTRL, ctrl):
+            raise ValueError("Invalid control name")
+        return ctrl.value
+
+    def set(self, control, value):
+        ctrl = vd.v4l2_control()
+        ctrl.id = control.id
+        ctrl.value = value
+        try:
+            self.transport.ioctl(vd.VIDIOC_S_CTRL, ctrl)
+        except OSError as e:
+            print("{}: {}".format(control.name, e.strerror))
+            raise ValueError("Unable to set value")
+
+        # Drivers write back the value they actually applied
+        control.value = ctrl.value
+        return control.value
+
+    def _ext_ctrls(self, request, controls, values=None):
+        array = (vd.v4l2_ext_control * len(controls))()
+        for index, control in enumerate(controls):
+            array[index].id = control.id
+            if values is not None:
+                array[index].value = values[index]
+
+        ext_ctrls = vd.v4l2_ext_controls()
+        ext_ctrls.which = vd.V4L2_CTRL_WHICH_CUR_VAL
+        ext_ctrls.count = len(controls)
+        ext_ctrls.controls = array
+        self.transport.ioctl(request, ext_ctrls)
+        return [item.value for item in array]
+
+    def get_many(self, controls):
+        if not controls:
+            return []
+        try:
+            return self._ext_ctrls(vd.VIDIOC_G_EXT_CTRLS, controls)
+        except OSError:
+            return [self.get(control) for control in controls]
+
+    def set_many(self, values):
+        if not values:
+            return
+        controls = [control for control, _ in values]
+        try:
+            # One ioctl for the lot. Either all of them are set or none are
+            self._ext_ctrls(
+                vd.VIDIOC_S_EXT_CTRLS, controls, [value for _, value in values]
+            )
+            return
+        except OSError:
+            pass
+
+        # Set them one by one so a single bad control doesn't stop the rest
+        for control, value in values:
+            try:
+                self.set(control, value)
+            except ValueError:
+                pass
+
+    def get_resolutions(self):
+        resolutions = set()
+        fmtdesc = vd.v4l2_fmtdesc()
+        fmtdesc.type = vd.V4L2_BUF_TYPE_VIDEO_CAPTURE
+        while self._ioctl(vd.VIDIOC_ENUM_FMT, fmtdesc):
+            frmsize = vd.v4l2_frmsizeenum()
+            frmsize.pixel_format = fmtdesc.pixelformat
+            while self._ioctl(vd.VIDIOC_ENUM_FRAMESIZES, frmsize):
+                if frmsize.type == vd.V4L2_FRMSIZE_TYPE_DISCRETE:
+                    resolutions.add((frmsize.discrete.width, frmsize.discrete.height))
+                else:
+                    stepwise = frmsize.stepwise
+                    resolutions.add((stepwise.min_width, stepwise.min_height))
+                    resolutions.add((stepwise.max_width, stepwise.max_height))
+                    break
+                frmsize.index += 1
+            fmtdesc.index += 1
+
+        return sorted(resolutions)
+
+    def _frame_rates(self, pixel_format, width, height):
+        rates = []
+        frmival = vd.v4l2_frmivalenum()
+        frmival.pixel_format = pixel_format
+        frmival.width = width
+        frmival.height = height
+        while self._ioctl(vd.VIDIOC_ENUM_FRAMEINTERVALS, frmival):
+            if frmival.type == vd.V4L2_FRMIVAL_TYPE_DISCRETE:
+                intervals = [frmival.discrete]
+            else:
+                # Only the fastest and slowest rate of a range
+                intervals = [frmival.stepwise.min, frmival.stepwise.max]
+            for interval in intervals:
+                if interval.numerator:
+                    rates.append(round(interval.denominator / interval.numerator, 3))
+            if frmival.type != vd.V4L2_FRMIVAL_TYPE_DISCRETE:
+                break
+            frmival.index += 1
+        return rates
+
+    def get_formats(self):
+        """
+        Every capture format with its frame sizes and the frame rates for
+        each size.
+        """
+        formats = []
+        fmtdesc = vd.v4l2_fmtdesc()
+        fmtdesc.type = vd.V4L2_BUF_TYPE_VIDEO_CAPTURE
+        while self._ioctl(vd.VIDIOC_ENUM_FMT, fmtdesc):
+            sizes = []
+            frmsize = vd.v4l2_frmsizeenum()
+            frmsize.pixel_format = fmtdesc.pixelformat
+            while self._ioctl(vd.VIDIOC_ENUM_FRAMESIZES, frmsize):
+                if frmsize.type == vd.V4L2_FRMSIZE_TYPE_DISCRETE:
+                    dimensions = [(frmsize.discrete.width, frmsize.discrete.height)]
+                else:
+                    stepwise = frmsize.stepwise
+                    dimensions = [
+                        (stepwise.min_width, stepwise.min_height),
+                        (stepwise.max_width, stepwise.max_height),
+                    ]
+                for width, height in dimensions:
+                    sizes.append(
+                        {
+                            "width": width,
+                            "height": height,
+                            "fps": self._frame_rates(
+                                fmtdesc.pixelformat, width, height
+                            ),
+                        }
+                    )
+                if frmsize.type != vd.V4L2_FRMSIZE_TYPE_DISCRETE:
+                    break
+                frmsize.index += 1
+
+            formats.append(
+                {
+                    "fourcc": vd.fourcc_string(fmtdesc.pixelformat),
+                    "description": fmtdesc.description.decode("utf-8", "replace"),
+                    "sizes": sizes,
+                }
+            )
+            fmtdesc.index += 1
+
+        return formats
+
+
+def make_backend(device, backend=None):
+    """
+    Return a control backend for device. backend can be a backend instance,
+    a callable taking the device, "ioctl", "v4l2-ctl" or None to use ioctls
+    when the device can be opened.
+    """
+    if backend is None:
+        try:
+            return IoctlBackend(device)
+        except OSError:
+            return CtlBackend(device)
+    elif backend == IoctlBackend.name:
+        return IoctlBackend(device)
+    elif backend == CtlBackend.name:
+        return CtlBackend(device)
+    elif isinstance(backend, str):
+        raise ValueError("Unknown backend {}".format(backend))
+    elif callable(backend):
+        return backend(device)
+
+    return backend
+
+
+class V4L2:
+    def __init__(self, device=0, backend=None, metadata=None):
+        self.device = device
+        self.controls = {}
+        self.backend = make_backend(device, backend)
+        if metadata is None:
+            self.get_ctrls()
+        else:
+            self.load_ctrls(metadata)
+
+    def close(self):
+        self.backend.close()
+
+    def get_ctrls(self):
+        for control in self.backend.list_ctrls():
+            self.controls[control.name] = control
+
+    def load_ctrls(self, metadata):
+        """
+        Build the controls from V4L2_Ctrl.metadata() dicts, e.g. from the
+        capability cache, instead of enumerating them. Only the current
+        values are read from the device.
+        """
+        for data in metadata:
+            control = V4L2_Ctrl(None, self.device, self.backend)
+            control.id = data["id"]
+            control.name = data["name"]
+            control.type = data["type"]
+            control.limits = dict(data["limits"])
+            control.menu = {int(index): entry for index, entry in data["menu"].items()}
+            self.controls[control.name] = control
+        self.get_values()
+
+    def get_resolutions(self):
+        return self.backend.get_resolutions()
+
+    def get_formats(self):
+        return self.backend.get_formats()
+
+    def get_values(self):
+        """
+        Read every readable control in one pass and return {name: value}.
+        """
+        controls = [control for control in self.controls.values() if control.readable()]
+        for control, value in zip(controls, self.backend.get_many(controls)):
+            control.value = value
+        return {control.name: control.value for control in controls}
+
+    def get_flags(self):
+        """
+        Read the current flags of every control. Whether a control is
+        inactive depends on the others, so cached metadata leaves it out.
+        """
+        controls = list(self.controls.values())
+        for control, flags in zip(controls, self.backend.get_flags(controls)):
+            if flags:
+                control.limits["flags"] = flags
+            else:
+                control.limits.pop("flags", None)
+
+    def set_values(self, values):
+        """
+        Write {name: value} in one pass and return the resulting value of
+        every readable control, like get_values(). Controls that already
+        have the value are skipped.
+        """
+        changes = []
+        for name, value in values.items():
+            control = self.controls[name]
+            value = int(value)
+            control.check(value)
+            if control.value != value:
+                changes.append((control, value))
+
+        self.backend.set_many(changes)
+        state = self.get_values()
+
+        for control, value in changes:
+            if control.readable() and control.value != value:
+                print(
+                    "WARNING {} value does not match. {} {}".format(
+                        control.name, value, control.value
+                    )
+                )
+        return state
+
+
+class ControlCache:
+    """
+    Cached snapshot of a device's control values. apply() only writes the
+    controls whose desired value differs from the snapshot. Call
+    invalidate() whenever the device is reopened or the settings may have
+    been changed by someone else. backend is passed to V4L2 each time the
+    snapshot is rebuilt, so it should be a name or callable, not an instance.
+    """
+
+    def __init__(self, device=0, backend=None):
+        self.device = device
+        self.backend = backend
+        self.cam_ctrl = None
+
+        # Totals since creation and counts for the most recent apply()
+        self.writes = 0
+        self.skipped = 0
+        self.last_writes = 0
+        self.last_skipped = 0
+
+    def invalidate(self):
+        if self.cam_ctrl is not None:
+            self.cam_ctrl.close()
+            self.cam_ctrl = None
+
+    def apply(self, settings, verbose=False):
+        if self.cam_ctrl is None:
+            self.cam_ctrl = V4L2(self.device, self.backend)
+
+        self.last_writes = 0
+        self.last_skipped = 0
+        changes = {}
+        for setting, value in settings.items():
+            if setting not in self.cam_ctrl.controls:
+                if verbose:
+                    print("Setting {} not available.".format(setting))
+                continue
+
+            control = self.cam_ctrl.controls[setting]
+            try:
+                value = int(value)
+                control.check(value)
+            except ValueError:
+                if verbose:
+                    print("Unable to set {}".format(setting))
+                continue
+
+            if control.value == value:
+                self.last_skipped += 1
+                continue
+
+            if verbose:
+                print("Setting {} to {}".format(setting, value))
+            changes[setting] = value
+
+        if changes:
+            self.cam_ctrl.set_values(changes)
+            self.last_writes = len(changes)
+
+        self.writes += self.last_writes
+        self.skipped += self.last_skipped
+        metrics.counter("control_writes_total", "Camera control writes").inc(
+            self.last_writes
+        )
+        metrics.counter(
+            "control_skipped_total", "Camera control writes skipped as unchanged"
+        ).inc(self.last_skipped)
+
 
 def list_devices():
     """
@@ -125,7 +740,7 @@ def list_devices():
     """
     devices = []
 
-    result = subprocess.run(["v4l2-ctl", "--list-devices"], stdout=subprocess.PIPE)
+    result = metrics.run(["v4l2-ctl", "--list-devices"], stdout=subprocess.PIPE)
     output_lines = result.stdout.decode("utf-8").replace(":\n\t", "\0")
     for line in output_lines.split("\n"):
         if "\0" in line: